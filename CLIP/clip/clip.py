@@ -10,7 +10,7 @@ from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, CLIP
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -24,7 +24,7 @@ if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1")
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "build_meta", "tokenize"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -38,6 +38,16 @@ _MODELS = {
     "ViT-L/14": "https://openaipublic.azureedge.net/clip/models/b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
 }
 
+# Arguments of the CLIP constructor, as inferred by build_model from the released weights
+_CONFIGS = {
+    "ViT-B/32": dict(embed_dim=512, vision_layers=12, vision_width=768, vision_patch_size=32,
+        context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "ViT-B/16": dict(embed_dim=512, vision_layers=12, vision_width=768, vision_patch_size=16,
+        context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "ViT-L/14": dict(embed_dim=768, vision_layers=24, vision_width=1024, vision_patch_size=14,
+        context_length=77, vocab_size=49408, transformer_width=768, transformer_heads=12, transformer_layers=12),
+}
+
 
 def _download(url: str, root: str):
     os.makedirs(root, exist_ok=True)
@@ -90,6 +100,29 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
+def build_meta(name: str, image_resolution: int = 224):
+    """Build the architecture of a CLIP model on the meta device, without reading or initialising any weights
+
+    Parameters
+    ----------
+    name : str
+        A ViT model name listed by `clip.available_models()`
+
+    image_resolution : int
+        Input resolution the positional embedding of the vision tower is sized for
+
+    Returns
+    -------
+    model : torch.nn.Module
+        The CLIP model with meta tensors, to be allocated with `to_empty` before loading a state dict.
+        Unused parts can be deleted beforehand so that they are never allocated
+    """
+    if name not in _CONFIGS:
+        raise RuntimeError(f"Model {name} cannot be built without weights; available models = {list(_CONFIGS.keys())}")
+    with torch.device("meta"):
+        return CLIP(image_resolution=image_resolution, **_CONFIGS[name]).eval()
+
+
 def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None):
     """Load a CLIP model
 
@@ -5,6 +5,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import dropout_, nn
+from torch.utils.checkpoint import checkpoint
 import warnings
 import math
 from torch._C import _infer_size, _add_docstr
@@ -224,7 +225,7 @@ class ResidualAttentionBlock(nn.Module):
             is_batched = True
             tgt_len, bsz, embed_dim = query.shape
             src_len, _, _ = key.shape
-            expand_bsz = detection_attn_mask.shape[0]//num_heads
+            expand_bsz = detection_attn_mask.shape[0]
             
             assert embed_dim == embed_dim_to_check, \
         f"was expecting embedding dimension of {embed_dim_to_check}, but got {embed_dim}"
@@ -290,29 +291,24 @@ class ResidualAttentionBlock(nn.Module):
             B, Ns, E = k.shape
             q = q / math.sqrt(E)
             attn = torch.bmm(q, k.transpose(-2, -1))
-            if box_coords[0].dim() == 2:
-                    box_len_per_batch = list(map(lambda x: len(x), box_coords))
-            elif box_coords[0].dim() == 3:
-                assert len(box_coords) == 1
-                num_heads = self.attn.num_heads
-                box_len_per_batch = [len(detection_attn_mask) // num_heads]
-            else:
-                assert False
 
-            attn_expand_list = []
-            v_expand_list = []
-            for idx, box_len in enumerate(box_len_per_batch):
-                attn_expand_list.append(attn.reshape(bsz, num_heads, Nt, Ns)[idx].repeat(box_len, 1, 1))
-                v_expand_list.append(v.reshape(bsz, num_heads, Ns, E)[idx].repeat(box_len, 1, 1))
-            attn_expand = torch.cat(attn_expand_list, dim=0)
-            v_expand = torch.cat(v_expand_list, dim=0)
-            attn_expand += attn_mask
+            # The class token attends to the same keys and values for every box of an
+            # image, only the masks differ. Instead of copying the scores and values
+            # for each box, the boxes of each image are stacked as queries, padded to
+            # the largest number of boxes per image, and the masks are broadcast
+            box_idx = box_image_index(box_coords, detection_attn_mask)
+            box_len = torch.bincount(box_idx, minlength=bsz)
+            box_pos = torch.arange(len(box_idx), device=x.device) - (torch.cumsum(box_len, 0) - box_len)[box_idx]
+            mask_padded = attn_mask.new_zeros(bsz, int(box_len.max()) if len(box_idx) else 0, Ns)
+            mask_padded[box_idx, box_pos] = attn_mask[:, 0]
+            attn_expand = attn.reshape(bsz, num_heads, Nt, Ns) + mask_padded.unsqueeze(1)
             attn_expand = F.softmax(attn_expand, dim=-1)
 
             if dropout_p > 0.0:
                 attn_expand = F.dropout(attn_expand, p=dropout_p)
 
-            attn_output_expand = torch.bmm(attn_expand, v_expand)
+            attn_output_expand = torch.matmul(attn_expand, v.reshape(bsz, num_heads, Ns, E))
+            attn_output_expand = attn_output_expand.transpose(1, 2)[box_idx, box_pos]
 
             attn = F.softmax(attn, dim=-1)
             if dropout_p > 0.0:
@@ -323,7 +319,7 @@ class ResidualAttentionBlock(nn.Module):
             attn_output = linear(attn_output, out_proj_weight, out_proj_bias)
             attn_output = attn_output.view(1, bsz, attn_output.size(1))
             
-            attn_output_expand = attn_output_expand.transpose(0, 1).contiguous().view(expand_bsz, embed_dim)
+            attn_output_expand = attn_output_expand.reshape(expand_bsz, embed_dim)
             attn_output_expand = linear(attn_output_expand, out_proj_weight, out_proj_bias)
             attn_output_expand = attn_output_expand.view(1, expand_bsz, attn_output_expand.size(1))
             
@@ -353,19 +349,8 @@ class ResidualAttentionBlock(nn.Module):
                 cls = x[:1, :, :] + cls
                 cls = cls + self.mlp(self.ln_2(cls))
                 
-                x_expand_list = []
-                if box_coords[0].dim() == 2:
-                    box_len_per_batch = list(map(lambda x: len(x), box_coords))
-                elif box_coords[0].dim() == 3:
-                    assert len(box_coords) == 1
-                    num_heads = self.attn.num_heads
-                    box_len_per_batch = [len(detection_attn_mask) // num_heads]
-                else:
-                    assert False
-                for idx, box_len in enumerate(box_len_per_batch):
-                    x_expand_list.append(x[:,idx].unsqueeze(1).repeat(1, box_len, 1))
-                x_expand = torch.cat(x_expand_list, dim=1)
-                mask_cls = x_expand[:1, :, :] + mask_cls
+                # Residual connection with the class token of the image of each box
+                mask_cls = x[:1, box_image_index(box_coords, detection_attn_mask)] + mask_cls
                 mask_cls = mask_cls + self.mlp(self.ln_2(mask_cls))
                 
 
@@ -380,6 +365,24 @@ class ResidualAttentionBlock(nn.Module):
             return {'x':x, 'detection_attn_mask': None, 'layers': None, 'box_coords': None, 'need_patch': need_patch}
 
 
+def box_image_index(box_coords, detection_attn_mask):
+    """
+    Index of the image of each box amongst the batch, given the boxes of each
+    image or, in the pose box case, the pose boxes of a single image
+    """
+    device = detection_attn_mask.device
+    if box_coords[0].dim() == 2:
+        box_len_per_batch = list(map(lambda x: len(x), box_coords))
+    elif box_coords[0].dim() == 3:
+        assert len(box_coords) == 1
+        box_len_per_batch = [len(detection_attn_mask)]
+    else:
+        assert False
+    return torch.repeat_interleave(
+        torch.arange(len(box_len_per_batch), device=device),
+        torch.as_tensor(box_len_per_batch, device=device)
+    )
+
 def torch_intersection(t1, t2):
     combined = torch.cat((t1, t2))
     uniques, counts = combined.unique(return_counts=True)
@@ -387,6 +390,51 @@ def torch_intersection(t1, t2):
     return intersection
 
 
+def box_area_mask(box_coords, L, patch_size):
+    """
+    Fraction of each patch covered by each box, for all boxes at once
+
+    The coverage of a patch is the product of the coverage of its row and of its
+    column. Along each axis, the first and last patches spanned by a box are
+    covered partially and those in between fully
+
+    Parameters:
+    -----------
+        box_coords: Tensor
+            (K, 4) Boxes in pixels
+        L: int
+            Number of tokens, including the class token
+        patch_size: int
+
+    Returns:
+    --------
+        Tensor
+            (K, width * width) Coverage of the patches in the box dtype
+    """
+    width = int(L**0.5)
+    box_coords_normed = box_coords/patch_size
+    box_coords_int = torch.cat([torch.floor(box_coords_normed[:, :2]), torch.ceil(box_coords_normed[:, 2:])], dim=1).clip(0, width)
+    box_coords_area_wh = 1 - torch.abs(box_coords_int - box_coords_normed)
+    a, b, c, d = box_coords_int.unsqueeze(-1).unbind(1)
+    x, y, z, w = box_coords_area_wh.unsqueeze(-1).unbind(1)
+
+    idx = torch.arange(width, device=box_coords.device, dtype=box_coords_int.dtype)
+    ones = torch.ones_like(box_coords_area_wh[:, :1])
+    def coverage(start, end, first, last):
+        # A box within a single patch covers first + last - 1 of it
+        cov = torch.where(idx == start, torch.where(end - start == 1, first + last - 1, first),
+            torch.where(idx == end - 1, last, ones))
+        return cov, (idx >= start) & (idx < end)
+    row, row_in = coverage(b, d, y, w)
+    column, column_in = coverage(a, c, x, z)
+
+    mask = torch.where(
+        row_in.unsqueeze(2) & column_in.unsqueeze(1),
+        row.unsqueeze(2) * column.unsqueeze(1),
+        torch.zeros_like(box_coords_area_wh[:, :1, None])
+    )
+    return mask.flatten(1)
+
 def find_det_mask(box_coords, L, patch_size, heads, pose_attention_weight=None):
     
     if box_coords[0].shape[1] == 4:
@@ -395,33 +443,7 @@ def find_det_mask(box_coords, L, patch_size, heads, pose_attention_weight=None):
         batch_size = box_coords.shape[0]
         det_mask = torch.zeros([batch_size, 1, L]).to(box_coords.device)
         det_mask[:, 0, 0] = 1
-        width = int(L**0.5)
-        box_coords_normed = box_coords/patch_size
-        box_coords_int = torch.cat([torch.floor(box_coords_normed[:, :2]), torch.ceil(box_coords_normed[:, 2:])], dim=1).clip(0, width)
-        box_coords_area_wh = 1 - torch.abs(box_coords_int - box_coords_normed) 
-        for b_i, (box_coord_area_wh, box_coord_int) in enumerate(zip(box_coords_area_wh, box_coords_int)):  
-            a = int(box_coord_int[0])
-            b = int(box_coord_int[1])
-            c = int(box_coord_int[2])
-            d = int(box_coord_int[3])
-            x, y, z, w = box_coord_area_wh.unsqueeze(1)
-            
-            row = torch.arange(width*b+a+1, width*b+c+1).to(x.device)
-            mask_index = row.repeat(d-b) + torch.arange(d-b).to(x.device).repeat_interleave(c-a) * width
-            
-            if c-a == 1 and d-b == 1:
-                mask_area = (x+z-1) * (y+w-1)
-            elif c-a == 1:
-                mask_area = (x+z-1) * torch.cat([y, torch.ones(d-b-2).to(x.device), w])
-            elif d-b == 1:
-                mask_area = (y+w-1) * torch.cat([x, torch.ones(c-a-2).to(x.device), z])
-            else:
-                area_row = torch.cat([x, torch.ones(c-a-2).to(x.device), z])
-                area_column = torch.cat([y, torch.ones(d-b-2).to(x.device), w])
-                mask_area = area_row.unsqueeze(0) * area_column.unsqueeze(1)
-            
-            det_mask[b_i, 0, mask_index] = mask_area.view(-1)
-        
+        det_mask[:, 0, 1:] = box_area_mask(box_coords, L, patch_size)
 
         return torch.ceil(det_mask)     
 
@@ -459,32 +481,7 @@ def find_det_mask_with_area(box_coords, L, patch_size, heads, pose_attention_wei
         batch_size = box_coords.shape[0]
         det_mask = torch.zeros([batch_size, 1, L]).to(box_coords.device)
         det_mask[:, 0, 0] = 1
-        width = int(L**0.5)
-        box_coords_normed = box_coords/patch_size
-        box_coords_int = torch.cat([torch.floor(box_coords_normed[:, :2]), torch.ceil(box_coords_normed[:, 2:])], dim=1).clip(0, width)
-        box_coords_area_wh = 1 - torch.abs(box_coords_int - box_coords_normed) 
-        for b_i, (box_coord_area_wh, box_coord_int) in enumerate(zip(box_coords_area_wh, box_coords_int)):  
-            a = int(box_coord_int[0])
-            b = int(box_coord_int[1])
-            c = int(box_coord_int[2])
-            d = int(box_coord_int[3])
-            x, y, z, w = box_coord_area_wh.unsqueeze(1)
-            
-            row = torch.arange(width*b+a+1, width*b+c+1).to(x.device)
-            mask_index = row.repeat(d-b) + torch.arange(d-b).to(x.device).repeat_interleave(c-a) * width
-            
-            if c-a == 1 and d-b == 1:
-                mask_area = (x+z-1) * (y+w-1)
-            elif c-a == 1:
-                mask_area = (x+z-1) * torch.cat([y, torch.ones(d-b-2).to(x.device), w])
-            elif d-b == 1:
-                mask_area = (y+w-1) * torch.cat([x, torch.ones(c-a-2).to(x.device), z])
-            else:
-                area_row = torch.cat([x, torch.ones(c-a-2).to(x.device), z])
-                area_column = torch.cat([y, torch.ones(d-b-2).to(x.device), w])
-                mask_area = area_row.unsqueeze(0) * area_column.unsqueeze(1)
-            
-            det_mask[b_i, 0, mask_index] = mask_area.view(-1)
+        det_mask[:, 0, 1:] = box_area_mask(box_coords, L, patch_size)
                 
         return det_mask     
     
@@ -513,9 +510,8 @@ def find_det_mask_with_area(box_coords, L, patch_size, heads, pose_attention_wei
     elif box_coords[0].shape[1] == 17:  ### pose box case
 
         assert len(box_coords) == 1
-        box_coords = box_coords[0]
-        pose_box_coords = list(map(lambda x: x.squeeze(0), torch.chunk(box_coords, box_coords.shape[0], dim=0)))
-        pose_det_mask = find_det_mask_with_area(pose_box_coords, L, patch_size, heads)
+        pose_box_coords = box_coords[0].reshape(-1, 4)
+        pose_det_mask = find_det_mask_with_area([pose_box_coords], L, patch_size, heads)
         pose_det_mask = pose_det_mask.reshape(-1, 17, 1, L)
         n_h = pose_det_mask.shape[0]
         total_n = pose_attention_weight.shape[0]
@@ -538,18 +534,63 @@ class Transformer(nn.Module):
         self.heads = heads
         self.attn_mask = attn_mask
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, i, attn_mask) for i in range(layers)])
-        
-    def forward(self, x: torch.Tensor, patch_size=None, box_coords=None, pose_attention_weight=None, need_patch=False):
+        # Number of blocks, from the first, whose activations are recomputed in the
+        # backward pass instead of being kept, in segments of checkpoint_group blocks
+        self.checkpoint_blocks = 0
+        self.checkpoint_group = 1
+
+    def run_blocks(self, seq_dict, start=0, end=None):
+        """
+        Run the blocks from start to end on a sequence dict. Activations of the first
+        checkpoint_blocks blocks are only kept at the inputs of each group of blocks
+        when training with gradients, and the groups are run again in the backward pass
+        """
+        end = self.layers if end is None else end
+        if not (self.training and torch.is_grad_enabled()):
+            return self.resblocks[start:end](seq_dict)
+        for i in range(start, min(self.checkpoint_blocks, end), self.checkpoint_group):
+            j = min(i + self.checkpoint_group, self.checkpoint_blocks, end)
+            seq_dict = checkpoint(self.resblocks[i:j], seq_dict, use_reentrant=False)
+        return self.resblocks[max(start, min(self.checkpoint_blocks, end)):end](seq_dict)
+
+    def forward(self, x: torch.Tensor, patch_size=None, box_coords=None, pose_attention_weight=None, need_patch=False, need_tokens=False):
         #return self.resblocks(x)
         L, B, C = x.shape
         #print("x shape:", x.shape)
         if box_coords is not None:
             detection_attn_mask = find_det_mask_with_area(box_coords, L, patch_size, self.heads, pose_attention_weight)
-            detection_attn_mask = torch.log(detection_attn_mask).repeat_interleave(self.heads, dim=0)
+            # Masks are broadcast over the heads in the last block. The log-masks
+            # stay in fp32 under autocast, as do the scores they are added to
+            detection_attn_mask = torch.log(detection_attn_mask.float())
             seq_dict = {'x':x, 'detection_attn_mask': detection_attn_mask, 'layers': self.layers, 'box_coords': box_coords, 'need_patch': need_patch}
         else:
             seq_dict = {'x':x, 'detection_attn_mask': None, 'layers': None, 'box_coords': None, 'need_patch': need_patch}
-        return self.resblocks(seq_dict)
+        if need_tokens:
+            # Keep the tokens entering the last block, the only one using the masks
+            seq_dict = self.run_blocks(seq_dict, end=self.layers - 1)
+            tokens = seq_dict['x']
+            seq_dict = self.run_blocks(seq_dict, start=self.layers - 1)
+            seq_dict['tokens'] = tokens
+            return seq_dict
+        return self.run_blocks(seq_dict)
+
+    def forward_tokens(self, x: torch.Tensor, start=0, end=None):
+        """
+        Run the blocks from start to end, by default all blocks but the last one,
+        which are the only ones not using box masks
+        """
+        end = self.layers - 1 if end is None else end
+        assert end < self.layers, "The last block needs box masks"
+        seq_dict = {'x':x, 'detection_attn_mask': None, 'layers': None, 'box_coords': None, 'need_patch': False}
+        return self.run_blocks(seq_dict, start, end)['x']
+
+    def forward_last_block(self, tokens: torch.Tensor, patch_size, box_coords, pose_attention_weight=None, need_patch=False):
+        """Run the masked last block on the tokens entering it, as kept with need_tokens"""
+        L, B, C = tokens.shape
+        detection_attn_mask = find_det_mask_with_area(box_coords, L, patch_size, self.heads, pose_attention_weight)
+        detection_attn_mask = torch.log(detection_attn_mask.float())
+        seq_dict = {'x':tokens, 'detection_attn_mask': detection_attn_mask, 'layers': self.layers, 'box_coords': box_coords, 'need_patch': need_patch}
+        return self.run_blocks(seq_dict, start=self.layers - 1)
 
     
         
@@ -572,7 +613,7 @@ class VisionTransformer(nn.Module):
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
 
-    def forward(self, x: torch.Tensor, box_coords=None, box_segs=None, pose_attention_weight=None, need_patch=False):
+    def forward(self, x: torch.Tensor, box_coords=None, box_segs=None, pose_attention_weight=None, need_patch=False, need_tokens=False):
         x = self.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
@@ -586,9 +627,9 @@ class VisionTransformer(nn.Module):
         if box_coords is not None :
             if box_coords[0].shape[1] == 4 or box_coords[0].shape[1] == 17:
                 if box_segs is None:
-                    res = self.transformer(x, self.patch_size, box_coords, pose_attention_weight, need_patch)
+                    res = self.transformer(x, self.patch_size, box_coords, pose_attention_weight, need_patch, need_tokens)
                 else:
-                    res = self.transformer(x, self.patch_size, box_segs, pose_attention_weight, need_patch)
+                    res = self.transformer(x, self.patch_size, box_segs, pose_attention_weight, need_patch, need_tokens)
                 mask_cls_tok = res['x']
                 cls_tok = res['cls']
                 if need_patch:
@@ -605,10 +646,12 @@ class VisionTransformer(nn.Module):
                 mask_cls_tok = self.ln_post(mask_cls_tok[0])
                 cls_tok = self.ln_post(cls_tok[0])
                 
+                outputs = (mask_cls_tok, cls_tok)
                 if need_patch:
-                    return mask_cls_tok, cls_tok, patch_tok
-                else:
-                    return mask_cls_tok, cls_tok
+                    outputs += (patch_tok,)
+                if need_tokens:
+                    outputs += (res['tokens'],)
+                return outputs
 
                 #center_point = fine_det_center_point(box_coords, self.input_resolution, self.patch_size)
 
@@ -647,6 +690,47 @@ class VisionTransformer(nn.Module):
         #if self.proj is not None:
         #    x = x @ self.proj
 
+    def forward_tokens(self, x: torch.Tensor, blocks=None):
+        """
+        Encode images up to the last block, whose (L, B, C) input tokens do not
+        depend on the boxes and can be pooled later with forward_from_tokens.
+        Only the first given number of blocks are run if blocks is not None
+        """
+        x = self.conv1(x)
+        x = x.reshape(x.shape[0], x.shape[1], -1).permute(0, 2, 1)
+        x = torch.cat([self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device), x], dim=1)
+        x = x + self.positional_embedding.to(x.dtype)
+        x = self.ln_pre(x)
+        return self.transformer.forward_tokens(x.permute(1, 0, 2), end=blocks)
+
+    def advance_tokens(self, tokens: torch.Tensor, start: int):
+        """
+        Run the blocks from start up to the last one on the (L, B, C) tokens left by
+        forward_tokens with blocks=start, returning the tokens entering the last block
+        """
+        return self.transformer.forward_tokens(tokens, start)
+
+    def in_prefix(self, name: str, blocks: int) -> bool:
+        """
+        Whether a parameter, named as in the state dict of this module, is used to
+        encode images up to the given number of blocks
+        """
+        if name.startswith('transformer.resblocks.'):
+            return int(name.split('.')[2]) < blocks
+        return not name.startswith(('ln_post', 'proj'))
+
+    def forward_from_tokens(self, tokens: torch.Tensor, box_coords, pose_attention_weight=None, need_patch=False):
+        """
+        Pool box features with new box or pose masks from the (L, B, C) tokens entering
+        the last block, returned by forward with need_tokens. As the earlier blocks do
+        not use the masks, the outputs are those of forward on the same images
+        """
+        res = self.transformer.forward_last_block(tokens, self.patch_size, box_coords, pose_attention_weight, need_patch)
+        outputs = (self.ln_post(res['x'][0]), self.ln_post(res['cls'][0]))
+        if need_patch:
+            outputs += (res['global_x'].permute(1, 0, 2)[:, 1:, :],)
+        return outputs
+
 
 
 class CLIP(nn.Module):
@@ -746,17 +830,26 @@ class CLIP(nn.Module):
     def dtype(self):
         return self.visual.conv1.weight.dtype
 
-    def encode_image(self, image, box_coords=None, box_segs=None, pose_attention_weight=None, need_patch=False):
+    def encode_image(self, image, box_coords=None, box_segs=None, pose_attention_weight=None, need_patch=False, need_tokens=False):
         if box_coords is None:
             return self.visual(image.type(self.dtype), need_patch=need_patch)
         else:
             if box_segs is None:
                 if pose_attention_weight is None:
-                    return self.visual(image.type(self.dtype), box_coords=box_coords, need_patch=need_patch)
+                    return self.visual(image.type(self.dtype), box_coords=box_coords, need_patch=need_patch, need_tokens=need_tokens)
                 else:
-                    return self.visual(image.type(self.dtype), box_coords=box_coords, pose_attention_weight=pose_attention_weight, need_patch=need_patch)
+                    return self.visual(image.type(self.dtype), box_coords=box_coords, pose_attention_weight=pose_attention_weight, need_patch=need_patch, need_tokens=need_tokens)
             else:
-                return self.visual(image.type(self.dtype), box_coords=box_coords, box_segs=box_segs, need_patch=need_patch)    
+                return self.visual(image.type(self.dtype), box_coords=box_coords, box_segs=box_segs, need_patch=need_patch, need_tokens=need_tokens)
+
+    def encode_tokens(self, image, blocks=None):
+        return self.visual.forward_tokens(image.type(self.dtype), blocks)
+
+    def advance_tokens(self, tokens, start):
+        return self.visual.advance_tokens(tokens.type(self.dtype), start)
+
+    def encode_image_from_tokens(self, tokens, box_coords, pose_attention_weight=None, need_patch=False):
+        return self.visual.forward_from_tokens(tokens.type(self.dtype), box_coords, pose_attention_weight, need_patch)
     
 
     def encode_text(self, text):
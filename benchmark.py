@@ -0,0 +1,385 @@
+"""
+Micro-benchmarks of the interaction head
+
+    python benchmark.py mbf --device cuda
+    python benchmark.py graph --device cuda --batch-size 11
+    python benchmark.py amp --device cuda --dtype fp16 --patch-size 16
+    python benchmark.py checkpoint --device cuda --patch-sizes 16 32
+"""
+
+import time
+import torch
+import weakref
+import argparse
+import torch.nn.functional as F
+
+from torch import nn
+from collections import OrderedDict
+from torch.utils._pytree import tree_leaves
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from interaction_head import MultiBranchFusion, MessageMBF, GraphHead
+
+class PeakMemory(TorchDispatchMode):
+    """
+    Track the peak size of the tensor storages allocated within the context.
+    Used on CPU, where there is no counterpart of torch.cuda.max_memory_allocated
+    """
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+        self._seen = weakref.WeakSet()
+    def _free(self, nbytes):
+        self.live -= nbytes
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_leaves(out):
+            if not isinstance(t, torch.Tensor):
+                continue
+            storage = t.untyped_storage()
+            if storage in self._seen:
+                continue
+            self._seen.add(storage)
+            self.live += storage.nbytes()
+            self.peak = max(self.peak, self.live)
+            weakref.finalize(storage, self._free, storage.nbytes())
+        return out
+
+def measure(fn, device, repeats):
+    """
+    Returns:
+    --------
+        float
+            Average time per call in milliseconds
+        float
+            Peak memory allocated during a call in MiB, excluding existing tensors
+    """
+    # Warm up
+    for _ in range(3):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t = (time.perf_counter() - t) / repeats * 1e3
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        peak = torch.cuda.max_memory_allocated(device) - base
+    else:
+        with PeakMemory() as tracker:
+            fn()
+        peak = tracker.peak
+    return t, peak / 2 ** 20
+
+class LoopMBF(MultiBranchFusion):
+    """Reference implementation running one branch at a time"""
+    def forward(self, appearance, spatial):
+        return F.relu(torch.stack([
+            fc_3(F.relu(fc_1(appearance) * fc_2(spatial)))
+            for fc_1, fc_2, fc_3
+            in zip(self.fc_1, self.fc_2, self.fc_3)
+        ]).sum(dim=0))
+
+class LoopPairMBF(LoopMBF):
+    """Reference attention head on the concatenated node encodings of every pair"""
+    def forward(self, h_node_encodings, node_encodings, spatial):
+        n_h, n = spatial.shape[:2]
+        return super().forward(torch.cat([
+            h_node_encodings[:, None].expand(-1, n, -1),
+            node_encodings[None].expand(n_h, -1, -1)
+        ], 2), spatial)
+
+class PairMBF(MultiBranchFusion):
+    """Attention head with the node encodings projected once per node"""
+    def forward(self, h_node_encodings, node_encodings, spatial):
+        return self.forward_projected(
+            self.project_appearance(h_node_encodings)[:, None]
+            + self.project_appearance(node_encodings,
+                h_node_encodings.shape[1], bias=False)[None],
+            spatial
+        )
+
+class LoopMessageMBF(MessageMBF):
+    """Reference implementation running one branch at a time"""
+    def _forward_human_nodes(self, appearance, spatial):
+        n_h, n = spatial.shape[:2]
+        return torch.stack([
+            fc_3(F.relu(
+                fc_1(appearance).repeat(n, 1, 1)
+                * fc_2(spatial).permute([1, 0, 2])
+            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
+        ]).sum(dim=0)
+    def _forward_object_nodes(self, appearance, spatial):
+        n_h, n = spatial.shape[:2]
+        return torch.stack([
+            fc_3(F.relu(
+                fc_1(appearance).repeat(n_h, 1, 1)
+                * fc_2(spatial)
+            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
+        ]).sum(dim=0)
+
+def compare(name, reference, fused, inputs, args):
+    """Time two modules with the same parameters on the same inputs"""
+    fused.load_state_dict(reference.state_dict())
+    for module in (reference, fused):
+        module.to(args.device).train(args.backward)
+    inputs = [x.requires_grad_(args.backward) for x in inputs]
+
+    def run(module):
+        def fn():
+            if args.backward:
+                module(*inputs).sum().backward()
+            else:
+                with torch.no_grad():
+                    module(*inputs)
+        return fn
+
+    with torch.no_grad():
+        diff = (reference(*inputs) - fused(*inputs)).abs().max().item()
+    t_ref, m_ref = measure(run(reference), args.device, args.repeats)
+    t_fused, m_fused = measure(run(fused), args.device, args.repeats)
+    print("{:<20} loop {:8.2f} ms {:8.1f} MiB | fused {:8.2f} ms {:8.1f} MiB | "
+        "speedup {:5.2f}x | max abs diff {:.2e}".format(
+        name, t_ref, m_ref, t_fused, m_fused, t_ref / t_fused, diff
+    ))
+
+def benchmark_mbf(args):
+    """Compare the fused multi-branch fusion against the per-branch loop"""
+    n_h, n = args.num_human, args.num_boxes
+    rep, enc, card = args.representation_size, args.node_encoding_size, args.cardinality
+    device = args.device
+
+    torch.manual_seed(0)
+    # Attention head of GraphHead, on the appearance and spatial features of pairs
+    compare('pairs',
+        LoopPairMBF(enc * 2, 1024, rep, card), PairMBF(enc * 2, 1024, rep, card),
+        [torch.rand(n_h, enc, device=device), torch.rand(n, enc, device=device),
+            torch.rand(n_h, n, 1024, device=device)],
+        args
+    )
+    # Messages from humans to objects and vice versa
+    compare('human messages',
+        LoopMessageMBF(enc, 1024, rep, 'human', card),
+        MessageMBF(enc, 1024, rep, 'human', card),
+        [torch.rand(n_h, enc, device=device), torch.rand(n_h, n, 1024, device=device)],
+        args
+    )
+    compare('object messages',
+        LoopMessageMBF(enc, 1024, rep, 'object', card),
+        MessageMBF(enc, 1024, rep, 'object', card),
+        [torch.rand(n, enc, device=device), torch.rand(n_h, n, 1024, device=device)],
+        args
+    )
+
+def random_detections(args, human_idx=49):
+    """Random box features, detections and targets of a batch, humans first"""
+    device = args.device
+    num_human = torch.randint(1, args.max_human + 1, (args.batch_size,)).tolist()
+    num_object = torch.randint(1, args.max_object + 1, (args.batch_size,)).tolist()
+    coords, labels, scores, heatmaps, joints, joint_scores, targets = [], [], [], [], [], [], []
+    for n_h, n_o in zip(num_human, num_object):
+        n = n_h + n_o
+        xy = torch.rand(n, 2, device=device) * 400
+        coords.append(torch.cat([xy, xy + torch.rand(n, 2, device=device) * 250 + 8], 1))
+        l = torch.randint(0, 79, (n,), device=device)
+        l[l >= human_idx] += 1; l[:n_h] = human_idx
+        labels.append(l)
+        scores.append(torch.rand(n, device=device))
+        # Heatmaps are only checked for their size
+        heatmaps.append(torch.zeros(n_h, 17, 1, 1, device=device))
+        joints.append(torch.rand(n_h, 17, 2, device=device) * 600)
+        joint_scores.append(torch.rand(n_h, 17, device=device))
+        targets.append(dict(
+            boxes_h=coords[-1][:1], boxes_o=coords[-1][-1:],
+            labels=torch.randint(0, 117, (1,), device=device)
+        ))
+    num_boxes = sum(num_human) + sum(num_object)
+    return dict(
+        features={'global': torch.rand(args.batch_size, args.out_channels, device=device)},
+        image_shapes=[(672, 672)] * args.batch_size,
+        box_features=torch.rand(num_boxes, args.out_channels, device=device),
+        pose_box_features=torch.rand(
+            sum(num_human) * 17, args.out_channels, 5, 5, device=device),
+        box_coords=coords, box_labels=labels, box_scores=scores,
+        pose_heatmaps=heatmaps, human_joints=joints,
+        human_joints_score=joint_scores, targets=targets
+    )
+
+def benchmark_graph(args):
+    """Compare message passing on padded batches against one image at a time"""
+    torch.manual_seed(0)
+    object_to_target = [torch.randint(0, 117, (3,)).tolist() for _ in range(80)]
+    head = GraphHead(
+        list(range(117)), None, args.out_channels, 5, 1024, 1024, 117, 49,
+        object_to_target, None, num_iter=args.num_iter, backbone_name='CLIP_CLS',
+        pose=True, local_pose=args.local_pose
+    ).to(args.device).train(args.backward)
+    inputs = random_detections(args)
+    if not args.backward:
+        inputs['targets'] = None
+
+    def forward(batched):
+        head.batched = batched
+        # Joints are clipped to the image in place
+        return head(**dict(inputs, human_joints=[j.clone() for j in inputs['human_joints']]))
+
+    def run(batched):
+        def fn():
+            if args.backward:
+                sum(f.sum() for f in forward(batched)[0]).backward()
+            else:
+                with torch.no_grad():
+                    forward(batched)
+        return fn
+
+    with torch.no_grad():
+        diff = max((a - b).abs().max().item() if a.numel() else 0. for a, b in zip(
+            forward(False)[0], forward(True)[0]))
+    t_loop, m_loop = measure(run(False), args.device, args.repeats)
+    t_batched, m_batched = measure(run(True), args.device, args.repeats)
+    print("batch size {} | loop {:7.1f} images/s {:8.1f} MiB | "
+        "batched {:7.1f} images/s {:8.1f} MiB | speedup {:5.2f}x | max abs diff {:.2e}".format(
+        args.batch_size, args.batch_size / t_loop * 1e3, m_loop,
+        args.batch_size / t_batched * 1e3, m_batched, t_loop / t_batched, diff
+    ))
+
+def build_network(args, patch_size):
+    """CLIP_CLS network at 672px, with the weights of a checkpoint or random ones"""
+    # Deferred so that the other benchmarks do not need the dataset dependencies
+    from models import SpatiallyConditionedGraph as SCG
+    from utils import load_checkpoint
+
+    torch.manual_seed(0)
+    object_to_target = [torch.randint(0, 117, (3,)).tolist() for _ in range(80)]
+    net = SCG(object_to_target, None, None, None, 49, backbone_name='CLIP_CLS',
+        pretrained=False, patch_size=patch_size, pose=True, warp=True,
+        local_pose=args.local_pose, pose_cls=args.local_pose)
+    if args.model_path is not None:
+        load_checkpoint(net, args.model_path)
+    else:
+        # The vision tower is allocated without being initialised
+        for m in net.backbone.modules():
+            if isinstance(m, nn.MultiheadAttention):
+                m._reset_parameters()
+            elif hasattr(m, 'reset_parameters'):
+                m.reset_parameters()
+        for p in (net.backbone.visual.class_embedding, net.backbone.visual.positional_embedding):
+            nn.init.normal_(p, std=0.02)
+    return net.to(args.device)
+
+def benchmark_amp(args):
+    """Compare the backbone and interaction head under autocast against fp32"""
+    from utils import AMP_DTYPES
+
+    head = build_network(args, args.patch_size).interaction_head.eval()
+
+    inputs = random_detections(args)
+    detections = [dict(boxes=b, labels=l, scores=s, human_joints=j,
+        human_joints_score=js, pose_heatmap=h) for b, l, s, j, js, h in zip(
+        inputs['box_coords'], inputs['box_labels'], inputs['box_scores'],
+        inputs['human_joints'], inputs['human_joints_score'], inputs['pose_heatmaps'])]
+    images = torch.randn(args.batch_size, 3, 672, 672, device=args.device)
+    dtype = AMP_DTYPES[args.dtype]
+
+    def forward(amp):
+        with torch.no_grad(), torch.autocast(args.device.type, dtype=dtype, enabled=amp):
+            # Joints are clipped to the image in place
+            return head(OrderedDict(), [dict(d, human_joints=d['human_joints'].clone())
+                for d in detections], inputs['image_shapes'], None, images)
+
+    diff = max((a['scores'] - b['scores']).abs().max().item() if a['scores'].numel() else 0.
+        for a, b in zip(forward(False), forward(True)))
+    t_fp32, m_fp32 = measure(lambda: forward(False), args.device, args.repeats)
+    t_amp, m_amp = measure(lambda: forward(True), args.device, args.repeats)
+    print("batch size {} | fp32 {:7.2f} images/s {:8.1f} MiB | "
+        "{} {:7.2f} images/s {:8.1f} MiB | speedup {:5.2f}x | max abs score diff {:.2e}".format(
+        args.batch_size, args.batch_size / t_fp32 * 1e3, m_fp32, args.dtype,
+        args.batch_size / t_amp * 1e3, m_amp, t_fp32 / t_amp, diff
+    ))
+
+def benchmark_checkpoint(args):
+    """Time training steps of the backbone with its first blocks checkpointed"""
+    print("patch | checkpointed blocks | group | images/s | peak MiB")
+    for patch_size in args.patch_sizes:
+        backbone = build_network(args, patch_size).backbone.train()
+        transformer = backbone.visual.transformer
+        images = torch.randn(args.batch_size, 3, 672, 672, device=args.device)
+        box_coords = random_detections(args)['box_coords']
+
+        def fn():
+            backbone.zero_grad(set_to_none=True)
+            box_features, global_features = backbone.encode_image(images, box_coords)
+            (box_features.sum() + global_features.sum()).backward()
+
+        for blocks in args.blocks:
+            transformer.checkpoint_blocks = blocks
+            transformer.checkpoint_group = args.group
+            t, m = measure(fn, args.device, args.repeats)
+            print("{:5d} | {:19d} | {:5d} | {:8.2f} | {:8.1f}".format(
+                patch_size, blocks, args.group, args.batch_size / t * 1e3, m))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the interaction head")
+    parser.add_argument('--device', default='cuda', type=torch.device)
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--backward', action='store_true',
+                        help="Time forward and backward passes instead of inference")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    mbf = subparsers.add_parser('mbf',
+        help="Fused multi-branch fusion against the per-branch loop")
+    mbf.add_argument('--num-human', default=15, type=int)
+    mbf.add_argument('--num-boxes', default=30, type=int)
+    mbf.add_argument('--representation-size', default=1024, type=int)
+    mbf.add_argument('--node-encoding-size', default=1024, type=int)
+    mbf.add_argument('--cardinality', default=16, type=int)
+    mbf.set_defaults(func=benchmark_mbf)
+
+    graph = subparsers.add_parser('graph',
+        help="Message passing on padded batches against one image at a time")
+    graph.add_argument('--batch-size', default=11, type=int)
+    graph.add_argument('--max-human', default=15, type=int)
+    graph.add_argument('--max-object', default=15, type=int)
+    graph.add_argument('--num-iter', default=2, type=int)
+    graph.add_argument('--out-channels', default=768, type=int)
+    graph.add_argument('--local-pose', action='store_true')
+    graph.set_defaults(func=benchmark_graph)
+
+    amp = subparsers.add_parser('amp',
+        help="Backbone and interaction head under autocast against fp32")
+    amp.add_argument('--dtype', default='fp16', choices=['fp16', 'bf16'],
+                     help="Use bf16 on the CPU")
+    amp.add_argument('--batch-size', default=4, type=int)
+    amp.add_argument('--max-human', default=15, type=int)
+    amp.add_argument('--max-object', default=15, type=int)
+    amp.add_argument('--patch-size', default=16, type=int)
+    amp.add_argument('--local-pose', action='store_true')
+    amp.add_argument('--model-path', default=None,
+                     help="Checkpoint to load instead of random weights")
+    amp.set_defaults(func=benchmark_amp, out_channels=768)
+
+    ckpt = subparsers.add_parser('checkpoint',
+        help="Backbone training steps with activation checkpointing")
+    ckpt.add_argument('--patch-sizes', nargs='+', default=[16, 32], type=int)
+    ckpt.add_argument('--blocks', nargs='+', default=[0, 6, 11, 12], type=int,
+                      help="Numbers of checkpointed blocks to compare")
+    ckpt.add_argument('--group', default=1, type=int,
+                      help="Number of blocks per checkpointed segment")
+    ckpt.add_argument('--batch-size', default=4, type=int)
+    ckpt.add_argument('--max-human', default=15, type=int)
+    ckpt.add_argument('--max-object', default=15, type=int)
+    ckpt.add_argument('--model-path', default=None,
+                      help="Checkpoint to load instead of random weights")
+    ckpt.set_defaults(func=benchmark_checkpoint, out_channels=768, local_pose=False)
+
+    args = parser.parse_args()
+    print(args)
+
+    args.func(args)
@@ -8,69 +8,68 @@ import scipy.io as sio
 
 from tqdm import tqdm
 from collections import defaultdict
-from torch.utils.data import DataLoader
 
 import pocket
 
-from utils import DataFactory, custom_collate
-from models import SpatiallyConditionedGraph as SCG
-
-
-def inference_hicodet(net, dataloader, coco2hico, cache_dir):
-    dataset = dataloader.dataset.dataset
-    net.eval()
-
+from hicodet.hicodet import HICODet
+from utils import inference, build_inference, run_sharded, AMP_DTYPES
+
+# Number of interaction classes the network predicts for each dataset
+NUM_CLASSES = {'hicodet': 117, 'vcoco': 24}
+
+def format_hicodet(output, dataset):
+    """
+    Group the detected pairs of an image by predicted interaction class
+
+    Returns:
+        dict: Arrays of (human box, object box, score) rows, keyed by interaction class
+    """
+    box_idx = output['index']
+    boxes_h = output['boxes_h'][box_idx]
+    boxes_o = output['boxes_o'][box_idx]
+    objects = output['object'][box_idx]
+    # Convert box representation to pixel indices
+    boxes_h[:, 2:] -= 1
+    boxes_o[:, 2:] -= 1
+
+    scores = output['scores']
+    verbs = output['prediction']
+    interactions = dataset.object_n_verb_to_interaction_lut[objects, verbs]
+
+    # Group box pairs with the same predicted class
+    permutation = interactions.argsort()
+    boxes_h = boxes_h[permutation]
+    boxes_o = boxes_o[permutation]
+    interactions = interactions[permutation]
+    scores = scores[permutation]
+
+    results = dict()
+    unique_class, counts = interactions.unique(return_counts=True)
+    n = 0
+    for cls_id, cls_num in zip(unique_class, counts):
+        results[cls_id.item()] = torch.cat([
+            boxes_h[n: n + cls_num],
+            boxes_o[n: n + cls_num],
+            scores[n: n + cls_num, None]
+        ], dim=1).numpy()
+        n += cls_num
+    return results
+
+def save_hicodet(results, dataset, coco2hico, cache_dir):
+    """
+    Arguments:
+        results(iterable): Tuples of (index, grouped detections), where the index
+            is amongst images excluding those without ground truth box pairs
+    """
     # Include empty images when counting
     nimages = len(dataset.annotations)
     all_results = np.empty((600, nimages), dtype=object)
 
     object2int = dataset.object_to_interaction
-    for i, batch in enumerate(tqdm(dataloader)):
-        inputs = pocket.ops.relocate_to_cuda(batch[:-1])
-        with torch.no_grad():
-            output = net(*inputs)
-        if output is None:
-            continue
-
-        # Batch size is fixed as 1 for inference
-        assert len(output) == 1, "Batch size is not 1"
-        output = pocket.ops.relocate_to_cpu(output[0])
-        # NOTE Index i is the intra-index amongst images excluding those without
-        # ground truth box pairs
+    for i, detections in results:
         image_idx = dataset._idx[i]
-
-        box_idx = output['index']
-        boxes_h = output['boxes_h'][box_idx]
-        boxes_o = output['boxes_o'][box_idx]
-        objects = output['object'][box_idx]
-        # Convert box representation to pixel indices
-        boxes_h[:, 2:] -= 1
-        boxes_o[:, 2:] -= 1
-
-        scores = output['scores']
-        verbs = output['prediction']
-        interactions = torch.tensor([
-            dataset.object_n_verb_to_interaction[o][v]
-            for o, v in zip(objects, verbs)
-        ])
-
-        # Group box pairs with the same predicted class
-        permutation = interactions.argsort()
-        boxes_h = boxes_h[permutation]
-        boxes_o = boxes_o[permutation]
-        interactions = interactions[permutation]
-        scores = scores[permutation]
-
-        # Store results
-        unique_class, counts = interactions.unique(return_counts=True)
-        n = 0
-        for cls_id, cls_num in zip(unique_class, counts):
-            all_results[cls_id.long(), image_idx] = torch.cat([
-                boxes_h[n: n + cls_num],
-                boxes_o[n: n + cls_num],
-                scores[n: n + cls_num, None]
-            ], dim=1).numpy()
-            n += cls_num
+        for cls_id, dets in detections.items():
+            all_results[cls_id, image_idx] = dets
 
     # Replace None with size (0,0) arrays
     for i in range(600):
@@ -85,6 +84,15 @@ def inference_hicodet(net, dataloader, coco2hico, cache_dir):
             dict(all_boxes=all_results[interaction_idx])
         )
 
+def inference_hicodet(net, dataloader, coco2hico, cache_dir, device='cuda', amp=None):
+    dataset = dataloader.dataset.dataset
+    # NOTE Index i is the intra-index amongst images excluding those without
+    # ground truth box pairs
+    save_hicodet((
+        (i, format_hicodet(output, dataset))
+        for i, output, _ in inference(net, dataloader, device, amp)
+    ), dataset, coco2hico, cache_dir)
+
 class CacheTemplate(defaultdict):
     """A template for VCOCO cached results """
     def __init__(self, **kwargs):
@@ -100,94 +108,82 @@ class CacheTemplate(defaultdict):
         else:
             return [0., 0., .1, .1, 0.]
 
-def inference_vcoco(net, dataloader, cache_dir, cache_name):
-    dataset = dataloader.dataset.dataset
-    net.eval()
+def format_vcoco(output, dataset, i):
+    """Convert the detected pairs of an image to the fields of V-COCO cache entries"""
+    image_id = dataset.image_id(i)
+    box_idx = output['index']
+    boxes_h = output['boxes_h'][box_idx]
+    boxes_o = output['boxes_o'][box_idx]
+    scores = output['scores']
+    actions = output['prediction']
+
+    results = []
+    for bh, bo, s, a in zip(boxes_h, boxes_o, scores, actions):
+        a_name = dataset.actions[a].split()
+        result = dict(image_id=image_id, person_box=bh.tolist())
+        result[a_name[0] + '_agent'] = s.item()
+        result['_'.join(a_name)] = bo.tolist() + [s.item()]
+        results.append(result)
+    return results
+
+def save_vcoco(results, cache_dir, cache_name):
+    """
+    Arguments:
+        results(iterable): Tuples of (index, cache entry fields) in any order
+    """
     all_results = []
-    for i, batch in enumerate(tqdm(dataloader)):
-        inputs = pocket.ops.relocate_to_cuda(batch[:-1])
-        with torch.no_grad():
-            output = net(*inputs)
-        if output is None:
-            continue
-
-        # Batch size is fixed as 1 for inference
-        assert len(output) == 1, "Batch size is not 1"
-        output = pocket.ops.relocate_to_cpu(output[0])
-
-        image_id = dataset.image_id(i)
-        box_idx = output['index']
-        boxes_h = output['boxes_h'][box_idx]
-        boxes_o = output['boxes_o'][box_idx]
-        scores = output['scores']
-        actions = output['prediction']
-
-        for bh, bo, s, a in zip(boxes_h, boxes_o, scores, actions):
-            a_name = dataset.actions[a].split()
-            result = CacheTemplate(image_id=image_id, person_box=bh.tolist())
-            result[a_name[0] + '_agent'] = s.item()
-            result['_'.join(a_name)] = bo.tolist() + [s.item()]
-            all_results.append(result)
+    for _, entries in sorted(results, key=lambda x: x[0]):
+        all_results += [CacheTemplate(**entry) for entry in entries]
 
     with open(os.path.join(cache_dir, cache_name), 'wb') as f:
         # Use protocol 2 for compatibility with Python2
         pickle.dump(all_results, f, 2)
 
-def main(args):
-    torch.cuda.set_device(0)
-    torch.backends.cudnn.benchmark = False
+def inference_vcoco(net, dataloader, cache_dir, cache_name, device='cuda', amp=None):
+    dataset = dataloader.dataset.dataset
+    save_vcoco((
+        (i, format_vcoco(output, dataset, i))
+        for i, output, _ in inference(net, dataloader, device, amp)
+    ), cache_dir, cache_name)
+
+def inference_shard(rank, num_shards, args, put):
+    """Format the detections of every num_shards-th image and send them back"""
+    net, dataloader, device, _ = build_inference(args, NUM_CLASSES[args.dataset], rank, num_shards)
+    dataset = dataloader.dataset.dataset
+    for i, output, _ in inference(net, dataloader, device, AMP_DTYPES.get(args.amp)):
+        if args.dataset == 'hicodet':
+            put((i, format_hicodet(output, dataset)))
+        else:
+            put((i, format_vcoco(output, dataset, i)))
 
+def main(args):
     if not os.path.exists(args.cache_dir):
         os.makedirs(args.cache_dir)
 
-    dataloader = DataLoader(
-        dataset=DataFactory(
-            name=args.dataset, partition=args.partition,
-            data_root=args.data_root,
-            detection_root=args.detection_dir, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose, 
-        ), collate_fn=custom_collate, batch_size=1,
-        num_workers=args.num_workers, pin_memory=True
-    )
-
-    if args.dataset == 'hicodet':
-        object_to_target = dataloader.dataset.dataset.object_to_verb
-        human_idx = 49
-        num_classes = 117
-    elif args.dataset == 'vcoco':
-        object_to_target = dataloader.dataset.dataset.object_to_action
-        object_to_interaction = None
-        object_n_verb_to_interaction = None
-        verb_list = dataloader.dataset.dataset.actions
-        human_idx = 1
-        num_classes = 24
-    torch.cuda.set_device(0)
-    torch.cuda.empty_cache()
-    net = SCG(
-        object_to_target, object_n_verb_to_interaction, object_to_interaction, verb_list, human_idx, num_classes=num_classes, backbone_name=args.backbone_name, 
-        output_size=args.roi_size,
-        num_iterations=args.num_iter,
-        max_human=args.max_human, max_object=args.max_object,
-        box_score_thresh=args.box_score_thresh,
-        patch_size=args.patch_size, pose=args.pose, warp=args.warp, local_pose=args.local_pose, pose_cls=args.pose_cls
-    )
-    
-    if os.path.exists(args.model_path):
-        print("Loading model from ", args.model_path)
-        checkpoint = torch.load(args.model_path, map_location="cpu")
-        net.load_state_dict(checkpoint['model_state_dict'])
-        epoch = checkpoint["epoch"]
-    elif len(args.model_path):
-        print("\nWARNING: The given model path does not exist. "
-            "Proceed to use a randomly initialised model.\n")
-
-    net.cuda()
-    
+    if args.shards > 1:
+        # Results are keyed by image index, so they are merged into the same
+        # cache files as a single-process run regardless of arrival order
+        results = run_sharded(inference_shard, args.shards, args)
+        if args.dataset == 'hicodet':
+            with open(os.path.join(args.data_root, 'coco80tohico80.json'), 'r') as f:
+                coco2hico = json.load(f)
+            dataset = HICODet(None, anno_file=os.path.join(
+                args.data_root, 'instances_{}_vitpose.json'.format(args.partition)),
+                packed=args.packed_anno)
+            save_hicodet(results, dataset, coco2hico, args.cache_dir)
+        elif args.dataset == 'vcoco':
+            save_vcoco(results, args.cache_dir, args.cache_name)
+        return
+
+    net, dataloader, device, _ = build_inference(args, NUM_CLASSES[args.dataset])
     if args.dataset == 'hicodet':
         with open(os.path.join(args.data_root, 'coco80tohico80.json'), 'r') as f:
             coco2hico = json.load(f)
-        inference_hicodet(net, dataloader, coco2hico, args.cache_dir)
+        inference_hicodet(net, dataloader, coco2hico, args.cache_dir, device,
+            AMP_DTYPES.get(args.amp))
     elif args.dataset == 'vcoco':
-        inference_vcoco(net, dataloader, args.cache_dir, args.cache_name)
+        inference_vcoco(net, dataloader, args.cache_dir, args.cache_name, device,
+            AMP_DTYPES.get(args.amp))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Train an interaction head")
@@ -202,6 +198,14 @@ if __name__ == "__main__":
     parser.add_argument('--max-human', default=15, type=int)
     parser.add_argument('--max-object', default=15, type=int)
     parser.add_argument('--num-workers', default=2, type=int)
+    parser.add_argument('--batch-size', default=None, type=int,
+                        help="Number of images the network runs on at once, 1 by default, "
+                        "or at most with --batch-budget, 64 by default")
+    parser.add_argument('--batch-budget', default=None, type=float,
+                        help="Pack images into batches of at most this many boxes or pairs, "
+                        "see --budget-unit, instead of a fixed number of images")
+    parser.add_argument('--budget-unit', default='boxes', choices=['boxes', 'pairs'],
+                        help="Unit of --batch-budget, counted after the box score threshold")
     parser.add_argument('--model-path', default='', type=str)
     parser.add_argument('--backbone-name', default='CLIP_CLS', type=str)
     parser.add_argument('--num-class', default=24, type=int)
@@ -209,8 +213,26 @@ if __name__ == "__main__":
     parser.add_argument('--roi-size', default=7, type=int)
     parser.add_argument('--pose', action='store_true')
     parser.add_argument('--warp', action='store_true')
+    parser.add_argument('--worker-preprocess', action='store_true',
+                        help="Warp or resize images and transform boxes in the dataloader workers")
     parser.add_argument('--local_pose', action='store_true')
     parser.add_argument('--pose_cls', action='store_true')
+    parser.add_argument('--packed-anno', action='store_true',
+                        help="Load annotations from memory-mapped arrays instead of json")
+    parser.add_argument('--warp-cache', default=None, type=str,
+                        help="Directory of images warped ahead of time with pack.py warp")
+    parser.add_argument('--token-cache', default=None, type=str,
+                        help="Directory where the backbone tokens entering its last block are "
+                        "cached, so that repeated runs only compute the last block")
+    parser.add_argument('--token-cache-gb', default=100., type=float,
+                        help="Maximum size of the token cache in GiB")
+    parser.add_argument('--device', default='cuda', type=str, choices=['cuda', 'cpu'])
+    parser.add_argument('--amp', default=None, choices=['fp16', 'bf16'],
+                        help="Run the network with automatic mixed precision in the given data type. "
+                        "Use bf16 on the CPU")
+    parser.add_argument('--shards', default=1, type=int,
+                        help="Number of processes the dataset is split across. "
+                        "With cuda, shards are assigned to the visible GPUs in turn")
     parser.add_argument('--cache-dir', type=str, help="Diretory where to save cache file")
     parser.add_argument('--cache-name', type=str, help='cache pkl name to save')
     args = parser.parse_args()
@@ -0,0 +1,220 @@
+"""
+Vectorised evaluation of HOI detection
+
+The evaluator reproduces the protocol of pocket.utils.BoxPairAssociation and
+pocket.utils.DetectionAPMeter with 11-point interpolation. Instead of one
+association per class and image and one AP computation per class, the
+detected pairs of an image are matched against its ground truth for all
+classes at once, and AP of all classes is computed in a single sorted pass.
+"""
+
+import torch
+import numpy as np
+
+from torch import Tensor
+from typing import List, Tuple
+from torchvision.ops.boxes import box_iou
+
+def associate_box_pairs(
+    gt_boxes: Tuple[Tensor, Tensor], gt_classes: Tensor,
+    boxes: Tuple[Tensor, Tensor], classes: Tensor, scores: Tensor,
+    min_iou: float = 0.5
+):
+    """
+    Label detected box pairs as true positives, for all classes of an image at once
+
+    A detected pair is assigned to the ground truth pair of the same class with
+    the highest min(IoU_h, IoU_o). Each ground truth pair then accepts the highest
+    scoring detection amongst those assigned to it with an IoU of at least min_iou.
+
+    Parameters:
+    -----------
+        gt_boxes: Tuple[Tensor, Tensor]
+            Ground truth human and object boxes (G, 4)
+        gt_classes: Tensor
+            (G,) Ground truth interaction classes
+        boxes: Tuple[Tensor, Tensor]
+            Detected human and object boxes (D, 4)
+        classes: Tensor
+            (D,) Detected interaction classes
+        scores: Tensor
+            (D,) Confidence scores of the detections
+        min_iou: float
+            Minimum IoU for a detection to be a true positive
+
+    Returns:
+    --------
+        Tensor
+            (D,) Binary labels in the same type as the scores
+    """
+    labels = torch.zeros_like(scores)
+    if len(gt_classes) == 0 or len(scores) == 0:
+        return labels
+
+    iou = torch.min(
+        box_iou(gt_boxes[0].view(-1, 4), boxes[0].view(-1, 4)),
+        box_iou(gt_boxes[1].view(-1, 4), boxes[1].view(-1, 4))
+    )
+    # Detections can only be assigned to ground truth of the same class
+    iou = torch.where(gt_classes[:, None] == classes[None], iou, torch.full_like(iou, -1))
+    max_iou, max_idx = iou.max(0)
+    det_idx = torch.nonzero(max_iou >= min_iou).squeeze(1)
+    gt_idx = max_idx[det_idx]
+
+    # Group detections by ground truth with descending scores. Stable sorting
+    # keeps the lowest detection index first amongst tied scores
+    order = torch.sort(scores[det_idx], descending=True, stable=True).indices
+    det_idx = det_idx[order]; gt_idx = gt_idx[order]
+    order = torch.sort(gt_idx, stable=True).indices
+    det_idx = det_idx[order]; gt_idx = gt_idx[order]
+    first = torch.ones_like(gt_idx, dtype=torch.bool)
+    first[1:] = gt_idx[1:] != gt_idx[:-1]
+    labels[det_idx[first]] = 1
+
+    return labels
+
+def compute_ap_11p(
+    scores: np.ndarray, classes: np.ndarray, labels: np.ndarray,
+    num_gt: np.ndarray, tie_breakers: tuple = (), eps: float = 1e-8
+):
+    """
+    Compute 11-point interpolated AP of all classes in a single pass
+
+    Parameters:
+    -----------
+        scores: np.ndarray
+            (M,) Confidence scores of all detections
+        classes: np.ndarray
+            (M,) Classes of the detections
+        labels: np.ndarray
+            (M,) Binary labels of the detections
+        num_gt: np.ndarray
+            (C,) Number of ground truth instances for each class
+        tie_breakers: tuple
+            Arrays that order detections with the same class and score, least
+            significant first. Detections are otherwise kept in their given order
+        eps: float
+            Denominator used for classes without ground truth
+
+    Returns:
+    --------
+        np.ndarray
+            (C,) Average precision
+        np.ndarray
+            (C,) Maximum recall
+    """
+    num_cls = len(num_gt)
+    ap = np.zeros(num_cls, dtype=np.float64)
+    max_rec = np.zeros(num_cls, dtype=np.float64)
+    if len(scores) == 0:
+        return ap, max_rec
+
+    scores = np.asarray(scores, dtype=np.float64)
+    classes = np.asarray(classes, dtype=np.int64)
+    # Sort by class and then by descending score. The sort is stable
+    order = np.lexsort(tuple(tie_breakers) + (-scores, classes))
+    labels = np.asarray(labels, dtype=np.float64)[order]
+    classes = classes[order]
+
+    counts = np.bincount(classes, minlength=num_cls)
+    end = np.cumsum(counts)
+    start = end - counts
+    # Classes without detections start past the end of the array
+    cls = np.nonzero(counts)[0]
+    # True and false positives within each class. The counts are integers,
+    # hence cumulative sums over the whole array are exact
+    tp = np.cumsum(labels)
+    tp -= np.repeat(tp[start[cls]] - labels[start[cls]], counts[cls])
+    fp = np.arange(1, len(labels) + 1, dtype=np.float64) - np.repeat(start, counts) - tp
+
+    num_gt = np.asarray(num_gt, dtype=np.float64)
+    num_gt = np.where(num_gt == 0, eps, num_gt)
+    prec = tp / (tp + fp)
+    rec = tp / num_gt[classes]
+
+    max_rec[cls] = rec[end[cls] - 1]
+    # Recall increases within a class, so the detections with recall of at least t
+    # are the last ones of the class, starting after those with lower recall
+    thresholds = torch.linspace(0, 1, 11, dtype=torch.float64).numpy()
+    below = np.stack([
+        np.add.reduceat(rec < t, start[cls], dtype=np.int64) for t in thresholds
+    ], axis=1)
+    first = start[cls, None] + below
+    last = np.broadcast_to(end[cls, None], first.shape)
+    valid = first < last
+    # Maximum precision over [first, last) for every class and threshold
+    bounds = np.stack([first, last], axis=-1).ravel()
+    max_prec = np.maximum.reduceat(np.append(prec, 0), bounds)[::2].reshape(first.shape)
+    max_prec = np.where(valid, max_prec, 0)
+    for k in range(len(thresholds)):
+        ap[cls] += max_prec[:, k] / 11
+
+    return ap, max_rec
+
+class HOIEvaluator:
+    """
+    Accumulate detections image by image and compute mAP as
+    DetectionAPMeter(algorithm='11P') with BoxPairAssociation
+
+    Parameters:
+    -----------
+    num_gt: List[int]
+        Number of ground truth box pairs for each interaction class
+    min_iou: float
+        Minimum IoU for a detection to be a true positive
+    """
+    def __init__(self, num_gt: List[int], min_iou: float = 0.5):
+        self.num_gt = np.asarray(num_gt, dtype=np.float64)
+        self.min_iou = min_iou
+        self.reset()
+
+    def reset(self):
+        self._scores = []; self._classes = []; self._labels = []
+        self._image_idx = []; self._det_idx = []
+
+    def append(self, image_idx: int, boxes: Tuple[Tensor, Tensor],
+            classes: Tensor, scores: Tensor, target: dict):
+        """
+        Parameters:
+        -----------
+            image_idx: int
+                Index of the image in the dataset, used to order tied detections
+                as if the images had been evaluated sequentially
+            boxes: Tuple[Tensor, Tensor]
+                Detected human and object boxes (D, 4)
+            classes: Tensor
+                (D,) Detected interaction classes
+            scores: Tensor
+                (D,) Confidence scores
+            target: dict
+                Ground truth with keys `boxes_h`, `boxes_o` and `hoi`
+        """
+        labels = associate_box_pairs(
+            (target['boxes_h'], target['boxes_o']), target['hoi'],
+            boxes, classes, scores, self.min_iou
+        )
+        self.extend(image_idx, classes, scores, labels)
+
+    def extend(self, image_idx: int, classes: Tensor, scores: Tensor, labels: Tensor):
+        """Add detections of an image that have already been labelled"""
+        self._scores.append(scores.detach().cpu().numpy().astype(np.float64))
+        self._classes.append(classes.cpu().numpy().astype(np.int64))
+        self._labels.append(labels.detach().cpu().numpy().astype(np.float64))
+        self._image_idx.append(np.full(len(scores), image_idx, dtype=np.int64))
+        self._det_idx.append(np.arange(len(scores), dtype=np.int64))
+
+    def eval(self) -> Tensor:
+        """
+        Returns:
+        --------
+            Tensor
+                (C,) Average precision of each class in float64
+        """
+        if len(self._scores) == 0:
+            return torch.zeros(len(self.num_gt), dtype=torch.float64)
+        ap, self.max_rec = compute_ap_11p(
+            np.concatenate(self._scores), np.concatenate(self._classes),
+            np.concatenate(self._labels), self.num_gt,
+            tie_breakers=(np.concatenate(self._det_idx), np.concatenate(self._image_idx))
+        )
+        return torch.from_numpy(ap)
@@ -1,5 +1,6 @@
 import os
 import json
+import torch
 import numpy as np
 import cv2
 from PIL import Image
@@ -8,6 +9,116 @@ from typing import Optional, List, Callable, Tuple
 from pocket.data import ImageDataset, DataSubset
 from torch.utils.data.dataset import IterableDataset
 
+class PackedAnnotations:
+    """
+    Annotations stored as flat arrays with per-image offsets (CSR layout)
+
+    Each annotation key is stored as one array concatenated over all images,
+    along with an offset array, i.e. the values of the i-th image are rows
+    offsets[i]: offsets[i + 1]. The arrays are opened with memory mapping, so
+    dataloader workers share the pages instead of duplicating Python objects.
+
+    Arguments:
+        root(str): Directory of the packed annotations
+    """
+    KEYS = ['boxes_h', 'boxes_o', 'hoi', 'verb', 'object',
+        'human_joints', 'human_joints_score']
+
+    def __init__(self, root: str):
+        self._root = root
+        self._keys = [k for k in self.KEYS
+            if os.path.exists(os.path.join(root, k + '.npy'))]
+        self._arrays = None
+        self._len = len(np.load(os.path.join(root, 'filenames.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return self._len
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(os.path.join(self._root, name + '.npy'), mmap_mode='r')
+                for name in self._keys + [k + '_offsets' for k in self._keys]}
+        return self._arrays
+
+    def get(self, i: int, keys: Optional[List[str]] = None) -> dict:
+        """Return the annotation of the i-th image as a dict of arrays"""
+        arrays = self._open()
+        anno = dict()
+        for k in self._keys if keys is None else keys:
+            start, end = arrays[k + '_offsets'][i: i + 2]
+            # Copy the slice as targets are modified in place downstream.
+            # Empty values follow the json convention of an empty list
+            anno[k] = np.array(arrays[k][start: end]) if end > start \
+                else np.zeros(0, dtype=np.float32)
+        return anno
+
+    def __getitem__(self, i: int) -> dict:
+        return self.get(i)
+
+    @staticmethod
+    def sidecar(anno_file: str) -> str:
+        """Return the directory of packed annotations next to an annotation file"""
+        return os.path.splitext(anno_file)[0] + '_packed'
+
+    @staticmethod
+    def is_valid(root: str, anno_file: str) -> bool:
+        """Return True if the packed annotations were built from the given file"""
+        meta_path = os.path.join(root, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, 'r') as f:
+            source = json.load(f)['source']
+        stat = os.stat(anno_file)
+        return source == [stat.st_size, stat.st_mtime]
+
+    @staticmethod
+    def pack(f: dict, anno_file: str, root: str):
+        """
+        Arguments:
+            f(dict): Dictionary loaded from {anno_file}.json
+            anno_file(str): Path to the json annotation file
+            root(str): Directory where the packed annotations will be written
+
+        Files are written to a temporary directory and moved into place one by one,
+        metadata last. Processes that pack the same file at once, e.g. the ranks of
+        a distributed run, thus never truncate the arrays others have mapped
+        """
+        tmp = root + '.{}.tmp'.format(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for k in PackedAnnotations.KEYS:
+            if len(f['annotation']) == 0 or k not in f['annotation'][0]:
+                continue
+            values = [np.asarray(anno[k]) for anno in f['annotation']]
+            # Rows of empty lists have no shape, borrow it from other images
+            row_shape = next((v.shape[1:] for v in values if v.size), ())
+            dtype = np.float32 if any(v.dtype.kind == 'f' for v in values if v.size) else np.int64
+            values = [v.astype(dtype).reshape((-1,) + row_shape) for v in values]
+            offsets = np.cumsum([0] + [len(v) for v in values], dtype=np.int64)
+            np.save(os.path.join(tmp, k + '.npy'), np.concatenate(values))
+            np.save(os.path.join(tmp, k + '_offsets.npy'), offsets)
+        np.save(os.path.join(tmp, 'filenames.npy'), np.asarray(f['filenames']))
+        np.save(os.path.join(tmp, 'size.npy'), np.asarray(f['size'], dtype=np.int64))
+
+        stat = os.stat(anno_file)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as meta:
+            json.dump(dict(
+                source=[stat.st_size, stat.st_mtime],
+                correspondence=f['correspondence'],
+                empty=f['empty'], objects=f['objects'], verbs=f['verbs']
+            ), meta)
+
+        os.makedirs(root, exist_ok=True)
+        names = sorted(os.listdir(tmp), key=lambda name: name == 'meta.json')
+        for name in names:
+            os.replace(os.path.join(tmp, name), os.path.join(root, name))
+        os.rmdir(tmp)
+
+
 class HICODetSubset(DataSubset):
     def __init__(self, *args):
         super().__init__(*args)
@@ -55,14 +166,15 @@ class HICODet(ImageDataset):
             target and transforms it
         transforms (callable, optional): A function/transform that takes input sample 
             and its target as entry and returns a transformed version.
+        pose(bool): If True, include human joints in the targets
+        packed(bool): If True, load annotations from memory-mapped arrays in a sidecar
+            directory next to the annotation file, which is built on first use
     """
     def __init__(self, root: str, anno_file: str,
             transform: Optional[Callable] = None,
             target_transform: Optional[Callable] = None,
-            transforms: Optional[Callable] = None, pose=False):
+            transforms: Optional[Callable] = None, pose=False, packed=False):
         super(HICODet, self).__init__(root, transform, target_transform, transforms)
-        with open(anno_file, 'r') as f:
-            anno = json.load(f)
 
         self.num_object_cls = 80
         self.num_interaction_cls = 600
@@ -72,7 +184,13 @@ class HICODet(ImageDataset):
         self.pose=pose
 
         # Load annotations
-        self._load_annotation_and_metadata(anno)
+        if packed:
+            self._load_packed_annotation_and_metadata(anno_file)
+        else:
+            with open(anno_file, 'r') as f:
+                anno = json.load(f)
+            self._load_annotation_and_metadata(anno)
+        self._build_lookup_tables()
         
 
     def __len__(self):
@@ -94,19 +212,36 @@ class HICODet(ImageDataset):
                     "object": list[N]
         """
         intra_idx = self._idx[i]
-        target = self._anno[intra_idx].copy()
+        return self._transforms(
+            self.load_image(os.path.join(self._root, self._filenames[intra_idx])), 
+            self.get_target(i)
+            )
+
+    def get_target(self, i: int) -> dict:
+        """
+        Return the annotation of an image without loading the image
+
+        Arguments:
+            i(int): Index to an image
+
+        Returns:
+            dict: Target before the target transform is applied
+        """
+        intra_idx = self._idx[i]
+        if isinstance(self._anno, PackedAnnotations):
+            keys = PackedAnnotations.KEYS if self.pose else PackedAnnotations.KEYS[:5]
+            target = self._anno.get(intra_idx, keys)
+        else:
+            target = self._anno[intra_idx].copy()
 
         if 'image_id' in target.keys():
             target.pop('image_id')
 
-        if not self.pose:
+        if not self.pose and 'human_joints' in target.keys():
             target.pop('human_joints')
             target.pop('human_joints_score')
 
-        return self._transforms(
-            self.load_image(os.path.join(self._root, self._filenames[intra_idx])), 
-            target
-            )
+        return target
 
     def __repr__(self):
         """Return the executable string representation"""
@@ -159,6 +294,48 @@ class HICODet(ImageDataset):
             lut[j, k] = i
         return lut.tolist()
 
+    def _build_lookup_tables(self):
+        """Build the tensor lookup tables of the class correspondence once"""
+        corr = torch.as_tensor(self._class_corr, dtype=torch.int64).view(-1, 3)
+        hoi, obj, verb = corr.unbind(1)
+        self._object_n_verb_to_interaction_lut = torch.full(
+            (self.num_object_cls, self.num_action_cls), -1, dtype=torch.int64)
+        self._object_n_verb_to_interaction_lut[obj, verb] = hoi
+        self._object_to_verb_mask = torch.zeros(
+            self.num_object_cls, self.num_action_cls, dtype=torch.bool)
+        self._object_to_verb_mask[obj, verb] = True
+        self._object_to_interaction_mask = torch.zeros(
+            self.num_object_cls, self.num_interaction_cls, dtype=torch.bool)
+        self._object_to_interaction_mask[obj, hoi] = True
+
+    @property
+    def object_n_verb_to_interaction_lut(self):
+        """
+        Tensor version of object_n_verb_to_interaction, so that interaction classes
+        of many object-verb pairs are looked up with a single gather, i.e.
+        lut[objects, verbs]
+
+        Returns:
+            LongTensor[80, 117]: Interaction class index, -1 for invalid pairs
+        """
+        return self._object_n_verb_to_interaction_lut
+
+    @property
+    def object_to_verb_mask(self):
+        """
+        Returns:
+            BoolTensor[80, 117]: True where a verb is valid for an object type
+        """
+        return self._object_to_verb_mask
+
+    @property
+    def object_to_interaction_mask(self):
+        """
+        Returns:
+            BoolTensor[80, 600]: True where an interaction class involves an object type
+        """
+        return self._object_to_interaction_mask
+
     @property
     def object_to_interaction(self):
         """
@@ -268,11 +445,11 @@ class HICODet(ImageDataset):
 
     def filename(self, idx: int):
         """Return the image file name given the index"""
-        return self._filenames[self._idx[idx]]
+        return str(self._filenames[self._idx[idx]])
 
     def image_size(self, idx: int):
         """Return the size (width, height) of an image"""
-        return self._image_sizes[self._idx[idx]]
+        return [int(v) for v in self._image_sizes[self._idx[idx]]]
 
     def _load_annotation_and_metadata(self, f: dict):
         """
@@ -299,4 +476,36 @@ class HICODet(ImageDataset):
         self._class_corr = f['correspondence']
         self._empty_idx = f['empty']
         self._objects = f['objects']
-        self._verbs = f['verbs']
\ No newline at end of file
+        self._verbs = f['verbs']
+
+    def _load_packed_annotation_and_metadata(self, anno_file: str):
+        """
+        Arguments:
+            anno_file(str): Path to the json annotation file. The json file is only
+                parsed when its packed sidecar is missing or out of date
+        """
+        root = PackedAnnotations.sidecar(anno_file)
+        if not PackedAnnotations.is_valid(root, anno_file):
+            with open(anno_file, 'r') as f:
+                PackedAnnotations.pack(json.load(f), anno_file, root)
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        idx = np.setdiff1d(
+            np.arange(len(np.load(os.path.join(root, 'filenames.npy'), mmap_mode='r'))),
+            np.asarray(meta['empty'], dtype=np.int64)
+        )
+
+        self._idx = idx
+        self._num_anno = np.bincount(
+            np.load(os.path.join(root, 'hoi.npy'), mmap_mode='r'),
+            minlength=self.num_interaction_cls
+        ).tolist()
+
+        self._anno = PackedAnnotations(root)
+        self._filenames = np.load(os.path.join(root, 'filenames.npy'), mmap_mode='r')
+        self._image_sizes = np.load(os.path.join(root, 'size.npy'), mmap_mode='r')
+        self._class_corr = meta['correspondence']
+        self._empty_idx = meta['empty']
+        self._objects = meta['objects']
+        self._verbs = meta['verbs']
@@ -14,7 +14,7 @@ from pocket.ops import Flatten
 from typing import Optional, List, Tuple
 from collections import OrderedDict
 
-from ops import compute_spatial_encodings, binary_focal_loss, generate_pose_heatmap, make_pose_box, compute_spatial_encodings_with_pose, compute_spatial_encodings_with_pose_to_attention
+from ops import CollectiveTimer, compute_spatial_encodings, binary_focal_loss, generate_pose_heatmap, make_pose_box, compute_spatial_encodings_with_pose, compute_spatial_encodings_with_pose_to_attention
 from pose_models import Pose2d, BottleNeck, BasicBlock
 
 
@@ -90,6 +90,8 @@ class InteractionHead(Module):
         self.max_human = max_human
         self.max_object = max_object
         self.distributed = distributed
+        # Time waiting for the collectives of the losses
+        self.collective_timer = CollectiveTimer()
 
     def preprocess(self,
         detections: List[dict],
@@ -182,51 +184,37 @@ class InteractionHead(Module):
 
         return results
     
-    def compute_interaction_classification_loss(self, results: List[dict]):
-        scores = []; labels = []
-        for result in results:
-            scores.append(result['scores'])
-            labels.append(result['labels'])
-
-        labels = torch.cat(labels)
-        n_p = len(torch.nonzero(labels))
+    def compute_losses(self, results: List[dict]):
+        """
+        Compute the interaction classification and interactiveness losses, each
+        normalised by its number of positives averaged over all processes
+
+        Both counts are summed across processes with a single asynchronous
+        all-reduce, which overlaps with the focal losses. The counts stay on the
+        device, so that no host sync is needed.
+        """
+        scores = torch.cat([result['scores'] for result in results])
+        labels = torch.cat([result['labels'] for result in results])
+        weights = torch.cat([result['weights'] for result in results])
+        unary_labels = torch.cat([result['unary_labels'] for result in results])
+
+        n_p = torch.stack([
+            torch.count_nonzero(labels), torch.count_nonzero(unary_labels)
+        ]).float()
         if self.distributed:
-            world_size = dist.get_world_size()
-            n_p = torch.as_tensor([n_p], device='cuda')
-            dist.barrier()
-            dist.all_reduce(n_p)
-            n_p = (n_p / world_size).item()
-        loss = binary_focal_loss(
-            torch.cat(scores), labels, reduction='sum', gamma=0.2
-        )
+            work = dist.all_reduce(n_p, async_op=True)
+        hoi_loss = binary_focal_loss(scores, labels, reduction='sum', gamma=0.2)
+        interactiveness_loss = binary_focal_loss(weights, unary_labels, reduction='sum', gamma=2.0)
+        if self.distributed:
+            self.collective_timer.wait(work, n_p.device)
+            n_p = n_p / dist.get_world_size()
         ##will not happen when batch size is large enough 
-        if n_p == 0:
-            n_p = 1
+        n_p = torch.where(n_p == 0, torch.ones_like(n_p), n_p)
 
-        return loss / n_p
-        
-    def compute_interactiveness_loss(self, results: List[dict]):
-        weights = []; labels = []
-        for result in results:
-            weights.append(result['weights'])
-            labels.append(result['unary_labels'])
-
-        weights = torch.cat(weights)
-        labels = torch.cat(labels)
-        n_p = len(torch.nonzero(labels))
-        if self.distributed:
-            world_size = dist.get_world_size()
-            n_p = torch.as_tensor([n_p], device='cuda')
-            dist.barrier()
-            dist.all_reduce(n_p)
-            n_p = (n_p / world_size).item()
-        loss = binary_focal_loss(
-            weights, labels, reduction='sum', gamma=2.0
+        return dict(
+            hoi_loss=hoi_loss / n_p[0],
+            interactiveness_loss=interactiveness_loss / n_p[1]
         )
-        ##will not happen when batch size is large enough 
-        if n_p == 0:
-            n_p = 1
-        return loss / n_p
 
     def postprocess(self,
         logits_p: Tensor,
@@ -283,8 +271,9 @@ class InteractionHead(Module):
                 Labels for the unary weights
         """
         num_boxes = [len(b) for b in boxes_h]
-        weights = torch.sigmoid(logits_s).squeeze(1)
-        scores = torch.sigmoid(logits_p)
+        # Scores are ranked in evaluation, so keep them in fp32 under autocast
+        weights = torch.sigmoid(logits_s.float()).squeeze(1)
+        scores = torch.sigmoid(logits_p.float())
         weights = weights.split(num_boxes)
         scores = scores.split(num_boxes)
                     
@@ -314,12 +303,26 @@ class InteractionHead(Module):
 
         return results
         
+    def encode_image(self, images, box_coords, tokens=None, need_patch=False, need_tokens=False):
+        """
+        Encode boxes with the backbone, running only its last block if the
+        tokens entering it are given
+        """
+        if tokens is None:
+            return self.backbone.encode_image(images, box_coords, None,
+                need_patch=need_patch, need_tokens=need_tokens)
+        outputs = self.backbone.encode_image_from_tokens(tokens, box_coords, need_patch=need_patch)
+        if need_tokens:
+            outputs += (tokens,)
+        return outputs
+
     def forward(self,
         features: OrderedDict,
         detections: List[dict],
         image_shapes: List[Tuple[int, int]],
         targets: Optional[List[dict]] = None,
-        images=None
+        images=None,
+        tokens=None
     ):
         """
         Parameters:
@@ -353,6 +356,9 @@ class InteractionHead(Module):
                 Loss for HOI classification
             `interactiveness_loss`: Tensor
                 Loss incurred on learned unary weights
+        tokens: Tensor, optional
+            (L, B, C) Backbone tokens entering its last block, e.g. from a token cache.
+            If given, only the last block is run
         """
         if self.training:
             assert targets is not None, "Targets should be passed during training"
@@ -370,7 +376,38 @@ class InteractionHead(Module):
         else:
             pose_heatmaps = [None for _ in detections]
             human_joints = [None for _ in detections]
+            human_joints_score = [None for _ in detections]
+
+        box_features, pose_box_features, pose_box_coords, tokens = self.encode_boxes(
+            features, image_shapes, box_coords, box_labels, human_joints, images, tokens)
+
+        return self.forward_features(
+            features, image_shapes, box_features, pose_box_features,
+            box_coords, box_labels, box_scores, pose_heatmaps, human_joints, human_joints_score,
+            targets, images, pose_box_coords, tokens
+        )
+
+    def encode_boxes(self,
+        features: OrderedDict, image_shapes: List[Tuple[int, int]],
+        box_coords: List[Tensor], box_labels: List[Tensor], human_joints: List[Tensor],
+        images=None, tokens=None
+    ):
+        """
+        Compute the features of the boxes kept by preprocess and of the pose boxes of
+        their humans. The global features of CLIP_CLS are added to features
 
+        Returns:
+        --------
+        box_features: Tensor
+            (N, C) Class tokens masked by each box, or pooled box features
+        pose_box_features: Tensor or None
+            (17H, C, P, P) Pooled pose box features, with local_pose but not pose_cls
+        pose_box_coords: List[Tensor] or None
+            (17H, 4) Pose boxes of each image, with local_pose
+        tokens: Tensor or None
+            (L, B, C) Tokens entering the last block of the backbone, with pose_cls
+        """
+        pose_box_coords = None
         if self.backbone_name == "resnet50" or self.backbone_name=="CLIP" or self.backbone_name == "GLIP":
             box_features = self.box_roi_pool(features, box_coords, image_shapes)
             pose_box_features = None
@@ -379,33 +416,56 @@ class InteractionHead(Module):
             if self.pose:
                 if self.local_pose:
                     if self.pose_cls:
-                        box_features, global_features = self.backbone.encode_image(images, box_coords, box_segs, need_patch=False)
+                        # Keep the tokens entering the last block of the backbone, so
+                        # that pose boxes are pooled without running it again
+                        box_features, global_features, tokens = self.encode_image(images, box_coords, tokens, need_tokens=True)
                         features['global'] = global_features
-                        image_hw = images.shape[2:]
+                        image_hw = image_shapes[0]
                         pose_box_coords = make_pose_box(box_coords, box_labels, human_joints, self.human_idx, image_hw)
                         pose_box_features = None
                     else:
-                        box_features, global_features, patch_features = self.backbone.encode_image(images, box_coords, box_segs, need_patch=True)
+                        box_features, global_features, patch_features = self.encode_image(images, box_coords, tokens, need_patch=True)
                         features['global'] = global_features
                         B, L, C = patch_features.shape
                         features['0'] = patch_features.permute(0,2,1).reshape(B, C, int(L**0.5), int(L**0.5)).to(dtype=torch.float32)
-                        image_hw = images.shape[2:]
+                        image_hw = image_shapes[0]
                         pose_box_coords = make_pose_box(box_coords, box_labels, human_joints, self.human_idx, image_hw)
                         pose_box_features = self.box_roi_pool(features, pose_box_coords, image_shapes)
                 else:
-                    box_features, global_features = self.backbone.encode_image(images, box_coords, box_segs, need_patch=False)
+                    box_features, global_features = self.encode_image(images, box_coords, tokens)
                     features['global'] = global_features
                     pose_box_features = None
             else:
-                box_features, global_features = self.backbone.encode_image(images, box_coords, box_segs, need_patch=False)
+                box_features, global_features = self.encode_image(images, box_coords, tokens)
                 features['global'] = global_features
                 pose_box_features = None
-        
+        return box_features, pose_box_features, pose_box_coords, tokens
+
+    def forward_features(self,
+        features: OrderedDict, image_shapes: List[Tuple[int, int]],
+        box_features: Tensor, pose_box_features: Optional[Tensor],
+        box_coords: List[Tensor], box_labels: List[Tensor], box_scores: List[Tensor],
+        pose_heatmaps: List[Tensor], human_joints: List[Tensor], human_joints_score: List[Tensor],
+        targets: Optional[List[dict]] = None, images=None, pose_box_coords=None, tokens=None
+    ):
+        """
+        Run the graph head and the predictors on the backbone features of the boxes
+        kept by preprocess, the second half of forward. Called on its own to train the
+        head from precomputed features, see train_head.py. With pose_cls, the pose box
+        features are pooled by the last block of the backbone from the tokens entering
+        it, or from the images if tokens are not given
+
+        Returns:
+        --------
+        results: List[dict]
+            As for forward
+        """
         if self.pose_cls:
             box_pair_features, box_pair_local_features, boxes_h, boxes_o, object_class,\
             box_pair_labels, box_pair_prior = self.box_pair_head(
                 features, image_shapes, box_features, pose_box_features,
-                box_coords, box_labels, box_scores, pose_heatmaps, human_joints, human_joints_score, targets, backbone=self.backbone, images=images, pose_box_coords=pose_box_coords
+                box_coords, box_labels, box_scores, pose_heatmaps, human_joints, human_joints_score, targets, backbone=self.backbone, images=images, pose_box_coords=pose_box_coords,
+                tokens=tokens
             )
         else:
             box_pair_features, box_pair_local_features, boxes_h, boxes_o, object_class,\
@@ -431,10 +491,7 @@ class InteractionHead(Module):
         )
 
         if self.training:
-            loss_dict = dict(
-            hoi_loss=self.compute_interaction_classification_loss(results),
-            interactiveness_loss=self.compute_interactiveness_loss(results)
-        )
+            loss_dict = self.compute_losses(results)
             results.append(loss_dict)
 
         return results
@@ -477,12 +534,62 @@ class MultiBranchFusion(Module):
             nn.Linear(sub_repr_size, representation_size)
             for _ in range(cardinality)
         ])
+    def project_appearance(self, appearance: Tensor, offset: int = 0, bias: bool = True):
+        """
+        Apply fc_1 of all branches at once to the appearance features, or to a
+        part of them
+
+        The appearance features of a box pair are often the concatenation of the
+        features of its nodes. As fc_1 is linear, each part can be projected once
+        per node, and the projections of a pair summed before the nonlinearity.
+        The result is passed to forward_projected
+
+        Parameters:
+        -----------
+            appearance: Tensor
+                (..., D) Features that make up dimensions [offset, offset + D) of
+                the appearance features
+            offset: int
+                Position of the features amongst the appearance features
+            bias: bool
+                Whether to add the bias of fc_1. It should be added to one part only
+
+        Returns:
+        --------
+            Tensor
+                (..., R) Projected features of all branches, concatenated
+        """
+        weight = torch.cat([
+            fc.weight[:, offset: offset + appearance.shape[-1]] for fc in self.fc_1
+        ])
+        return F.linear(appearance, weight,
+            torch.cat([fc.bias for fc in self.fc_1]) if bias else None)
+
+    def _fuse(self, appearance: Tensor, spatial: Tensor):
+        # The branches stay as separate linear layers, hence checkpoints load
+        # unchanged. Since the outputs of fc_3 are summed over branches, they are
+        # equivalent to one linear layer over the concatenated inputs, with the
+        # weights concatenated along the input dimension and the biases summed
+        return F.linear(F.relu(appearance * F.linear(spatial,
+            torch.cat([fc.weight for fc in self.fc_2]),
+            torch.cat([fc.bias for fc in self.fc_2])
+        )), torch.cat([fc.weight for fc in self.fc_3], 1),
+            torch.stack([fc.bias for fc in self.fc_3]).sum(0))
+
+    def forward_projected(self, appearance: Tensor, spatial: Tensor):
+        """
+        Parameters:
+        -----------
+            appearance: Tensor
+                Appearance features projected by project_appearance, broadcastable
+                to the projected spatial features
+            spatial: Tensor
+                Spatial features
+        """
+        return F.relu(self._fuse(appearance, spatial))
+
     def forward(self, appearance: Tensor, spatial: Tensor):
-        return F.relu(torch.stack([
-            fc_3(F.relu(fc_1(appearance) * fc_2(spatial)))
-            for fc_1, fc_2, fc_3
-            in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0))
+        return self.forward_projected(self.project_appearance(appearance), spatial)
 
 class MessageMBF(MultiBranchFusion):
     """
@@ -519,37 +626,46 @@ class MessageMBF(MultiBranchFusion):
         else:
             raise ValueError("Unknown node type \"{}\"".format(node_type))
 
+    def forward_pairs(self, appearance: Tensor, spatial: Tensor):
+        """
+        Compute the messages of a flat list of box pairs
+
+        Parameters:
+        -----------
+            appearance: Tensor
+                (M, R) Appearance features of the sending node of each pair, projected
+                by project_appearance
+            spatial: Tensor
+                (M, D) Spatial features of each pair
+        """
+        return self._fuse(appearance, spatial)
+
+    # The methods below index dimensions from the end, so that the features may
+    # have a leading batch dimension, with spatial features of shape (B, n_h, n, D)
     def _forward_human_nodes(self, appearance: Tensor, spatial: Tensor):
-        n_h, n = spatial.shape[:2]
-        assert len(appearance) == n_h, "Incorrect size of dim0 for appearance features"
-        return torch.stack([
-            fc_3(F.relu(
-                fc_1(appearance).repeat(n, 1, 1)
-                * fc_2(spatial).permute([1, 0, 2])
-            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0)
+        n_h, n = spatial.shape[-3:-1]
+        assert appearance.shape[-2] == n_h, "Incorrect size of dim0 for appearance features"
+        # Broadcast the projected appearance instead of repeating it for each pair,
+        # and permute the output rather than the much wider intermediate features
+        return self._fuse(
+            self.project_appearance(appearance).unsqueeze(-2), spatial
+        ).transpose(-3, -2)
     def _forward_object_nodes(self, appearance: Tensor, spatial: Tensor):
-        n_h, n = spatial.shape[:2]
-        assert len(appearance) == n, "Incorrect size of dim0 for appearance features"
-        return torch.stack([
-            fc_3(F.relu(
-                fc_1(appearance).repeat(n_h, 1, 1)
-                * fc_2(spatial)
-            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0)
+        n_h, n = spatial.shape[-3:-1]
+        assert appearance.shape[-2] == n, "Incorrect size of dim0 for appearance features"
+        return self._fuse(self.project_appearance(appearance).unsqueeze(-3), spatial)
     def _forward_object_local_pose_nodes(self, local_feature: Tensor, appearance: Tensor, spatial: Tensor):
-        n_h, n = spatial.shape[:2]
-        assert local_feature.shape[0] == n_h
-        assert local_feature.shape[1] == n
-        assert len(appearance) == n, "Incorrect size of dim0 for appearance features"
-        #print("doing local pose")
-        concat_appearance = torch.cat([local_feature, appearance.repeat(n_h, 1, 1)], dim=2)
-        return torch.stack([
-            fc_3(F.relu(
-                fc_1(concat_appearance)
-                * fc_2(spatial)
-            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0)
+        n_h, n = spatial.shape[-3:-1]
+        assert local_feature.shape[-3] == n_h
+        assert local_feature.shape[-2] == n
+        assert appearance.shape[-2] == n, "Incorrect size of dim0 for appearance features"
+        # Project the local features of each pair and the appearance features of
+        # each object node separately, instead of their concatenation per pair
+        return self._fuse(
+            self.project_appearance(local_feature)
+            + self.project_appearance(appearance, local_feature.shape[-1], bias=False).unsqueeze(-3),
+            spatial
+        )
 
     # def _forward_object_local_pose_nodes(self, local_feature: Tensor, spatial: Tensor):
     #     n_h, n = spatial.shape[:2]
@@ -589,6 +705,9 @@ class GraphHead(Module):
         The IoU threshold to identify a positive example
     num_iter: int, default 2
         Number of iterations of the message passing process
+    batched: bool, default True
+        If True, run message passing for all images of a batch at once, with the
+        graphs padded to the same size. Otherwise, run it one image at a time
     """
     def __init__(self,
         verb_list,
@@ -607,6 +726,7 @@ class GraphHead(Module):
         pose: bool = False,
         local_pose: bool = False,
         pose_cls: bool = False,
+        batched: bool = True,
     ):
 
         super().__init__()
@@ -627,6 +747,7 @@ class GraphHead(Module):
         self.pose = pose
         self.local_pose = local_pose
         self.pose_cls = pose_cls
+        self.batched = batched
 
         # Box head to map RoI features to low dimensional
         if self.backbone_name == "CLIP_CLS":
@@ -795,11 +916,49 @@ class GraphHead(Module):
 
         return torch.stack([prior_h, prior_o])
     
+    def encode_pose_boxes(self,
+        backbone: Module, b_idx: int, pose_attention_weight: Tensor,
+        images: Optional[Tensor] = None, tokens: Optional[Tensor] = None,
+        pose_box_coords: Optional[List[Tensor]] = None
+    ):
+        """
+        Pool the pose box features of an image, with the masks of the 17 pose boxes
+        of each human weighted for each box pair
+
+        Parameters:
+        -----------
+            backbone: Module
+                CLIP model
+            b_idx: int
+                Index of the image in the batch
+            pose_attention_weight: Tensor
+                (M, 17) Weights of the joints for each box pair of the image
+            images: Tensor
+                (B, 3, H, W) Images, encoded again when tokens are not given
+            tokens: Tensor
+                (L, B, C) Tokens entering the last block of the backbone. Only the
+                last block uses the masks, hence it is the only one to run
+            pose_box_coords: List[Tensor]
+                Pose boxes of each image
+
+        Returns:
+        --------
+            Tensor
+                (M, C) Pooled features
+        """
+        pose_boxes = [pose_box_coords[b_idx].reshape(-1, 17, 4)]
+        if tokens is not None:
+            return backbone.encode_image_from_tokens(
+                tokens[:, b_idx: b_idx + 1], pose_boxes, pose_attention_weight)[0]
+        return backbone.encode_image(images[b_idx].unsqueeze(0), pose_boxes, None,
+            pose_attention_weight, need_patch=False)[0]
+
     def forward(self,
         features: OrderedDict, image_shapes: List[Tuple[int, int]],
         box_features: Tensor, pose_box_features: Tensor, box_coords: List[Tensor], 
         box_labels: List[Tensor], box_scores: List[Tensor], pose_heatmaps : List[Tensor], human_joints: List[Tensor], human_joints_score: List[Tensor],
         targets: Optional[List[dict]] = None, backbone = None, images = None, pose_box_coords = None, 
+        tokens = None
     ):
         """
         Parameters:
@@ -821,6 +980,9 @@ class GraphHead(Module):
                 `boxes_h`: Tensor[G, 4]
                 `boxes_o`: Tensor[G, 4]
                 `labels`: Tensor[G]
+            tokens: Tensor
+                (L, B, C) Tokens entering the last block of the backbone. If given,
+                pose box features are pooled from them instead of the images
 
         Returns:
         --------
@@ -848,6 +1010,12 @@ class GraphHead(Module):
         if self.local_pose and not self.pose_cls:
             pose_box_features = self.pose_head(pose_box_features)
             pose_box_features = pose_box_features.reshape(-1, 17, pose_box_features.shape[-1])
+        if self.batched:
+            return self._forward_batched(
+                global_features, image_shapes, box_features, pose_box_features,
+                box_coords, box_labels, box_scores, human_joints, human_joints_score,
+                targets, backbone, images, pose_box_coords, tokens
+            )
         num_boxes = [len(boxes_per_image) for boxes_per_image in box_coords]
         
         counter = 0
@@ -882,7 +1050,12 @@ class GraphHead(Module):
                 all_boxes_o.append(torch.zeros(0, 4, device=device))
                 all_object_class.append(torch.zeros(0, device=device, dtype=torch.int64))
                 all_prior.append(torch.zeros(2, 0, self.num_cls, device=device))
-                all_labels.append(torch.zeros(0, self.num_cls, device=device))
+                # Labels are only computed against targets, as for the other images
+                if targets is not None:
+                    all_labels.append(torch.zeros(0, self.num_cls, device=device))
+                # The features of the skipped boxes are still in the batch
+                counter += n
+                counter_h += n_h
                 continue
             if not torch.all(labels[:n_h]==self.human_idx):
                 raise ValueError("Human detections are not permuted to the top")
@@ -929,7 +1102,7 @@ class GraphHead(Module):
                     pose_attention = torch.matmul(box_pair_spatial_semantic.unsqueeze(1), pose_key_mat.permute(0,2,1)).squeeze(1) * human_joint_score.repeat_interleave(n, dim=0)
                     pose_attention_weight = pose_attention.softmax(dim=-1)
                     if self.pose_cls:
-                        pose_local_feature, _ = backbone.encode_image(images[b_idx].unsqueeze(0), [pose_box_coords[b_idx].reshape(-1, 17, 4)], None, pose_attention_weight, need_patch=False)
+                        pose_local_feature = self.encode_pose_boxes(backbone, b_idx, pose_attention_weight, images, tokens, pose_box_coords)
                         pose_local_feature = self.box_head(pose_local_feature)
                     else:
                         pose_box_feature = pose_box_feature.repeat_interleave(n, dim=0)
@@ -942,15 +1115,17 @@ class GraphHead(Module):
             box_pair_spatial_semantic_reshaped = box_pair_spatial_semantic.reshape(n_h, n, -1)
             adjacency_matrix = torch.ones(n_h, n, device=device)
             for _ in range(self.num_iter):
-                # Compute weights of each edge
-                weights = self.attention_head(
-                    torch.cat([
-                        h_node_encodings[x],
-                        node_encodings[y]
-                    ], 1),
-                    box_pair_spatial_semantic
+                # Compute weights of each edge. The appearance features of a pair
+                # are the concatenated encodings of its nodes, so they are
+                # projected once per node and summed for each pair
+                weights = self.attention_head.forward_projected(
+                    self.attention_head.project_appearance(h_node_encodings)[:, None]
+                    + self.attention_head.project_appearance(
+                        node_encodings, h_node_encodings.shape[1], bias=False)[None],
+                    box_pair_spatial_semantic_reshaped
                 )
-                adjacency_matrix = self.adjacency(weights).reshape(n_h, n)
+                # The adjacency and its softmax stay in fp32 under autocast
+                adjacency_matrix = self.adjacency(weights).reshape(n_h, n).float()
 
                 # update local human nodes
 
@@ -995,16 +1170,17 @@ class GraphHead(Module):
                     coords[x_keep], coords[y_keep], targets[b_idx])
                 )
 
+            box_pair_spatial_kept = box_pair_spatial_semantic_reshaped[x_keep, y_keep]
             all_box_pair_features.append(torch.cat([
-                    self.attention_head(
-                        torch.cat([
-                            h_node_encodings[x_keep],
-                            node_encodings[y_keep]
-                            ], 1),
-                        box_pair_spatial_semantic_reshaped[x_keep, y_keep]
-                    ), self.attention_head_g(
-                        global_features[b_idx, None],
-                        box_pair_spatial_semantic_reshaped[x_keep, y_keep])
+                    self.attention_head.forward_projected(
+                        self.attention_head.project_appearance(h_node_encodings)[x_keep]
+                        + self.attention_head.project_appearance(
+                            node_encodings, h_node_encodings.shape[1], bias=False)[y_keep],
+                        box_pair_spatial_kept
+                    ), self.attention_head_g.forward_projected(
+                        # Projected once per image and broadcast to the pairs
+                        self.attention_head_g.project_appearance(global_features[b_idx, None]),
+                        box_pair_spatial_kept)
                 ], dim=1))
             #if self.local_pose:
             #   all_box_pair_local_features.append(pose_local_feature_reshaped[x_keep, y_keep])
@@ -1020,3 +1196,230 @@ class GraphHead(Module):
 
         return all_box_pair_features, all_box_pair_local_features, all_boxes_h, all_boxes_o, \
            all_object_class, all_labels, all_prior
+
+    def _forward_batched(self,
+        global_features: Tensor, image_shapes: List[Tuple[int, int]],
+        box_features: Tensor, pose_box_features: Tensor, box_coords: List[Tensor],
+        box_labels: List[Tensor], box_scores: List[Tensor], human_joints: List[Tensor],
+        human_joints_score: List[Tensor], targets: Optional[List[dict]] = None,
+        backbone = None, images = None, pose_box_coords = None, tokens = None
+    ):
+        """
+        Same as the per-image loop in forward, with message passing run for all
+        images at once. Arguments are as for forward, with global features and box
+        features already computed
+        """
+        device = box_features.device
+        num_boxes = [len(boxes_per_image) for boxes_per_image in box_coords]
+        num_human = [torch.sum(labels == self.human_idx).item() for labels in box_labels]
+        # Skip images when there are no detected human or object instances
+        # and when there is only one detected instance
+        valid = [b_idx for b_idx, (n_h, n) in enumerate(zip(num_human, num_boxes))
+            if n_h > 0 and n > 1]
+        for b_idx in valid:
+            if not torch.all(box_labels[b_idx][:num_human[b_idx]] == self.human_idx):
+                raise ValueError("Human detections are not permuted to the top")
+        if self.pose:
+            for b_idx in valid:
+                assert human_joints[b_idx].shape[0] == num_human[b_idx]
+
+        if len(valid):
+            box_pair_features, pair_idx = self._run_graphs(
+                valid, global_features, image_shapes, box_features, pose_box_features,
+                box_coords, num_human, num_boxes, human_joints, human_joints_score,
+                backbone, images, pose_box_coords, tokens
+            )
+
+        all_boxes_h = []; all_boxes_o = []; all_object_class = []
+        all_labels = []; all_prior = []
+        all_box_pair_features = []
+        all_box_pair_local_features = []
+        for b_idx, (coords, labels, scores) in enumerate(zip(box_coords, box_labels, box_scores)):
+            if b_idx not in valid:
+                if self.training:
+                    print("not enough detection!!!")
+                if self.local_pose:
+                    all_box_pair_local_features.append(torch.zeros(
+                        0, 1 * self.representation_size,
+                        device=device)
+                    )
+                all_box_pair_features.append(torch.zeros(
+                    0, 2 * self.representation_size,
+                    device=device)
+                )
+                all_boxes_h.append(torch.zeros(0, 4, device=device))
+                all_boxes_o.append(torch.zeros(0, 4, device=device))
+                all_object_class.append(torch.zeros(0, device=device, dtype=torch.int64))
+                all_prior.append(torch.zeros(2, 0, self.num_cls, device=device))
+                # Labels are only computed against targets, as for the other images
+                if targets is not None:
+                    all_labels.append(torch.zeros(0, self.num_cls, device=device))
+                continue
+
+            x_keep, y_keep = pair_idx[valid.index(b_idx)]
+            if targets is not None:
+                all_labels.append(self.associate_with_ground_truth(
+                    coords[x_keep], coords[y_keep], targets[b_idx])
+                )
+            all_box_pair_features.append(box_pair_features[valid.index(b_idx)])
+            all_boxes_h.append(coords[x_keep])
+            all_boxes_o.append(coords[y_keep])
+            all_object_class.append(labels[y_keep])
+            all_prior.append(self.compute_prior_scores(
+                x_keep, y_keep, scores, labels)
+            )
+
+        return all_box_pair_features, all_box_pair_local_features, all_boxes_h, all_boxes_o, \
+           all_object_class, all_labels, all_prior
+
+    def _run_graphs(self,
+        valid: List[int], global_features: Tensor, image_shapes: List[Tuple[int, int]],
+        box_features: Tensor, pose_box_features: Tensor, box_coords: List[Tensor],
+        num_human: List[int], num_boxes: List[int], human_joints: List[Tensor],
+        human_joints_score: List[Tensor], backbone = None, images = None,
+        pose_box_coords = None, tokens = None
+    ):
+        """
+        Run message passing on the graphs of the given images at once
+
+        Features of box pairs are computed for the pairs of all images, stacked.
+        Node encodings and adjacency matrices are padded to the largest numbers of
+        human and object nodes in the batch. Padded edges have zero weight in the
+        adjacency softmax, hence do not alter the messages to the other nodes
+
+        Returns:
+        --------
+            box_pair_features: List[Tensor]
+                Features of the box pairs of each image, excluding pairs of a human
+                instance with itself
+            pair_idx: List[Tuple[Tensor, Tensor]]
+                Indices of the human and object boxes of the kept pairs
+        """
+        device = box_features.device
+        n_h = torch.as_tensor([num_human[b_idx] for b_idx in valid], device=device)
+        n = torch.as_tensor([num_boxes[b_idx] for b_idx in valid], device=device)
+        max_h = max(num_human[b_idx] for b_idx in valid)
+        max_n = max(num_boxes[b_idx] for b_idx in valid)
+        # Offsets into the box features of all images, including the skipped ones
+        box_offset = torch.cumsum(torch.as_tensor(num_boxes, device=device), 0)
+        box_offset = (box_offset - torch.as_tensor(num_boxes, device=device))[valid]
+        human_offset = torch.cumsum(torch.as_tensor(num_human, device=device), 0)
+        human_offset = (human_offset - torch.as_tensor(num_human, device=device))[valid]
+
+        node_mask = torch.arange(max_n, device=device)[None] < n[:, None]
+        human_mask = torch.arange(max_h, device=device)[None] < n_h[:, None]
+        pair_mask = human_mask[:, :, None] & node_mask[:, None]
+        # Pairs of all images, ordered by image and then as the meshgrid of each image
+        b, x, y = torch.nonzero(pair_mask).unbind(1)
+        pairs_per_image = (n_h * n).tolist()
+
+        node_encodings = box_features.new_zeros(len(valid), max_n, box_features.shape[-1])
+        node_b, node_idx = torch.nonzero(node_mask).unbind(1)
+        node_encodings[node_mask] = box_features[box_offset[node_b] + node_idx]
+        # Duplicate human nodes
+        h_node_encodings = node_encodings[:, :max_h]
+
+        # Compute spatial features
+        coords = torch.cat(box_coords)
+        shapes = [image_shapes[b_idx] for b_idx in valid]
+        boxes_1 = coords[box_offset[b] + x].split(pairs_per_image)
+        boxes_2 = coords[box_offset[b] + y].split(pairs_per_image)
+        if self.pose:
+            joints = torch.cat(human_joints)
+            joint_scores = torch.cat(human_joints_score)
+            spatial_query, pose_key = compute_spatial_encodings_with_pose_to_attention(
+                boxes_1, boxes_2, joints[human_offset[b] + x].split(pairs_per_image), shapes
+            )
+            box_pair_spatial_semantic = self.spatial_head(spatial_query)
+            pose_key_mat = self.joint_head(pose_key)
+        else:
+            box_pair_spatial_semantic = self.spatial_head(
+                compute_spatial_encodings(boxes_1, boxes_2, shapes)
+            )
+
+        if self.pose and self.local_pose:
+            pose_attention = torch.matmul(
+                box_pair_spatial_semantic.unsqueeze(1), pose_key_mat.permute(0, 2, 1)
+            ).squeeze(1) * joint_scores[human_offset[b] + x]
+            pose_attention_weight = pose_attention.softmax(dim=-1)
+            if self.pose_cls:
+                # The masks of the pose boxes are computed one image at a time
+                pose_local_feature = self.box_head(torch.cat([
+                    self.encode_pose_boxes(backbone, b_idx, weights, images, tokens, pose_box_coords)
+                    for b_idx, weights in zip(valid, pose_attention_weight.split(pairs_per_image))
+                ]))
+            else:
+                pose_local_feature = torch.sum(
+                    pose_box_features[human_offset[b] + x]
+                    * pose_attention_weight.unsqueeze(-1), dim=1
+                )
+
+        # The adjacency and its softmax stay in fp32 under autocast
+        min_value = torch.finfo(torch.float32).min
+        for _ in range(self.num_iter):
+            # Compute weights of each edge
+            weights = self.attention_head.forward_projected(
+                self.attention_head.project_appearance(h_node_encodings)[b, x]
+                + self.attention_head.project_appearance(
+                    node_encodings, h_node_encodings.shape[-1], bias=False)[b, y],
+                box_pair_spatial_semantic
+            )
+            # Padded edges are excluded from the softmax
+            adjacency_matrix = torch.full(pair_mask.shape, min_value,
+                dtype=torch.float32, device=device
+            ).index_put((b, x, y), self.adjacency(weights).squeeze(1).float())
+
+            # Update human nodes
+            if self.local_pose:
+                messages = self.obj_to_sub.forward_pairs(
+                    self.obj_to_sub.project_appearance(pose_local_feature)
+                    + self.obj_to_sub.project_appearance(
+                        node_encodings, pose_local_feature.shape[-1], bias=False)[b, y],
+                    box_pair_spatial_semantic
+                )
+            else:
+                messages = self.obj_to_sub.forward_pairs(
+                    self.obj_to_sub.project_appearance(node_encodings)[b, y],
+                    box_pair_spatial_semantic
+                )
+            messages = adjacency_matrix.softmax(dim=2)[b, x, y, None] * messages
+            messages_to_h = F.relu(torch.sum(messages.new_zeros(
+                *pair_mask.shape, messages.shape[-1]
+            ).index_put((b, x, y), messages), dim=2))
+            h_node_encodings = self.norm_h(
+                h_node_encodings + messages_to_h
+            )
+
+            # Update object nodes (including human nodes)
+            messages = self.sub_to_obj.forward_pairs(
+                self.sub_to_obj.project_appearance(h_node_encodings)[b, x],
+                box_pair_spatial_semantic
+            )
+            messages = adjacency_matrix.softmax(dim=1)[b, x, y, None] * messages
+            messages_to_o = F.relu(torch.sum(messages.new_zeros(
+                *pair_mask.shape, messages.shape[-1]
+            ).index_put((b, x, y), messages), dim=1))
+            node_encodings = self.norm_o(
+                node_encodings + messages_to_o
+            )
+
+        # Remove pairs consisting of the same human instance
+        keep = torch.nonzero(x != y).squeeze(1)
+        b, x, y = b[keep], x[keep], y[keep]
+        box_pair_spatial_kept = box_pair_spatial_semantic[keep]
+        box_pair_features = torch.cat([
+            self.attention_head.forward_projected(
+                self.attention_head.project_appearance(h_node_encodings)[b, x]
+                + self.attention_head.project_appearance(
+                    node_encodings, h_node_encodings.shape[-1], bias=False)[b, y],
+                box_pair_spatial_kept
+            ), self.attention_head_g.forward_projected(
+                # Projected once per image and broadcast to the pairs
+                self.attention_head_g.project_appearance(global_features[valid])[b],
+                box_pair_spatial_kept)
+        ], dim=1)
+
+        kept_per_image = (n_h * (n - 1)).tolist()
+        return box_pair_features.split(kept_per_image), list(zip(
+            x.split(kept_per_image), y.split(kept_per_image)
+        ))
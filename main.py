@@ -16,7 +16,9 @@ from pocket.data import HICODet
 from fvcore.nn import FlopCountAnalysis
 
 from models import SpatiallyConditionedGraph as SCG
-from utils import custom_collate, CustomisedDLE, DataFactory
+from utils import custom_collate, CustomisedDLE, DataFactory, BalancedDistributedSampler, pair_costs, \
+    AMP_DTYPES, cache_frozen_tokens
+from store import TokenCache
 
 def main(rank, args):
 
@@ -31,23 +33,33 @@ def main(rank, args):
         name=args.dataset, partition=args.partitions[0],
         data_root=args.data_root,
         detection_root=args.train_detection_dir,
-        flip=True, color_jitter=False, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose
+        flip=True, color_jitter=False, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose,
+        packed_anno=args.packed_anno, preprocess=args.worker_preprocess, warp=args.warp
     )
 
     valset = DataFactory(
         name=args.dataset, partition=args.partitions[1],
         data_root=args.data_root,
-        detection_root=args.val_detection_dir, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose
+        detection_root=args.val_detection_dir, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose,
+        packed_anno=args.packed_anno, preprocess=args.worker_preprocess, warp=args.warp
     )
 
+    if args.balanced_sampler:
+        # Ground truth pairs are appended to the detections in training
+        costs = pair_costs(trainset.box_counts(args.box_score_thresh, append_gt=True),
+            args.max_human, args.max_object)
+        train_sampler = BalancedDistributedSampler(costs, args.batch_size,
+            args.world_size, rank, seed=args.random_seed)
+    else:
+        train_sampler = DistributedSampler(
+            trainset, 
+            num_replicas=args.world_size, 
+            rank=rank, seed=args.random_seed)
     train_loader = DataLoader(
         dataset=trainset,
         collate_fn=custom_collate, batch_size=args.batch_size,
         num_workers=args.num_workers, pin_memory=True,
-        sampler=DistributedSampler(
-            trainset, 
-            num_replicas=args.world_size, 
-            rank=rank, seed=args.random_seed)
+        sampler=train_sampler
     )
 
     val_loader = DataLoader(
@@ -92,6 +104,11 @@ def main(rank, args):
         box_score_thresh=args.box_score_thresh,
         distributed=True, rank=rank, patch_size=args.patch_size, pose=args.pose, warp=args.warp, local_pose=args.local_pose, pose_cls=args.pose_cls
     )
+    if args.checkpoint_blocks:
+        assert args.backbone_name != 'resnet50', \
+            "Activation checkpointing is only supported for the ViT backbones"
+        net.backbone.visual.transformer.checkpoint_blocks = args.checkpoint_blocks
+        net.backbone.visual.transformer.checkpoint_group = args.checkpoint_group
 
 
 
@@ -110,6 +127,30 @@ def main(rank, args):
         sched_state_dict = None
         epoch = 0; iteration = 0
 
+    if args.frozen_blocks:
+        assert args.dataset == 'hicodet' and args.backbone_name == 'CLIP_CLS' \
+            and args.worker_preprocess, \
+            "Frozen blocks are only supported on HICO-DET for CLIP_CLS with --worker-preprocess"
+        assert args.token_store is not None, "Frozen blocks need a --token-store"
+        visual = net.backbone.visual
+        for name, p in visual.named_parameters():
+            if visual.in_prefix(name, args.frozen_blocks):
+                p.requires_grad_(False)
+        # The first rank clears a stale store before the others open it
+        if rank == 0:
+            store = TokenCache(args.token_store, net.backbone, args.warp, args.worker_preprocess,
+                None, args.frozen_blocks)
+        dist.barrier()
+        if rank != 0:
+            store = TokenCache(args.token_store, net.backbone, args.warp, args.worker_preprocess,
+                None, args.frozen_blocks)
+        net.backbone.cuda()
+        for dataset in (trainset, valset):
+            cache_frozen_tokens(net.backbone, dataset, store, args.frozen_blocks, rank,
+                args.world_size, args.batch_size, args.num_workers)
+            dataset.token_store = store
+        net.frozen_blocks = args.frozen_blocks
+
     engine = CustomisedDLE(
         net,
         train_loader,
@@ -117,7 +158,9 @@ def main(rank, args):
         num_classes=num_classes,
         backbone_name=args.backbone_name,
         print_interval=args.print_interval,
-        cache_dir=args.cache_dir
+        cache_dir=args.cache_dir,
+        epoch_results=args.epoch_results,
+        amp=AMP_DTYPES.get(args.amp)
     )
     # Seperate backbone parameters from the rest
     param_group_1 = []
@@ -184,8 +227,29 @@ if __name__ == '__main__':
     parser.add_argument('--num-class', default=117, type=int)
     parser.add_argument('--pose', action='store_true')
     parser.add_argument('--warp', action='store_true')
+    parser.add_argument('--worker-preprocess', action='store_true',
+                        help="Warp or resize images and transform boxes in the dataloader workers")
     parser.add_argument('--local_pose', action='store_true')
     parser.add_argument('--pose_cls', action='store_true')
+    parser.add_argument('--packed-anno', action='store_true',
+                        help="Load annotations from memory-mapped arrays instead of json")
+    parser.add_argument('--balanced-sampler', action='store_true',
+                        help="Balance the estimated cost of boxes and pairs of the batches across ranks")
+    parser.add_argument('--epoch-results', action='store_true',
+                        help="Gather the results for training mAP once per epoch instead of every iteration")
+    parser.add_argument('--checkpoint-blocks', default=0, type=int,
+                        help="Number of backbone blocks, from the first, whose activations are "
+                        "recomputed in the backward pass instead of being kept")
+    parser.add_argument('--checkpoint-group', default=1, type=int,
+                        help="Number of blocks per checkpointed segment")
+    parser.add_argument('--frozen-blocks', default=0, type=int,
+                        help="Freeze the patch embedding and this number of backbone blocks, "
+                        "and train the rest from their output tokens in --token-store")
+    parser.add_argument('--token-store', default=None, type=str,
+                        help="Directory of the tokens leaving the frozen blocks, "
+                        "written before training if missing")
+    parser.add_argument('--amp', default=None, choices=['fp16', 'bf16'],
+                        help="Train with automatic mixed precision in the given data type")
 
     args = parser.parse_args()
     print(args)
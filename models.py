@@ -19,15 +19,16 @@ from torchvision.ops import MultiScaleRoIAlign
 from torchvision.models.detection import transform
 import torch.nn.functional as F
 
-from ops import get_warp_matrix, warp_affine_joints, transform_preds, warpaffine_image
+from ops import get_warp_matrix, warp_affine_joints, transform_preds, warpaffine_image, warp_image
+from ops import warpaffine_images, warp_annotations_batched, transform_preds_batched
 import cv2
 import numpy as np
 
 import pocket.models as models
 import clip
-from ops import generate_pose_heatmap
+from ops import generate_pose_heatmap, warp_annotations, resize_annotations
 
-from transforms import HOINetworkTransform
+from transforms import HOINetworkTransform, clip_image_transform, CLIP_MEAN, CLIP_STD
 from interaction_head import InteractionHead, GraphHead
 
 class GenericHOINetwork(nn.Module):
@@ -57,6 +58,11 @@ torchvision Imagelist
         self.warp = warp
         self.topilimage = ToPILImage()
         self.instance_norm = nn.InstanceNorm2d(256, affine=False)
+        # Optional store.TokenCache of the backbone tokens entering its last block
+        self.token_cache = None
+        # Number of frozen backbone blocks. If nonzero, the images are replaced by the
+        # tokens leaving these blocks, see utils.DataFactory.token_store
+        self.frozen_blocks = 0
         
 
     def preprocess(self,
@@ -64,7 +70,8 @@ torchvision Imagelist
         detections: List[dict],
         targets: Optional[List[dict]] = None
     ):
-        device = torch.device(f"cuda:{self.rank}")
+        # Follow the device the inputs were moved to
+        device = images[0].device
         original_image_sizes = [img.shape[-2:] for img in images]
         if self.backbone_name == "resnet50":
             images, targets = self.transform(images, targets)
@@ -79,159 +86,79 @@ torchvision Imagelist
             return images, detections, targets, original_image_sizes, [None for _ in range(len(detections))]
                 
         elif self.backbone_name == "CLIP" or self.backbone_name == "CLIP_CLS":
-            if self.warp:
-                topilimage = ToPILImage()
-                totensor = ToTensor()
-                processed_image_list = []
-                trans_list = []
-                img_meta_list = []
-                mean = torch.tensor([0.48145466, 0.4578275, 0.40821073]).to(device).view(-1, 1, 1)
-                std = torch.tensor([0.26862954, 0.26130258, 0.27577711]).to(device).view(-1, 1, 1)
-                for img in images:
-                    img = topilimage(img)
-                    img, trans, img_meta = warpaffine_image(img, n_px=672, device=device)
-                    img = totensor(img).to(device)
-                    processed_image_list.append(img.sub_(mean).div_(std))
-                    trans_list.append(trans)
-                    img_meta_list.append(img_meta)
-                
-                processed_image_sizes = [img.shape[-2:] for img in processed_image_list]
-                if targets is None:
-                    for det, o_im_s, im_s, trans in zip(
-            detections, original_image_sizes, processed_image_sizes, trans_list
-            ):          
-                        boxes = det['boxes']
-                        boxes = warp_affine_joints(boxes, trans)
-                        det['boxes'] = boxes
-
-                        if self.pose:
-                            human_joints = det['human_joints']
-                            human_joints = warp_affine_joints(human_joints, trans)
-                            det['human_joints'] = human_joints    
-                            boxes = det['boxes']
-                            human_joints_score = det['human_joints_score']
-                            boxes_label = det['labels']
-                            human_boxes = boxes[boxes_label == self.human_idx]
-
-                            det['pose_heatmap'] = generate_pose_heatmap(human_boxes, human_joints, human_joints_score)
-                
+            if len(detections) and 'original_size' in detections[0].get('img_meta', {}):
+                # Inputs already preprocessed by the dataloader workers, see
+                # utils.DataFactory.preprocess_inputs
+                img_metas = [det.pop('img_meta') for det in detections]
+                original_image_sizes = [tuple(m.pop('original_size').tolist()) for m in img_metas]
+                if self.warp:
+                    assert 'center' in img_metas[0], "Inputs were not warped in the dataloader"
+                    for m in img_metas:
+                        m['n_px'] = int(m['n_px'])
                 else:
-                
-                    for det, tar, o_im_s, im_s, trans in zip(
-                detections, targets, original_image_sizes, processed_image_sizes, trans_list
-                ):      
-                        target_h = tar['boxes_h']
-                        target_h = warp_affine_joints(target_h, trans)
-                        tar['boxes_h'] = target_h    
-                        target_o = tar['boxes_o']
-                        target_o = warp_affine_joints(target_o, trans)
-                        tar['boxes_o'] = target_o   
-                        boxes = det['boxes']
-                        boxes = warp_affine_joints(boxes, trans)
-                        det['boxes'] = boxes
-
-                        if self.pose:
-                            human_joints = det['human_joints']
-                            human_joints = warp_affine_joints(human_joints, trans)
-                            det['human_joints'] = human_joints    
+                    img_metas = [None for _ in range(len(detections))]
+                images = torch.stack([img.to(device) for img in images], dim=0)
+                return images, detections, targets, original_image_sizes, img_metas
 
-                            human_joints_score = det['human_joints_score']
-                            boxes = det['boxes']
-                            boxes_label = det['labels']
-                            human_boxes = boxes[boxes_label == self.human_idx]
+            if self.warp:
+                mean = torch.tensor(CLIP_MEAN).to(device).view(-1, 1, 1)
+                std = torch.tensor(CLIP_STD).to(device).view(-1, 1, 1)
+                if 'img_meta' in detections[0]:
+                    # Images warped ahead of time, see store.WarpedImageStore
+                    img_meta_list = [det.pop('img_meta') for det in detections]
+                    trans = torch.stack([m.pop('trans') for m in img_meta_list]).to(device)
+                    for m in img_meta_list:
+                        m['n_px'] = int(m['n_px'])
+                    images = torch.stack([img.to(device) for img in images]).float().div_(255)
+                else:
+                    images, trans, center, scale = warpaffine_images(
+                        [img.to(device) for img in images], n_px=672)
+                    img_meta_list = [{'center': c, 'scale': s, 'n_px': 672}
+                        for c, s in zip(center, scale)]
+                warp_annotations_batched(detections, targets, trans, self.human_idx, self.pose)
 
-                            det['pose_heatmap'] = generate_pose_heatmap(human_boxes, human_joints, human_joints_score)
+                return images.sub_(mean).div_(std), detections, targets, original_image_sizes, img_meta_list
 
-                            tar_human_joints = tar['human_joints']
-                            tar_human_joints = warp_affine_joints(tar_human_joints, trans)
-                            tar['human_joints'] = tar_human_joints
-                            
-                            boxes_o = tar['boxes_o'][tar['object'] == self.human_idx]
-                            tar['pose_heatmap'] = generate_pose_heatmap(torch.cat([tar['boxes_h'], boxes_o], dim=0), tar['human_joints'], tar['human_joints_score'])
-                            
-                            
-                return torch.stack(processed_image_list, dim=0), detections, targets, original_image_sizes, img_meta_list
-                
             else:
                 processed_image_list = []
                 for img in images:
                     processed_image_list.append(self.transform(img).to(device))
                 processed_image_sizes = [img.shape[-2:] for img in processed_image_list]
                 if targets is None:
-                    for det, o_im_s, im_s in zip(
-        detections, original_image_sizes, processed_image_sizes
-        ):          
-                        if self.pose:
-                            boxes = det['boxes']
-                            boxes_label = det['labels']
-                            human_boxes = boxes[boxes_label == self.human_idx]
-
-                            det['pose_heatmap'] = generate_pose_heatmap(human_boxes, det['human_joints'], det['human_joints_score'])
-
-                            height_scale_factor = im_s[0] / o_im_s[0]
-                            width_scale_factor = im_s[1] / o_im_s[1]
-                            human_joints = det['human_joints']
-                            if len(human_joints) != 0:
-                                human_joints[..., 0] = human_joints[..., 0] * width_scale_factor
-                                human_joints[..., 1] = human_joints[..., 1] * height_scale_factor
-                            det['human_joints'] = human_joints
-
-                        boxes = det['boxes']
-                        boxes = transform.resize_boxes(boxes, o_im_s, im_s)
-                        det['boxes'] = boxes
-
+                    targets_ = [None for _ in range(len(detections))]
                 else:
-                    for det, tar, o_im_s, im_s in zip(
-                detections, targets, original_image_sizes, processed_image_sizes
-                ):      
-                        if self.pose:
-                            boxes = det['boxes']
-                            boxes_label = det['labels']
-                            human_boxes = boxes[boxes_label == self.human_idx]
-
-                            det['pose_heatmap'] = generate_pose_heatmap(human_boxes, det['human_joints'], det['human_joints_score'])
-
-                            height_scale_factor = im_s[0] / o_im_s[0]
-                            width_scale_factor = im_s[1] / o_im_s[1]
-                            human_joints = det['human_joints']
-                            if len(human_joints) != 0:
-                                human_joints[..., 0] = human_joints[..., 0] * width_scale_factor
-                                human_joints[..., 1] = human_joints[..., 1] * height_scale_factor
-
-                            det['human_joints'] = human_joints
-                            
-                            boxes_o = tar['boxes_o'][tar['object'] == self.human_idx]
-                            tar['pose_heatmap'] = generate_pose_heatmap(torch.cat([tar['boxes_h'], boxes_o], dim=0), tar['human_joints'], tar['human_joints_score'])
-                            
+                    targets_ = targets
+                for det, tar, o_im_s, im_s in zip(
+                    detections, targets_, original_image_sizes, processed_image_sizes
+                ):
+                    resize_annotations(det, tar, o_im_s, im_s, self.human_idx, self.pose)
 
-                            height_scale_factor = im_s[0] / o_im_s[0]
-                            width_scale_factor = im_s[1] / o_im_s[1]
-                            human_joints = tar['human_joints']
-                            if len(human_joints) != 0:
-                                human_joints[..., 0] = human_joints[..., 0] * width_scale_factor
-                                human_joints[..., 1] = human_joints[..., 1] * height_scale_factor
-
-                            tar['human_joints'] = human_joints
-
-                        target_h = tar['boxes_h']
-                        target_h = transform.resize_boxes(target_h, o_im_s, im_s)
-                        tar['boxes_h'] = target_h    
-                        target_o = tar['boxes_o']
-                        target_o = transform.resize_boxes(target_o, o_im_s, im_s)
-                        tar['boxes_o'] = target_o   
-                        boxes = det['boxes']
-                        boxes = transform.resize_boxes(boxes, o_im_s, im_s)
-                        det['boxes'] = boxes
-            
                 return torch.stack(processed_image_list, dim=0), detections, targets, original_image_sizes, [None for _ in range(len(detections))]
     
         else: 
             assert False, "Not supported backbone name"
 
+    def cached_tokens(self, images: Tensor, filenames: List[str]) -> Tensor:
+        """
+        Read the (L, B, C) tokens entering the last backbone block from the token
+        cache, and encode and write those of the images missing from it. Encoded
+        tokens are rounded to fp16 as well, so that results do not depend on whether
+        the cache was warm
+        """
+        tokens = [self.token_cache.get(name) for name in filenames]
+        missing = [i for i, t in enumerate(tokens) if t is None]
+        if len(missing):
+            encoded = self.backbone.encode_tokens(images[missing]).half()
+            for i, t in zip(missing, encoded.unbind(1)):
+                self.token_cache.put(filenames[i], t)
+                tokens[i] = t
+        return torch.stack([t.to(images.device) for t in tokens], dim=1)
+
     def forward(self,
         images: List[Tensor],
         detections: List[dict],
-        targets: Optional[List[dict]] = None
+        targets: Optional[List[dict]] = None,
+        filenames: Optional[List[str]] = None
     ) :
         """
         Parameters:
@@ -239,6 +166,8 @@ torchvision Imagelist
             images: List[Tensor]
             detections: List[dict]
             targets: List[dict]
+            filenames: List[str]
+                Names of the image files, the keys of the token cache if one is set
 
         Returns:
         --------
@@ -256,9 +185,19 @@ torchvision Imagelist
             images.image_sizes, targets)
            
         elif self.backbone_name == "CLIP_CLS" or self.backbone_name == "DEFR":
-            image_sizes = [img.shape[-2:] for img in images]
             features = OrderedDict()
-            results = self.interaction_head(features, detections, image_sizes, targets, images)
+            tokens = None
+            if self.frozen_blocks:
+                # (B, L, C) tokens of square images, to run the remaining blocks on
+                n_px = int((images.shape[1] - 1) ** 0.5) * self.patch_size
+                image_sizes = [torch.Size([n_px, n_px]) for _ in images]
+                tokens = self.backbone.advance_tokens(images.permute(1, 0, 2), self.frozen_blocks)
+                images = None
+            else:
+                image_sizes = [img.shape[-2:] for img in images]
+                if self.token_cache is not None and filenames is not None:
+                    tokens = self.cached_tokens(images, filenames)
+            results = self.interaction_head(features, detections, image_sizes, targets, images, tokens)
         
         elif self.backbone_name == "CLIP": 
             image_sizes = [img.shape[-2:] for img in images]
@@ -279,16 +218,24 @@ torchvision Imagelist
             elif self.backbone_name == 'CLIP' or self.backbone_name == "CLIP_CLS":
                 if self.training:
                     loss = results.pop()
-                for pred, im_s, o_im_s, img_meta in zip(results, image_sizes, original_image_sizes, img_metas):
-                    if self.warp:
-                        boxes_h, boxes_o = pred['boxes_h'], pred['boxes_o']
-                        center = img_meta['center']
-                        n_px = img_meta['n_px']
-                        scale = img_meta['scale']
-                        boxes_h = transform_preds(boxes_h.reshape(-1, 2), center, scale, [n_px, n_px], use_udp=True).reshape(-1, 4)
-                        boxes_o = transform_preds(boxes_o.reshape(-1, 2), center, scale, [n_px, n_px], use_udp=True).reshape(-1, 4)
-                        pred['boxes_h'], pred['boxes_o'] = boxes_h, boxes_o
-                    else:
+                if self.warp:
+                    # Map boxes of all images back with one batched transform
+                    center = torch.stack([m['center'] for m in img_metas])
+                    scale = torch.stack([m['scale'] for m in img_metas])
+                    n_px = img_metas[0]['n_px']
+                    counts = [len(pred['boxes_h']) for pred in results]
+                    batch_idx = torch.repeat_interleave(
+                        torch.arange(len(results), device=center.device),
+                        torch.as_tensor(counts, device=center.device), output_size=sum(counts)
+                    )
+                    for key in ['boxes_h', 'boxes_o']:
+                        boxes = torch.cat([pred[key] for pred in results]).reshape(-1, 2, 2)
+                        boxes = transform_preds_batched(boxes, center, scale, [n_px, n_px],
+                            batch_idx, use_udp=True).reshape(-1, 4)
+                        for pred, b in zip(results, boxes.split(counts)):
+                            pred[key] = b
+                else:
+                    for pred, im_s, o_im_s in zip(results, image_sizes, original_image_sizes):
                         boxes_h, boxes_o = pred['boxes_h'], pred['boxes_o']
                         boxes_h = transform.resize_boxes(boxes_h, im_s, o_im_s)
                         boxes_o = transform.resize_boxes(boxes_o, im_s, o_im_s)
@@ -301,9 +248,6 @@ torchvision Imagelist
         else:
             return results
 
-def _convert_image_to_rgb(image):
-    return image.convert("RGB")
-
 class SpatiallyConditionedGraph(GenericHOINetwork):
     def __init__(self,
         object_to_action: List[list],
@@ -351,7 +295,14 @@ class SpatiallyConditionedGraph(GenericHOINetwork):
             
             
         elif backbone_name == "CLIP" or backbone_name == "CLIP_CLS" or backbone_name=="DEFR":
-            backbone, _ = clip.load(f"ViT-B/{patch_size}", jit=False)
+            pretrained_img_size = 224
+            input_img_size = 672
+            if pretrained:
+                backbone, _ = clip.load(f"ViT-B/{patch_size}", jit=False)
+            else:
+                # Weights are loaded from a checkpoint afterwards, so build the model at
+                # the input resolution without reading the pretrained CLIP weights
+                backbone = clip.build_meta(f"ViT-B/{patch_size}", input_img_size)
             del backbone.token_embedding
             del backbone.positional_embedding
             del backbone.ln_final
@@ -362,19 +313,21 @@ class SpatiallyConditionedGraph(GenericHOINetwork):
 
             logit_scale =  None
             del backbone.logit_scale
-            pretrained_img_size = 224
-            input_img_size = 672
-            scale_factor = input_img_size // pretrained_img_size
-            pretrained_width = pretrained_img_size // patch_size
-            input_width = scale_factor * pretrained_width
             out_channels = 768
-            backbone = backbone.float()
-            cls_pos_embedding = backbone.visual.positional_embedding[:1]
-            pre_pos_embedding = backbone.visual.positional_embedding[1:].view(pretrained_width,pretrained_width,-1).permute(2,0,1)
+            if not pretrained:
+                # Allocate the remaining vision tower without initialising it
+                backbone = backbone.to_empty(device="cpu")
+            else:
+                scale_factor = input_img_size // pretrained_img_size
+                pretrained_width = pretrained_img_size // patch_size
+                input_width = scale_factor * pretrained_width
+                backbone = backbone.float()
+                cls_pos_embedding = backbone.visual.positional_embedding[:1]
+                pre_pos_embedding = backbone.visual.positional_embedding[1:].view(pretrained_width,pretrained_width,-1).permute(2,0,1)
             
-            post_pos_embedding = F.interpolate(pre_pos_embedding.unsqueeze(0), scale_factor=scale_factor, mode='bilinear')[0]
-            expanded_pos_embedding = torch.cat([cls_pos_embedding, post_pos_embedding.permute(1,2,0).view(input_width*input_width,-1)], dim=0)
-            backbone.visual.positional_embedding = torch.nn.Parameter(expanded_pos_embedding)
+                post_pos_embedding = F.interpolate(pre_pos_embedding.unsqueeze(0), scale_factor=scale_factor, mode='bilinear')[0]
+                expanded_pos_embedding = torch.cat([cls_pos_embedding, post_pos_embedding.permute(1,2,0).view(input_width*input_width,-1)], dim=0)
+                backbone.visual.positional_embedding = torch.nn.Parameter(expanded_pos_embedding)
         else:
             assert False, "Not Supported Backbone Type"
         
@@ -452,13 +405,6 @@ class SpatiallyConditionedGraph(GenericHOINetwork):
                             ToTensor()
                         ])
             else:
-                n_px = 672
-                transform  = Compose([
-                            ToPILImage(),
-                            Resize((n_px, n_px), interpolation=BICUBIC),
-                            _convert_image_to_rgb,
-                            ToTensor(),
-                            Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
-                        ])
+                transform = clip_image_transform(672)
         
         super().__init__(backbone, backbone_name, interaction_head, transform, postprocess, rank, patch_size, human_idx, pose, warp)
\ No newline at end of file
@@ -7,6 +7,8 @@ import time
 
 from torch import Tensor
 from typing import List, Tuple
+from torchvision.transforms import ToPILImage
+from torchvision.models.detection.transform import resize_boxes
 
 def compute_spatial_encodings(
     boxes_1: List[Tensor], boxes_2: List[Tensor],
@@ -227,10 +229,13 @@ def binary_focal_loss(
     reduction: str = 'mean',
     eps: float = 1e-6
 ):
-    loss = (1 - y - alpha).abs() * ((y-x).abs() + eps) ** gamma * \
-        torch.nn.functional.binary_cross_entropy(
-            x, y, reduction='none'
-        )
+    # Binary cross entropy is unsafe to autocast, and eps vanishes in fp16
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float(); y = y.float()
+        loss = (1 - y - alpha).abs() * ((y-x).abs() + eps) ** gamma * \
+            torch.nn.functional.binary_cross_entropy(
+                x, y, reduction='none'
+            )
     if reduction == 'mean':
         return loss.mean()
     elif reduction == 'sum':
@@ -240,6 +245,48 @@ def binary_focal_loss(
     else:
         raise ValueError("Unsupported reduction method {}".format(reduction))
 
+class CollectiveTimer:
+    """
+    Accumulate the time that the computation waits for collectives
+
+    Wrap the wait on an asynchronous collective with `timer.wait(work, device)`.
+    On CUDA, events recorded around the wait on the current stream measure how
+    long the stream stalls, i.e. only the part of the collective that does not
+    overlap with computation. The events are read, with a sync, only when the
+    total is queried. On CPU, the wall time of the wait is counted instead.
+    """
+    def __init__(self):
+        self._events = []
+        self._seconds = 0.
+        self.count = 0
+
+    def wait(self, work, device: torch.device):
+        self.count += 1
+        if device.type == 'cuda':
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            work.wait()
+            end.record()
+            self._events.append((start, end))
+        else:
+            t = time.perf_counter()
+            work.wait()
+            self._seconds += time.perf_counter() - t
+
+    def reset(self):
+        self._events = []
+        self._seconds = 0.
+        self.count = 0
+
+    def total(self) -> float:
+        """Return the accumulated time in seconds"""
+        for start, end in self._events:
+            end.synchronize()
+            self._seconds += start.elapsed_time(end) / 1e3
+        self._events = []
+        return self._seconds
+
 
 def generate_pose_heatmap(human_bbox: Tensor, human_joints : Tensor, human_joints_score: Tensor):
     if len(human_bbox) == 0:
@@ -296,6 +343,30 @@ def make_pose_box(box_coords, box_labels, human_joints, human_idx, image_hw, gam
     return result
 
 
+def warp_image(image: Tensor, n_px: int, device):
+    """
+    Warp an image tensor to a square network input with the unbiased affine transform
+
+    Parameters:
+    -----------
+        image: Tensor
+            (3, H, W) Image with values in [0, 1]
+        n_px: int
+            Size of the warped image
+        device: torch.device
+            Device on which the affine matrix is computed
+
+    Returns:
+    --------
+        np.ndarray
+            (n_px, n_px, 3) Warped image in uint8
+        Tensor
+            (2, 3) Affine matrix
+        dict
+            Image meta with keys `center`, `scale` and `n_px`
+    """
+    return warpaffine_image(ToPILImage()(image), n_px=n_px, device=device)
+
 def warpaffine_image(image, n_px, device):
     
     width, height = image.size
@@ -439,4 +510,267 @@ def transform_preds(coords, center, scale, output_size, use_udp=False):
     target_coords[:, 0] = coords[:, 0] * scale_x + center[0] - scale[0] * 0.5
     target_coords[:, 1] = coords[:, 1] * scale_y + center[1] - scale[1] * 0.5
 
-    return target_coords
\ No newline at end of file
+    return target_coords
+
+def get_warp_matrices(image_sizes: Tensor, n_px: int):
+    """
+    Compute in closed form the unbiased affine matrices of warpaffine_image for a batch
+
+    Parameters:
+    -----------
+        image_sizes: Tensor
+            (B, 2) Heights and widths of the images
+        n_px: int
+            Size of the warped images
+
+    Returns:
+    --------
+        Tensor
+            (B, 2, 3) Affine matrices
+        Tensor
+            (B, 2) Centres of the warped regions
+        Tensor
+            (B, 2) Scales of the warped regions
+    """
+    # Widths followed by heights, measured between the first and last pixel
+    wh = image_sizes.flip(1).to(torch.float32) - 1
+    center = wh * 0.5
+    # Extend the shorter side so that the region is square
+    scale = wh.max(dim=1, keepdim=True).values.expand(-1, 2) / 200.0
+    size_target = scale * 200.0
+    # A tensor numerator keeps the division exact as in get_warp_matrix
+    s = torch.full_like(size_target, n_px - 1.0) / size_target
+    t = s * (-0.5 * center * 2.0 + 0.5 * size_target)
+    trans = torch.zeros(len(image_sizes), 2, 3, dtype=torch.float32, device=image_sizes.device)
+    trans[:, 0, 0] = s[:, 0]; trans[:, 0, 2] = t[:, 0]
+    trans[:, 1, 1] = s[:, 1]; trans[:, 1, 2] = t[:, 1]
+    return trans, center, scale
+
+def warpaffine_images(images: List[Tensor], n_px: int):
+    """
+    Warp a batch of images of different sizes with the unbiased affine transform,
+    with a single bilinear resampling that matches warpaffine_image
+
+    Parameters:
+    -----------
+        images: List[Tensor]
+            (3, H, W) Images with values in [0, 1], all on the same device
+        n_px: int
+            Size of the warped images
+
+    Returns:
+    --------
+        Tensor
+            (B, 3, n_px, n_px) Warped images
+        Tensor
+            (B, 2, 3) Affine matrices
+        Tensor
+            (B, 2) Centres of the warped regions
+        Tensor
+            (B, 2) Scales of the warped regions
+    """
+    device = images[0].device
+    image_sizes = torch.as_tensor([img.shape[-2:] for img in images], device=device)
+    trans, center, scale = get_warp_matrices(image_sizes, n_px)
+
+    # Pad images at the right and bottom. Sampling outside an image reads
+    # zeros, which is the constant border of cv2.warpAffine
+    h, w = image_sizes.max(0).values.tolist()
+    padded = images[0].new_zeros(len(images), images[0].shape[0], h, w)
+    for img, x in zip(images, padded):
+        x[:, :img.shape[1], :img.shape[2]].copy_(img)
+
+    # Map normalised output coordinates to normalised input coordinates
+    # with pixel centres at the corners, i.e. align_corners=True
+    padded_wh = torch.as_tensor([w, h], dtype=torch.float32, device=device)
+    s = trans[:, [0, 1], [0, 1]]
+    t = trans[:, :, 2]
+    a = (n_px - 1.0) / (s * (padded_wh - 1.0))
+    b = a - 2.0 * t / (s * (padded_wh - 1.0)) - 1.0
+    theta = torch.zeros_like(trans)
+    theta[:, 0, 0] = a[:, 0]; theta[:, 0, 2] = b[:, 0]
+    theta[:, 1, 1] = a[:, 1]; theta[:, 1, 2] = b[:, 1]
+    grid = F.affine_grid(theta, (len(images), padded.shape[1], n_px, n_px), align_corners=True)
+    warped = F.grid_sample(padded, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    return warped, trans, center, scale
+
+def warp_affine_joints_batched(joints: Tensor, mats: Tensor, batch_idx: Tensor):
+    """
+    Apply per-image affine matrices to stacked coordinates
+
+    Parameters:
+    -----------
+        joints: Tensor
+            (N, ..., 2) Coordinates, e.g. boxes as (N, 2, 2) or joints as (N, 17, 2)
+        mats: Tensor
+            (B, 2, 3) Affine matrices
+        batch_idx: Tensor
+            (N,) Index of the image each row belongs to
+
+    Returns:
+    --------
+        Tensor
+            (N, ..., 2) Transformed coordinates
+    """
+    shape = joints.shape
+    joints = joints.reshape(shape[0], -1, 2)
+    mats = mats[batch_idx]
+    return (torch.bmm(joints, mats[:, :, :2].transpose(1, 2)) + mats[:, None, :, 2]).reshape(shape)
+
+def transform_preds_batched(coords: Tensor, center: Tensor, scale: Tensor,
+        output_size, batch_idx: Tensor, use_udp: bool = False):
+    """
+    Map stacked coordinates in the warped images back to the original images
+
+    Parameters:
+    -----------
+        coords: Tensor
+            (N, ..., 2) Coordinates in the warped images
+        center: Tensor
+            (B, 2) Centres of the warped regions
+        scale: Tensor
+            (B, 2) Scales of the warped regions
+        output_size: Tuple[int, int]
+            Size of the warped images
+        batch_idx: Tensor
+            (N,) Index of the image each row belongs to
+        use_udp: bool
+            Use unbiased data processing
+
+    Returns:
+    --------
+        Tensor
+            (N, ..., 2) Coordinates in the original images
+    """
+    shape = coords.shape
+    coords = coords.reshape(shape[0], -1, 2)
+    scale = scale[batch_idx] * 200.0
+    center = center[batch_idx]
+    output_size = torch.as_tensor(output_size, dtype=scale.dtype, device=scale.device)
+    if use_udp:
+        output_size = output_size - 1.0
+    target_coords = coords * (scale / output_size)[:, None] \
+        + (center - scale * 0.5)[:, None]
+    return target_coords.reshape(shape)
+
+def warp_annotations(detection: dict, target: dict, trans: Tensor, human_idx: int, pose: bool = False):
+    """
+    Warp the detections and optionally the targets of an image in place,
+    with the affine matrix returned by warpaffine_image
+
+    Parameters:
+    -----------
+        detection: dict
+            Detections with boxes, labels and optionally human joints
+        target: dict
+            Ground truth box pairs and optionally human joints. Left untouched if None
+        trans: Tensor
+            (2, 3) Affine matrix
+        human_idx: int
+            Object class index of human
+        pose: bool
+            If True, warp human joints and generate pose heatmaps
+    """
+    detection['boxes'] = warp_affine_joints(detection['boxes'], trans)
+    if pose:
+        detection['human_joints'] = warp_affine_joints(detection['human_joints'], trans)
+    if target is not None:
+        target['boxes_h'] = warp_affine_joints(target['boxes_h'], trans)
+        target['boxes_o'] = warp_affine_joints(target['boxes_o'], trans)
+        if pose:
+            target['human_joints'] = warp_affine_joints(target['human_joints'], trans)
+    if pose:
+        _add_pose_heatmaps(detection, target, human_idx)
+
+def _add_pose_heatmaps(detection: dict, target: dict, human_idx: int):
+    human_boxes = detection['boxes'][detection['labels'] == human_idx]
+    detection['pose_heatmap'] = generate_pose_heatmap(
+        human_boxes, detection['human_joints'], detection['human_joints_score'])
+    if target is not None:
+        boxes_o = target['boxes_o'][target['object'] == human_idx]
+        target['pose_heatmap'] = generate_pose_heatmap(
+            torch.cat([target['boxes_h'], boxes_o], dim=0),
+            target['human_joints'], target['human_joints_score'])
+
+def _warp_stacked(dicts: List[dict], key: str, num_points: int, trans: Tensor):
+    """Warp the same entry of all images with one batched transform"""
+    tensors = [d[key] for d in dicts]
+    counts = [x.numel() // (num_points * 2) for x in tensors]
+    batch_idx = torch.repeat_interleave(
+        torch.arange(len(tensors), device=trans.device),
+        torch.as_tensor(counts, device=trans.device), output_size=sum(counts)
+    )
+    warped = warp_affine_joints_batched(
+        torch.cat([x.reshape(-1, num_points, 2) for x in tensors]), trans, batch_idx)
+    for d, x, y in zip(dicts, tensors, warped.split(counts)):
+        d[key] = y.reshape(x.shape)
+
+def warp_annotations_batched(detections: List[dict], targets: List[dict], trans: Tensor,
+        human_idx: int, pose: bool = False):
+    """
+    Batched version of warp_annotations, where coordinates of the same kind
+    across all images are warped together
+
+    Parameters:
+    -----------
+        detections: List[dict]
+            Detections of each image
+        targets: List[dict]
+            Ground truth of each image. Left untouched if None
+        trans: Tensor
+            (B, 2, 3) Affine matrices
+        human_idx: int
+            Object class index of human
+        pose: bool
+            If True, warp human joints and generate pose heatmaps
+    """
+    _warp_stacked(detections, 'boxes', 2, trans)
+    if pose:
+        _warp_stacked(detections, 'human_joints', 17, trans)
+    if targets is not None:
+        _warp_stacked(targets, 'boxes_h', 2, trans)
+        _warp_stacked(targets, 'boxes_o', 2, trans)
+        if pose:
+            _warp_stacked(targets, 'human_joints', 17, trans)
+    if pose:
+        if targets is None:
+            targets = [None for _ in range(len(detections))]
+        for det, tar in zip(detections, targets):
+            _add_pose_heatmaps(det, tar, human_idx)
+
+def _resize_joints(human_joints: Tensor, original_size, size):
+    if len(human_joints) != 0:
+        human_joints[..., 0] = human_joints[..., 0] * (size[1] / original_size[1])
+        human_joints[..., 1] = human_joints[..., 1] * (size[0] / original_size[0])
+    return human_joints
+
+def resize_annotations(detection: dict, target: dict, original_size, size, human_idx: int, pose: bool = False):
+    """
+    Resize the detections and optionally the targets of an image in place
+
+    Parameters:
+    -----------
+        detection: dict
+            Detections with boxes, labels and optionally human joints
+        target: dict
+            Ground truth box pairs and optionally human joints. Left untouched if None
+        original_size: Tuple[int, int]
+            Height and width of the original image
+        size: Tuple[int, int]
+            Height and width of the resized image
+        human_idx: int
+            Object class index of human
+        pose: bool
+            If True, resize human joints and generate pose heatmaps
+    """
+    if pose:
+        _add_pose_heatmaps(detection, target, human_idx)
+        detection['human_joints'] = _resize_joints(detection['human_joints'], original_size, size)
+    detection['boxes'] = resize_boxes(detection['boxes'], original_size, size)
+    if target is None:
+        return
+
+    if pose:
+        target['human_joints'] = _resize_joints(target['human_joints'], original_size, size)
+    target['boxes_h'] = resize_boxes(target['boxes_h'], original_size, size)
+    target['boxes_o'] = resize_boxes(target['boxes_o'], original_size, size)
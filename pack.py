@@ -0,0 +1,93 @@
+"""
+Pack per-image files into memory-mapped stores
+
+    python pack.py detections --src hicodet/detections/test2015_upt_vitpose \
+        --dst hicodet/detections/test2015_upt_vitpose_packed
+    python pack.py annotations --anno-file hicodet/instances_train2015_vitpose.json
+    python pack.py warp --partition test2015 --dst hicodet/warped/test2015
+"""
+
+import os
+import json
+import torch
+import argparse
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+
+import pocket
+
+from ops import warp_image
+from store import DetectionStore, WarpedImageStore
+from hicodet.hicodet import HICODet, PackedAnnotations
+
+class WarpedImages(Dataset):
+    """Decode and warp images the same way as GenericHOINetwork.preprocess"""
+    def __init__(self, dataset, n_px):
+        self.dataset = dataset
+        self.n_px = n_px
+    def __len__(self):
+        return len(self.dataset)
+    def __getitem__(self, i):
+        image, _ = self.dataset[i]
+        image = pocket.ops.to_tensor(image, 'pil')
+        image, trans, img_meta = warp_image(image, n_px=self.n_px, device='cpu')
+        img_meta['trans'] = trans
+        return i, torch.from_numpy(image).permute(2, 0, 1).contiguous(), img_meta
+
+def _unpack(batch):
+    return batch[0]
+
+def pack_detections(args):
+    DetectionStore.pack(args.src, args.dst)
+
+def pack_annotations(args):
+    with open(args.anno_file, 'r') as f:
+        anno = json.load(f)
+    PackedAnnotations.pack(anno, args.anno_file, PackedAnnotations.sidecar(args.anno_file))
+
+def pack_warped_images(args):
+    dataset = HICODet(
+        root=os.path.join(args.data_root, 'hico_20160224_det/images', args.partition),
+        anno_file=os.path.join(args.data_root, 'instances_{}_vitpose.json'.format(args.partition))
+    )
+    dataloader = DataLoader(WarpedImages(dataset, args.n_px),
+        collate_fn=_unpack, batch_size=1, num_workers=args.num_workers
+    )
+    WarpedImageStore.pack(
+        tqdm(dataloader), [dataset.filename(i) for i in range(len(dataset))],
+        args.dst, n_px=args.n_px, shard_size=args.shard_size
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack data into memory-mapped stores")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    detections = subparsers.add_parser('detections',
+        help="Pack a directory of json detection files")
+    detections.add_argument('--src', required=True, type=str,
+                        help="Directory where detection files are stored")
+    detections.add_argument('--dst', required=True, type=str,
+                        help="Directory where the packed store will be written")
+    detections.set_defaults(func=pack_detections)
+
+    annotations = subparsers.add_parser('annotations',
+        help="Pack a HICO-DET annotation file into its sidecar directory")
+    annotations.add_argument('--anno-file', required=True, type=str,
+                        help="Path to the json annotation file")
+    annotations.set_defaults(func=pack_annotations)
+
+    warp = subparsers.add_parser('warp',
+        help="Cache images warped to the network input resolution for --warp")
+    warp.add_argument('--data-root', default='hicodet', type=str)
+    warp.add_argument('--partition', default='test2015', type=str)
+    warp.add_argument('--dst', required=True, type=str,
+                        help="Directory where the warped images will be written")
+    warp.add_argument('--n-px', default=672, type=int)
+    warp.add_argument('--shard-size', default=1000, type=int)
+    warp.add_argument('--num-workers', default=4, type=int)
+    warp.set_defaults(func=pack_warped_images)
+
+    args = parser.parse_args()
+    print(args)
+
+    args.func(args)
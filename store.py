@@ -0,0 +1,576 @@
+"""
+Packed, memory-mapped stores that replace per-image files
+
+A store is a directory of flat numpy arrays (.npy) that are opened with
+memory mapping, so a lookup is O(1) slicing with no parsing involved.
+Variable-length records are addressed through an offset index, i.e.
+the records of the i-th entry are rows offsets[i]: offsets[i + 1].
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+from tqdm import tqdm
+from typing import Optional
+
+def _load_arrays(root: str, names: list) -> dict:
+    """Open the arrays of a store directory with memory mapping"""
+    arrays = dict()
+    for name in names:
+        path = os.path.join(root, name + '.npy')
+        if os.path.exists(path):
+            arrays[name] = np.load(path, mmap_mode='r')
+    return arrays
+
+class DetectionStore:
+    """
+    Columnar store of detections packed from a directory of json files
+
+    Layout of the store directory:
+        filenames.json: Names of the detection files, in packing order
+        offsets.npy: (N + 1,) Box offsets of each image
+        boxes.npy: (M, 4) float32
+        labels.npy: (M,) int64
+        scores.npy: (M,) float32
+        joint_offsets.npy: (N + 1,) Human joint offsets of each image, optional
+        human_joints.npy: (H, 17, 2) float32, optional
+        human_joints_score.npy: (H, 17) float32, optional
+
+    Parameters:
+    -----------
+    root: str
+        Directory of the packed store
+    """
+    ARRAYS = ['offsets', 'boxes', 'labels', 'scores',
+        'joint_offsets', 'human_joints', 'human_joints_score']
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, 'filenames.json'), 'r') as f:
+            filenames = json.load(f)
+        self._index = {name: i for i, name in enumerate(filenames)}
+        # Memory maps are opened lazily so that each dataloader
+        # worker maps the files itself instead of inheriting them
+        self._arrays = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, filename: str):
+        return filename in self._index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def has_pose(self):
+        return os.path.exists(os.path.join(self.root, 'human_joints.npy'))
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        """Return True if the given directory is a packed detection store"""
+        return os.path.isfile(os.path.join(root, 'offsets.npy'))
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = _load_arrays(self.root, self.ARRAYS)
+        return self._arrays
+
+    def num_boxes(self, filename: str) -> int:
+        """Return the number of detected boxes in an image"""
+        offsets = self._open()['offsets']
+        i = self._index[filename]
+        return int(offsets[i + 1] - offsets[i])
+
+    def box_counts(self, filenames: list, human_idx: int, score_thresh: float = 0.) -> np.ndarray:
+        """
+        Count the human and object boxes scoring at least score_thresh in images
+
+        Arguments:
+            filenames(list[str]): Names of the detection files
+            human_idx(int): Label of the human class
+            score_thresh(float): Minimum score of the counted boxes
+        Returns:
+            ndarray: (N, 2) Numbers of human and object boxes of each image
+        """
+        arrays = self._open()
+        offsets = arrays['offsets']
+        n = len(offsets) - 1
+        image = np.repeat(np.arange(n), np.diff(offsets))
+        keep = np.asarray(arrays['scores']) >= score_thresh
+        human = np.asarray(arrays['labels']) == human_idx
+        counts = np.stack([
+            np.bincount(image[keep & human], minlength=n),
+            np.bincount(image[keep & ~human], minlength=n)
+        ], axis=1)
+        return counts[[self._index[name] for name in filenames]]
+
+    def get(self, filename: str, pose: bool = False) -> dict:
+        """
+        Arguments:
+            filename(str): Name of the detection file, e.g. HICO_test2015_00000001.json
+            pose(bool): If True, include human joints and joint scores
+        Returns:
+            dict: Detections with the same keys and tensor types as the json files
+        """
+        arrays = self._open()
+        i = self._index[filename]
+        start, end = arrays['offsets'][i: i + 2]
+        # Slices of the memory maps are copied as the detections
+        # are modified in place during preprocessing
+        detection = dict(
+            boxes=torch.from_numpy(np.array(arrays['boxes'][start: end])),
+            labels=torch.from_numpy(np.array(arrays['labels'][start: end])),
+            scores=torch.from_numpy(np.array(arrays['scores'][start: end]))
+        )
+        if pose:
+            start, end = arrays['joint_offsets'][i: i + 2]
+            detection['human_joints'] = torch.from_numpy(
+                np.array(arrays['human_joints'][start: end]))
+            detection['human_joints_score'] = torch.from_numpy(
+                np.array(arrays['human_joints_score'][start: end]))
+        return detection
+
+    @staticmethod
+    def pack(src: str, dst: str):
+        """
+        Pack a directory of per-image detection files into a store
+
+        Arguments:
+            src(str): Directory of json detection files
+            dst(str): Directory where the packed store will be written
+        """
+        filenames = sorted(f for f in os.listdir(src) if f.endswith('.json'))
+        boxes = []; labels = []; scores = []
+        joints = []; joints_score = []
+        offsets = [0]; joint_offsets = [0]
+        pose = None
+        for name in tqdm(filenames):
+            with open(os.path.join(src, name), 'r') as f:
+                detection = json.load(f)
+            if pose is None:
+                pose = 'human_joints' in detection
+            boxes.append(np.asarray(detection['boxes'], dtype=np.float32).reshape(-1, 4))
+            labels.append(np.asarray(detection['labels'], dtype=np.int64).reshape(-1))
+            scores.append(np.asarray(detection['scores'], dtype=np.float32).reshape(-1))
+            offsets.append(offsets[-1] + len(boxes[-1]))
+            if pose:
+                joints.append(np.asarray(
+                    detection['human_joints'], dtype=np.float32).reshape(-1, 17, 2))
+                joints_score.append(np.asarray(
+                    detection['human_joints_score'], dtype=np.float32).reshape(-1, 17))
+                joint_offsets.append(joint_offsets[-1] + len(joints[-1]))
+
+        os.makedirs(dst, exist_ok=True)
+        arrays = dict(
+            offsets=np.asarray(offsets, dtype=np.int64),
+            boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4), np.float32),
+            labels=np.concatenate(labels) if labels else np.zeros(0, np.int64),
+            scores=np.concatenate(scores) if scores else np.zeros(0, np.float32),
+        )
+        if pose:
+            arrays['joint_offsets'] = np.asarray(joint_offsets, dtype=np.int64)
+            arrays['human_joints'] = np.concatenate(joints)
+            arrays['human_joints_score'] = np.concatenate(joints_score)
+        for name, array in arrays.items():
+            np.save(os.path.join(dst, name + '.npy'), array)
+        with open(os.path.join(dst, 'filenames.json'), 'w') as f:
+            json.dump(filenames, f)
+
+class WarpedImageStore:
+    """
+    Images warped to the network input resolution, stored in memory-mapped shards
+
+    Layout of the store directory:
+        meta.json: Names of the image files in packing order, resolution and shard size
+        images_{k:03d}.npy: (S, 3, n_px, n_px) uint8 shards of warped images
+        trans.npy: (N, 2, 3) float32 affine matrices used for warping
+        center.npy: (N, 2) float32 centres of the warped regions
+        scale.npy: (N, 2) float32 scales of the warped regions
+
+    Parameters:
+    -----------
+    root: str
+        Directory of the store
+    """
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.n_px = meta['n_px']
+        self.shard_size = meta['shard_size']
+        self._index = {name: i for i, name in enumerate(meta['filenames'])}
+        self._arrays = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, filename: str):
+        return filename in self._index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _open(self):
+        if self._arrays is None:
+            arrays = _load_arrays(self.root, ['trans', 'center', 'scale'])
+            num_shards = (len(self) + self.shard_size - 1) // self.shard_size
+            arrays['images'] = [np.load(
+                os.path.join(self.root, 'images_{:03d}.npy'.format(k)), mmap_mode='r'
+            ) for k in range(num_shards)]
+            self._arrays = arrays
+        return self._arrays
+
+    def get(self, filename: str):
+        """
+        Arguments:
+            filename(str): Name of the image file
+        Returns:
+            Tensor: (3, n_px, n_px) Warped image in uint8
+            dict: Image meta with keys `center`, `scale`, `n_px` and `trans`
+        """
+        arrays = self._open()
+        i = self._index[filename]
+        image = arrays['images'][i // self.shard_size][i % self.shard_size]
+        img_meta = dict(
+            center=torch.from_numpy(np.array(arrays['center'][i])),
+            scale=torch.from_numpy(np.array(arrays['scale'][i])),
+            n_px=torch.as_tensor(self.n_px),
+            trans=torch.from_numpy(np.array(arrays['trans'][i]))
+        )
+        return torch.from_numpy(np.array(image)), img_meta
+
+    @staticmethod
+    def pack(samples, filenames: list, dst: str, n_px: int = 672, shard_size: int = 1000):
+        """
+        Write warped images into a store
+
+        Arguments:
+            samples(iterable): Tuples of (index, image, img_meta) in any order, where
+                image is a (3, n_px, n_px) uint8 tensor and img_meta is the dict
+                returned by ops.warpaffine_image with the affine matrix as `trans`
+            filenames(list[str]): Names of the image files, indexed as the samples
+            dst(str): Directory where the store will be written
+            n_px(int): Resolution of the warped images
+            shard_size(int): Number of images in each shard
+        """
+        os.makedirs(dst, exist_ok=True)
+        n = len(filenames)
+        shards = [np.lib.format.open_memmap(
+            os.path.join(dst, 'images_{:03d}.npy'.format(k)), mode='w+', dtype=np.uint8,
+            shape=(min(shard_size, n - k * shard_size), 3, n_px, n_px)
+        ) for k in range((n + shard_size - 1) // shard_size)]
+        trans = np.zeros((n, 2, 3), dtype=np.float32)
+        center = np.zeros((n, 2), dtype=np.float32)
+        scale = np.zeros((n, 2), dtype=np.float32)
+        for i, image, img_meta in samples:
+            shards[i // shard_size][i % shard_size] = image.numpy()
+            trans[i] = img_meta['trans'].cpu().numpy()
+            center[i] = img_meta['center'].cpu().numpy()
+            scale[i] = img_meta['scale'].cpu().numpy()
+        for shard in shards:
+            shard.flush()
+        np.save(os.path.join(dst, 'trans.npy'), trans)
+        np.save(os.path.join(dst, 'center.npy'), center)
+        np.save(os.path.join(dst, 'scale.npy'), scale)
+        with open(os.path.join(dst, 'meta.json'), 'w') as f:
+            json.dump(dict(filenames=filenames, n_px=n_px, shard_size=shard_size), f)
+
+class TokenCache:
+    """
+    Persistent cache of the ViT tokens entering the last, box-masked block, or
+    leaving any number of blocks before it
+
+    The earlier blocks of the backbone do not depend on the boxes, so with the tokens
+    of an image cached, box and pose features only need the last block. Tokens are
+    stored in fp16, one memory-mapped (L, C) array per image, in a directory keyed by
+    the warp mode, the preprocessing path, the patch size, the number of blocks and a
+    fingerprint of the weights of those blocks and of the patch embedding:
+        {root}/{key}/meta.json: Fields of the key and the token shape
+        {root}/{key}/{image name}.npy: (L, C) float16 tokens of an image
+
+    Entries whose fields or shape do not match the current backbone are never read.
+    The total size of all keys under the root is bounded by evicting the least
+    recently used entries, so that entries of stale checkpoints go first.
+
+    Parameters:
+    -----------
+    root: str
+        Directory of the cache
+    backbone: nn.Module
+        CLIP backbone whose tokens are cached
+    warp: bool
+        If True, images are warped to the input resolution instead of resized
+    preprocess: bool
+        If True, images are warped or resized in the dataloader workers, on uint8
+        images, instead of in the network
+    max_gb: float, optional
+        Maximum size of the cache on disk in GiB. Entries are never evicted if None
+    blocks: int, optional
+        Number of blocks the cached tokens have gone through, all but the last by default
+    """
+    def __init__(self, root: str, backbone, warp: bool, preprocess: bool,
+            max_gb: Optional[float] = 100., blocks: Optional[int] = None):
+        visual = backbone.visual
+        if blocks is None:
+            blocks = visual.transformer.layers - 1
+        self.meta = dict(
+            checkpoint=self.fingerprint(visual, lambda name: visual.in_prefix(name, blocks)),
+            warp=bool(warp), preprocess=bool(preprocess),
+            patch_size=int(visual.patch_size), blocks=int(blocks),
+            shape=list(visual.positional_embedding.shape), dtype='float16'
+        )
+        key = hashlib.sha1(json.dumps(self.meta, sort_keys=True).encode()).hexdigest()[:16]
+        self.root = root
+        self.dir = os.path.join(root, key)
+        self.max_bytes = None if max_gb is None else int(max_gb * 2 ** 30)
+        os.makedirs(self.dir, exist_ok=True)
+        meta_path = os.path.join(self.dir, 'meta.json')
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        if meta != self.meta:
+            if meta is not None:
+                # Key collision or a stale directory, whose entries cannot be trusted
+                shutil.rmtree(self.dir)
+                os.makedirs(self.dir)
+            # Replaced in one step, as other processes may be opening the same cache
+            tmp = meta_path + '.{}.tmp'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.meta, f)
+            os.replace(tmp, meta_path)
+        self._size = self._scan_size()
+
+    @staticmethod
+    def fingerprint(module, keep=None) -> str:
+        """
+        Hash of the names and values of the parameters and buffers of a module,
+        or of those whose names are kept by the given predicate
+        """
+        h = hashlib.sha1()
+        for name, tensor in sorted(module.state_dict().items()):
+            if keep is not None and not keep(name):
+                continue
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.dir, os.path.splitext(filename)[0] + '.npy')
+
+    def _entries(self):
+        """Yield the (path, size, access time) of all entries under the root"""
+        for key in os.listdir(self.root):
+            key_dir = os.path.join(self.root, key)
+            if not os.path.isdir(key_dir):
+                continue
+            for entry in os.scandir(key_dir):
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Evicted by another process
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def __contains__(self, filename: str):
+        return os.path.exists(self._path(filename))
+
+    def get(self, filename: str):
+        """
+        Arguments:
+            filename(str): Name of the image file
+        Returns:
+            Tensor or None: (L, C) Tokens in float16, or None on a miss
+        """
+        path = self._path(filename)
+        try:
+            tokens = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            # Missing, evicted, or partially written by a killed process
+            return None
+        if list(tokens.shape) != self.meta['shape'] or tokens.dtype != np.float16:
+            os.remove(path)
+            return None
+        # The modification time orders entries for eviction
+        os.utime(path)
+        return torch.from_numpy(np.array(tokens))
+
+    def put(self, filename: str, tokens):
+        """
+        Arguments:
+            filename(str): Name of the image file
+            tokens(Tensor): (L, C) Tokens of the image
+        """
+        tokens = tokens.detach().to('cpu', torch.float16).numpy()
+        assert list(tokens.shape) == self.meta['shape'], \
+            "Expected tokens of shape {} but got {}".format(self.meta['shape'], tokens.shape)
+        path = self._path(filename)
+        # Write to a temporary file first, so that readers never see a partial entry
+        tmp = path[:-len('.npy')] + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, tokens)
+        os.replace(tmp, path)
+        self._size += os.path.getsize(path)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its bound"""
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        self._size = sum(size for _, size, _ in entries)
+        # Leave some room so that eviction does not run on every write
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+class HeadFeatureStore:
+    """
+    Backbone features of the boxes kept by InteractionHead.preprocess, to train the
+    interaction head without the backbone
+
+    The records of each image follow the order of the boxes returned by preprocess,
+    humans first, so that the pairs, labels and priors computed by the head from the
+    stored boxes line up with the stored features. Images are written in shards of
+    consecutive images, each a set of flat arrays addressed through offset indices:
+        meta.json: Names of the image files, shard size and extraction settings
+        {name}_{k:03d}.npy: Array `name` of the k-th shard, with names as below
+        offsets: (S + 1,) Box offsets of each image in the shard
+        boxes: (M, 4) float32, labels: (M,) int64, scores: (M,) float32
+        box_features: (M, C) float16 class tokens masked by each box
+        global_features: (S, C) float16 class token of each image
+        tokens: (S, L, C) float16 tokens entering the last block of the backbone,
+            optional. They are stored with pose_cls, whose pose features depend on
+            the weights of the head
+        joint_offsets: (S + 1,) Human offsets of each image in the shard
+        human_joints: (H, 17, 2) float32, human_joints_score: (H, 17) float32
+        pose_features: (H, 17, C, P, P) float16 pooled features of the pose boxes,
+            optional. pose_boxes: (H, 17, 4) float32 pose boxes, optional
+        target_offsets: (S + 1,) Ground truth pair offsets of each image in the shard
+        boxes_h: (G, 4) float32, boxes_o: (G, 4) float32, verbs: (G,) int64
+
+    Boxes, joints and ground truth are in the coordinates of the network input.
+
+    Parameters:
+    -----------
+    root: str
+        Directory of the store
+    """
+    IMAGE_ARRAYS = ['global_features', 'tokens']
+    GROUPS = {
+        'offsets': ['boxes', 'labels', 'scores', 'box_features'],
+        'joint_offsets': ['human_joints', 'human_joints_score', 'pose_features', 'pose_boxes'],
+        'target_offsets': ['boxes_h', 'boxes_o', 'verbs']
+    }
+    DTYPES = dict(
+        boxes=np.float32, labels=np.int64, scores=np.float32, box_features=np.float16,
+        human_joints=np.float32, human_joints_score=np.float32, pose_features=np.float16,
+        pose_boxes=np.float32, boxes_h=np.float32, boxes_o=np.float32, verbs=np.int64,
+        global_features=np.float16, tokens=np.float16
+    )
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.filenames = self.meta['filenames']
+        self.shard_size = self.meta['shard_size']
+        self._shards = dict()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = dict()
+        return state
+
+    def _open(self, k: int) -> dict:
+        if k not in self._shards:
+            names = self.IMAGE_ARRAYS + list(self.GROUPS)
+            for group in self.GROUPS.values():
+                names += group
+            self._shards[k] = _load_arrays(self.root, ['{}_{:03d}'.format(name, k) for name in names])
+        return {name[:-4]: array for name, array in self._shards[k].items()}
+
+    def get(self, i: int) -> dict:
+        """
+        Arguments:
+            i(int): Index of the image
+        Returns:
+            dict: Tensors of the image with the names of the arrays, except offsets
+        """
+        arrays = self._open(i // self.shard_size)
+        j = i % self.shard_size
+        record = {name: torch.from_numpy(np.array(arrays[name][j]))
+            for name in self.IMAGE_ARRAYS if name in arrays}
+        for offsets, names in self.GROUPS.items():
+            if offsets not in arrays:
+                continue
+            start, end = arrays[offsets][j: j + 2]
+            for name in names:
+                if name in arrays:
+                    record[name] = torch.from_numpy(np.array(arrays[name][start: end]))
+        return record
+
+    @classmethod
+    def pack(cls, records, filenames: list, dst: str, shard_size: int = 1000, **meta):
+        """
+        Write the records of all images into a store
+
+        Arguments:
+            records(iterable): Dicts of tensors as returned by get, one per image
+                and in the order of filenames
+            filenames(list[str]): Names of the image files
+            dst(str): Directory where the store will be written
+            shard_size(int): Number of images in each shard
+            meta: Settings of the extraction, saved in meta.json
+        """
+        os.makedirs(dst, exist_ok=True)
+        buffer = []
+        def flush(k):
+            arrays = {name: np.stack([r[name].numpy().astype(cls.DTYPES[name]) for r in buffer])
+                for name in cls.IMAGE_ARRAYS if name in buffer[0]}
+            for offsets, names in cls.GROUPS.items():
+                if names[0] not in buffer[0]:
+                    # Joints are only stored with pose
+                    continue
+                for name in names:
+                    if name in buffer[0]:
+                        arrays[name] = np.concatenate([
+                            r[name].numpy().astype(cls.DTYPES[name]) for r in buffer])
+                counts = [len(r[names[0]]) for r in buffer]
+                arrays[offsets] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            for name, array in arrays.items():
+                np.save(os.path.join(dst, '{}_{:03d}.npy'.format(name, k)), array)
+            buffer.clear()
+
+        n = 0
+        for record in records:
+            buffer.append({name: t.detach().cpu() for name, t in record.items()})
+            n += 1
+            if len(buffer) == shard_size:
+                flush((n - 1) // shard_size)
+        if len(buffer):
+            flush((n - 1) // shard_size)
+        assert n == len(filenames), "Expected {} records but got {}".format(len(filenames), n)
+        with open(os.path.join(dst, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, filenames=filenames, shard_size=shard_size), f)
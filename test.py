@@ -2,56 +2,50 @@ import os
 import torch
 import argparse
 import torchvision
-from torch.utils.data import DataLoader
 
 import pocket
 
 from hicodet.hicodet import HICODet
-from models import SpatiallyConditionedGraph as SCG
-from utils import DataFactory, custom_collate, test
+from evaluation import HOIEvaluator
+from utils import test, inference, label_detections, build_inference, run_sharded, AMP_DTYPES
 
-def main(args):
-    torch.cuda.set_device(0)
-    torch.backends.cudnn.benchmark = False
+def evaluate_shard(rank, num_shards, args, put):
+    """Label the detections of every num_shards-th image and send them back"""
+    net, dataloader, device, epoch = build_inference(args, args.num_class, rank, num_shards)
+    if rank == 0:
+        put(epoch)
+    testset = dataloader.dataset.dataset
+    for i, output, target in inference(net, dataloader, device, AMP_DTYPES.get(args.amp)):
+        interactions, scores, labels = label_detections(testset, output, target)
+        put((i, interactions.numpy(), scores.numpy(), labels.numpy()))
 
+def main(args):
     num_anno = torch.tensor(HICODet(None, anno_file=os.path.join(
         args.data_root, 'instances_train2015.json')).anno_interaction)
     rare = torch.nonzero(num_anno < 10).squeeze(1)
     non_rare = torch.nonzero(num_anno >= 10).squeeze(1)
-    num_classes = args.num_class
-    dataloader = DataLoader(
-        dataset=DataFactory(
-            name='hicodet', partition=args.partition,
-            data_root=args.data_root,
-            detection_root=args.detection_dir, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose
-        ), collate_fn=custom_collate, batch_size=1,
-        num_workers=args.num_workers, pin_memory=True
-    )
-    object_to_target = dataloader.dataset.dataset.object_to_verb
-    object_n_verb_to_interaction = dataloader.dataset.dataset.object_n_verb_to_interaction
-    object_to_interaction = dataloader.dataset.dataset.object_to_interaction
-    verb_list = dataloader.dataset.dataset.verbs
-    net = SCG(
-        object_to_target, object_n_verb_to_interaction, object_to_interaction, verb_list, 49, num_classes = num_classes, backbone_name=args.backbone_name,
-        output_size=args.roi_size, num_iterations=args.num_iter, max_human=args.max_human, max_object=args.max_object,
-        box_score_thresh=args.box_score_thresh, patch_size=args.patch_size, pose=args.pose, warp=args.warp, local_pose=args.local_pose, pose_cls=args.pose_cls
-    )
-
-    epoch = 0
-    if os.path.exists(args.model_path):
-        print("Loading model from ", args.model_path)
-        checkpoint = torch.load(args.model_path, map_location="cpu")
-        net.load_state_dict(checkpoint['model_state_dict'])
-        epoch = checkpoint["epoch"]
-    elif len(args.model_path):
-        print("\nWARNING: The given model path does not exist. "
-            "Proceed to use a randomly initialised model.\n")
-
-    net.cuda()
     timer = pocket.utils.HandyTimer(maxlen=1)
-    
-    with timer:
-        test_ap = test(net, dataloader)
+
+    if args.shards > 1:
+        testset = HICODet(None, anno_file=os.path.join(
+            args.data_root, 'instances_{}_vitpose.json'.format(args.partition)),
+            packed=args.packed_anno)
+        evaluator = HOIEvaluator(testset.anno_interaction, min_iou=0.5)
+        with timer:
+            # Detections are ordered by image index in the evaluator, so
+            # the order in which the shards report back does not matter
+            for item in run_sharded(evaluate_shard, args.shards, args):
+                if isinstance(item, int):
+                    epoch = item
+                    continue
+                i, interactions, scores, labels = item
+                evaluator.extend(i, torch.from_numpy(interactions),
+                    torch.from_numpy(scores), torch.from_numpy(labels))
+            test_ap = evaluator.eval()
+    else:
+        net, dataloader, device, epoch = build_inference(args, args.num_class)
+        with timer:
+            test_ap = test(net, dataloader, device, AMP_DTYPES.get(args.amp))
     print("Model at epoch: {} | time elapsed: {:.2f}s\n"
         "Full: {:.4f}, rare: {:.4f}, non-rare: {:.4f}".format(
         epoch, timer[0], test_ap.mean(),
@@ -63,6 +57,8 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Train an interaction head")
+    # Only HICO-DET is evaluated here
+    parser.set_defaults(dataset='hicodet')
     parser.add_argument('--data-root', default='hicodet', type=str)
     parser.add_argument('--detection-dir', default='hicodet/detections/test2015_gt_vitpose',
                         type=str, help="Directory where detection files are stored")
@@ -73,6 +69,14 @@ if __name__ == "__main__":
     parser.add_argument('--max-human', default=15, type=int)
     parser.add_argument('--max-object', default=15, type=int)
     parser.add_argument('--num-workers', default=2, type=int)
+    parser.add_argument('--batch-size', default=None, type=int,
+                        help="Number of images the network runs on at once, 1 by default, "
+                        "or at most with --batch-budget, 64 by default")
+    parser.add_argument('--batch-budget', default=None, type=float,
+                        help="Pack images into batches of at most this many boxes or pairs, "
+                        "see --budget-unit, instead of a fixed number of images")
+    parser.add_argument('--budget-unit', default='boxes', choices=['boxes', 'pairs'],
+                        help="Unit of --batch-budget, counted after the box score threshold")
     parser.add_argument('--model-path', default='', type=str)
     parser.add_argument('--backbone-name', default='CLIP_CLS', type=str)
     parser.add_argument('--num-class', default=117, type=int)
@@ -80,8 +84,26 @@ if __name__ == "__main__":
     parser.add_argument('--roi-size', default=7, type=int)
     parser.add_argument('--pose', action='store_true')
     parser.add_argument('--warp', action='store_true')
+    parser.add_argument('--worker-preprocess', action='store_true',
+                        help="Warp or resize images and transform boxes in the dataloader workers")
     parser.add_argument('--local_pose', action='store_true')
     parser.add_argument('--pose_cls', action='store_true')
+    parser.add_argument('--packed-anno', action='store_true',
+                        help="Load annotations from memory-mapped arrays instead of json")
+    parser.add_argument('--warp-cache', default=None, type=str,
+                        help="Directory of images warped ahead of time with pack.py warp")
+    parser.add_argument('--token-cache', default=None, type=str,
+                        help="Directory where the backbone tokens entering its last block are "
+                        "cached, so that repeated runs only compute the last block")
+    parser.add_argument('--token-cache-gb', default=100., type=float,
+                        help="Maximum size of the token cache in GiB")
+    parser.add_argument('--device', default='cuda', type=str, choices=['cuda', 'cpu'])
+    parser.add_argument('--amp', default=None, choices=['fp16', 'bf16'],
+                        help="Run the network with automatic mixed precision in the given data type. "
+                        "Use bf16 on the CPU")
+    parser.add_argument('--shards', default=1, type=int,
+                        help="Number of processes the test set is split across. "
+                        "With cuda, shards are assigned to the visible GPUs in turn")
     
     args = parser.parse_args()
     print(args)
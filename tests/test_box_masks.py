@@ -0,0 +1,109 @@
+import pytest
+import torch
+
+from clip.model import box_area_mask, find_det_mask, find_det_mask_with_area
+
+
+def reference_mask(box_coords, L, patch_size):
+    """Per-box loop computing the patch coverage of find_det_mask_with_area before vectorisation"""
+    batch_size = box_coords.shape[0]
+    det_mask = torch.zeros([batch_size, 1, L])
+    det_mask[:, 0, 0] = 1
+    width = int(L**0.5)
+    box_coords_normed = box_coords/patch_size
+    box_coords_int = torch.cat([torch.floor(box_coords_normed[:, :2]), torch.ceil(box_coords_normed[:, 2:])], dim=1).clip(0, width)
+    box_coords_area_wh = 1 - torch.abs(box_coords_int - box_coords_normed)
+    for b_i, (box_coord_area_wh, box_coord_int) in enumerate(zip(box_coords_area_wh, box_coords_int)):
+        a = int(box_coord_int[0])
+        b = int(box_coord_int[1])
+        c = int(box_coord_int[2])
+        d = int(box_coord_int[3])
+        x, y, z, w = box_coord_area_wh.unsqueeze(1)
+
+        row = torch.arange(width*b+a+1, width*b+c+1)
+        mask_index = row.repeat(d-b) + torch.arange(d-b).repeat_interleave(c-a) * width
+
+        if c-a == 1 and d-b == 1:
+            mask_area = (x+z-1) * (y+w-1)
+        elif c-a == 1:
+            mask_area = (x+z-1) * torch.cat([y, torch.ones(d-b-2), w])
+        elif d-b == 1:
+            mask_area = (y+w-1) * torch.cat([x, torch.ones(c-a-2), z])
+        else:
+            area_row = torch.cat([x, torch.ones(c-a-2), z])
+            area_column = torch.cat([y, torch.ones(d-b-2), w])
+            mask_area = area_row.unsqueeze(0) * area_column.unsqueeze(1)
+
+        det_mask[b_i, 0, mask_index] = mask_area.view(-1)
+    return det_mask
+
+
+def random_boxes(n, patch_size, case):
+    if case == 'grid':
+        xy = torch.randint(0, 672 // patch_size - 4, (n, 2)).float() * patch_size
+        wh = torch.randint(1, 4, (n, 2)).float() * patch_size
+    elif case == 'sub_patch':
+        # Within or across the border of two patches
+        xy = torch.rand(n, 2) * (672 - patch_size)
+        wh = torch.rand(n, 2) * patch_size
+    elif case == 'out_of_image':
+        xy = torch.rand(n, 2) * 800 - 100
+        wh = torch.rand(n, 2) * 200 + 2 * patch_size
+        # Keep at least one patch of each box within the image
+        xy = torch.maximum(xy, patch_size - wh).clamp(max=672 - patch_size)
+    else:
+        xy = torch.rand(n, 2) * 400
+        wh = torch.rand(n, 2) * 250 + 1
+    return torch.cat([xy, xy + wh], 1)
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+@pytest.mark.parametrize('case', ['grid', 'sub_patch', 'out_of_image', 'random'])
+def test_box_area_mask(patch_size, case):
+    torch.manual_seed(0)
+    L = 1 + (672 // patch_size) ** 2
+    boxes = random_boxes(64, patch_size, case)
+    ref = reference_mask(boxes, L, patch_size)
+    assert torch.equal(box_area_mask(boxes, L, patch_size), ref[:, 0, 1:])
+    assert torch.equal(find_det_mask_with_area([boxes[:40], boxes[40:]], L, patch_size, 12), ref)
+    assert torch.equal(find_det_mask([boxes[:40], boxes[40:]], L, patch_size, 12), torch.ceil(ref))
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+def test_pair_boxes(patch_size):
+    torch.manual_seed(0)
+    L = 1 + (672 // patch_size) ** 2
+    boxes = torch.cat([random_boxes(30, patch_size, 'random'), random_boxes(30, patch_size, 'sub_patch')], 1)
+    ref = (reference_mask(boxes[:, :4], L, patch_size) + reference_mask(boxes[:, 4:], L, patch_size)).clip(0, 1)
+    assert torch.equal(find_det_mask_with_area([boxes[:10], boxes[10:]], L, patch_size, 12), ref)
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+def test_pose_boxes(patch_size):
+    torch.manual_seed(0)
+    L = 1 + (672 // patch_size) ** 2
+    n_h, n = 3, 4
+    # Pose boxes are a fixed size around each joint and may leave the image
+    joints = torch.rand(n_h, 17, 2) * 700 - 14
+    boxes = torch.cat([joints - 24, joints + 24], 2)
+    weights = torch.rand(n_h * n, 17)
+    ref = reference_mask(boxes.reshape(-1, 4), L, patch_size).reshape(n_h, 17, 1, L)
+    ref = torch.sum(ref.repeat_interleave(n, dim=0) * weights[..., None, None], dim=1).clip(1e-9, )
+    assert torch.equal(find_det_mask_with_area([boxes], L, patch_size, 12, weights), ref)
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+def test_boxes_spanning_no_patch(patch_size):
+    L = 1 + (672 // patch_size) ** 2
+    boxes = torch.tensor([
+        # Outside the image
+        [700., 100., 800., 200.],
+        [100., -90., 200., -10.],
+        # Zero width on a patch border
+        [2. * patch_size, 100., 2. * patch_size, 200.],
+    ])
+    # The per-box loop fails on these boxes, which now cover no patch
+    for box in boxes:
+        with pytest.raises(RuntimeError):
+            reference_mask(box[None], L, patch_size)
+    assert torch.equal(box_area_mask(boxes, L, patch_size), torch.zeros(len(boxes), L - 1))
@@ -0,0 +1,35 @@
+import numpy as np
+
+from evaluation import compute_ap_11p
+
+
+def reference_ap_11p(scores, labels, num_gt):
+    order = np.argsort(-scores, kind='stable')
+    tp = np.cumsum(labels[order])
+    fp = np.cumsum(1 - labels[order])
+    prec = tp / (tp + fp)
+    rec = tp / num_gt
+    ap = 0.
+    for t in np.linspace(0, 1, 11):
+        ap += prec[rec >= t].max() / 11 if np.any(rec >= t) else 0.
+    return ap, rec[-1]
+
+
+def test_trailing_classes_without_detections():
+    rng = np.random.default_rng(0)
+    num_cls = 6
+    # The last classes, and one in between, have no detections
+    classes = rng.choice([0, 1, 3], 40)
+    scores = rng.random(40)
+    labels = (rng.random(40) < 0.5).astype(np.float64)
+    num_gt = np.array([30, 30, 5, 30, 5, 5])
+
+    ap, max_rec = compute_ap_11p(scores, classes, labels, num_gt)
+    for c in range(num_cls):
+        keep = classes == c
+        if not np.any(keep):
+            assert ap[c] == 0 and max_rec[c] == 0
+            continue
+        ref_ap, ref_rec = reference_ap_11p(scores[keep], labels[keep], num_gt[c])
+        assert np.isclose(ap[c], ref_ap)
+        assert np.isclose(max_rec[c], ref_rec)
@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from interaction_head import GraphHead
+
+
+def random_image(n_h, n_o, channels, human_idx=49):
+    n = n_h + n_o
+    xy = torch.rand(n, 2) * 400
+    labels = torch.randint(0, 79, (n,))
+    labels[labels >= human_idx] += 1
+    labels[:n_h] = human_idx
+    return dict(
+        box_coords=torch.cat([xy, xy + torch.rand(n, 2) * 250 + 8], 1),
+        box_labels=labels, box_scores=torch.rand(n),
+        box_features=torch.rand(n, channels),
+        pose_box_features=torch.rand(n_h * 17, channels, 5, 5),
+        pose_heatmaps=torch.zeros(n_h, 17, 1, 1),
+        human_joints=torch.rand(n_h, 17, 2) * 600,
+        human_joints_score=torch.rand(n_h, 17),
+    )
+
+
+def run(head, images, channels=256):
+    with torch.no_grad():
+        return head(
+            features={'global': torch.stack([image['global'] for image in images])},
+            image_shapes=[(672, 672)] * len(images),
+            box_features=torch.cat([image['box_features'] for image in images]),
+            pose_box_features=torch.cat([image['pose_box_features'] for image in images]),
+            box_coords=[image['box_coords'] for image in images],
+            box_labels=[image['box_labels'] for image in images],
+            box_scores=[image['box_scores'] for image in images],
+            pose_heatmaps=[image['pose_heatmaps'] for image in images],
+            # Joints are clipped to the image in place
+            human_joints=[image['human_joints'].clone() for image in images],
+            human_joints_score=[image['human_joints_score'] for image in images],
+        )[0]
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_skipped_images_keep_feature_offsets(batched):
+    torch.manual_seed(0)
+    channels = 256
+    object_to_target = [torch.randint(0, 117, (3,)).tolist() for _ in range(80)]
+    head = GraphHead(
+        list(range(117)), None, channels, 5, 1024, 1024, 117, 49,
+        object_to_target, None, backbone_name='CLIP_CLS',
+        pose=True, local_pose=True, batched=batched
+    ).eval()
+    # The second image has a single box, the fourth no human, so both are skipped
+    images = [random_image(n_h, n_o, channels) for n_h, n_o in [(2, 3), (1, 0), (3, 2), (0, 2), (1, 4)]]
+    for image in images:
+        image['global'] = torch.rand(channels)
+
+    batch = run(head, images)
+    for image, result in zip(images, batch):
+        alone = run(head, [image])[0]
+        assert result.shape == alone.shape
+        assert torch.allclose(result, alone, atol=1e-5)
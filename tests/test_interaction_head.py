@@ -0,0 +1,50 @@
+import pytest
+import torch
+from collections import OrderedDict
+
+from models import SpatiallyConditionedGraph as SCG
+from test_graph_head import random_image
+
+
+@pytest.fixture(scope='module')
+def head():
+    torch.manual_seed(0)
+    object_to_target = [torch.randint(0, 117, (3,)).tolist() for _ in range(80)]
+    net = SCG(object_to_target, None, None, None, 49, backbone_name='CLIP_CLS',
+        pretrained=False, output_size=5, pose=True, warp=True, local_pose=True)
+    return net.interaction_head.eval()
+
+
+def run(head, images):
+    with torch.no_grad():
+        return head.forward_features(
+            features=OrderedDict([('global', torch.stack([image['global'] for image in images]))]),
+            image_shapes=[(672, 672)] * len(images),
+            box_features=torch.cat([image['box_features'] for image in images]),
+            pose_box_features=torch.cat([image['pose_box_features'] for image in images]),
+            box_coords=[image['box_coords'] for image in images],
+            box_labels=[image['box_labels'] for image in images],
+            box_scores=[image['box_scores'] for image in images],
+            pose_heatmaps=[image['pose_heatmaps'] for image in images],
+            # Joints are clipped to the image in place
+            human_joints=[image['human_joints'].clone() for image in images],
+            human_joints_score=[image['human_joints_score'] for image in images],
+        )
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_mixed_batch_without_targets(head, batched):
+    head.box_pair_head.batched = batched
+    torch.manual_seed(1)
+    # The second image has a single box and the fourth no human, so both are skipped
+    images = [random_image(n_h, n_o, 768) for n_h, n_o in [(2, 3), (1, 0), (3, 2), (0, 2)]]
+    for image in images:
+        image['global'] = torch.rand(768)
+
+    results = run(head, images)
+    assert len(results) == len(images)
+    for image, result in zip(images, results):
+        assert 'labels' not in result
+        alone = run(head, [image])[0]
+        for key in ('boxes_h', 'boxes_o', 'index', 'prediction', 'scores'):
+            assert torch.allclose(result[key].float(), alone[key].float(), atol=1e-5)
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from clip.model import Transformer, find_det_mask_with_area
+
+
+def repeated_last_block(block, x, log_mask, box_image):
+    """
+    Masked class token attention of the last block with the scores, values and
+    class tokens repeated for each box, as before the masks were broadcast
+    """
+    heads = block.attn.num_heads
+    h = block.ln_1(x)[:, box_image]
+    out = block.attn(h[:1], h, h, need_weights=False,
+        attn_mask=log_mask.repeat_interleave(heads, dim=0))[0]
+    out = x[:1, box_image] + out
+    return out + block.mlp(block.ln_2(out))
+
+
+@pytest.fixture(scope='module')
+def transformer():
+    torch.manual_seed(0)
+    return Transformer(64, 2, 4).eval()
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+def test_boxes_of_images(transformer, patch_size):
+    torch.manual_seed(0)
+    L = 1 + (672 // patch_size) ** 2
+    # Uneven box counts, including an image without boxes
+    box_len = [5, 1, 0, 3]
+    box_coords = []
+    for n in box_len:
+        xy = torch.rand(n, 2) * 400
+        box_coords.append(torch.cat([xy, xy + torch.rand(n, 2) * 250 + 8], 1))
+    x = torch.rand(L, len(box_len), 64)
+    with torch.no_grad():
+        out = transformer(x, patch_size, box_coords)
+        tokens = transformer.forward_tokens(x)
+        log_mask = torch.log(find_det_mask_with_area(box_coords, L, patch_size, 4))
+        box_image = torch.arange(len(box_len)).repeat_interleave(torch.as_tensor(box_len))
+        ref = repeated_last_block(transformer.resblocks[-1], tokens, log_mask, box_image)
+    assert out['x'].shape == (1, sum(box_len), 64)
+    assert torch.allclose(out['x'], ref, atol=1e-5)
+
+
+@pytest.mark.parametrize('patch_size', [16, 32])
+def test_pose_boxes(transformer, patch_size):
+    torch.manual_seed(0)
+    L = 1 + (672 // patch_size) ** 2
+    n_h, n = 3, 4
+    joints = torch.rand(n_h, 17, 2) * 600
+    box_coords = [torch.cat([joints - 24, joints + 24], 2)]
+    weights = torch.rand(n_h * n, 17).softmax(1)
+    x = torch.rand(L, 1, 64)
+    with torch.no_grad():
+        out = transformer(x, patch_size, box_coords, weights)
+        tokens = transformer.forward_tokens(x)
+        log_mask = torch.log(find_det_mask_with_area(box_coords, L, patch_size, 4, weights))
+        ref = repeated_last_block(transformer.resblocks[-1], tokens, log_mask,
+            torch.zeros(n_h * n, dtype=torch.long))
+    assert out['x'].shape == (1, n_h * n, 64)
+    assert torch.allclose(out['x'], ref, atol=1e-5)
@@ -0,0 +1,109 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from interaction_head import MultiBranchFusion, MessageMBF
+
+
+class BranchMBF(nn.Module):
+    """Multi-branch fusion running one branch at a time, as before the fusion of the branches"""
+    def __init__(self, appearance_size, spatial_size, representation_size, cardinality):
+        super().__init__()
+        sub_repr_size = representation_size // cardinality
+        self.fc_1 = nn.ModuleList([nn.Linear(appearance_size, sub_repr_size) for _ in range(cardinality)])
+        self.fc_2 = nn.ModuleList([nn.Linear(spatial_size, sub_repr_size) for _ in range(cardinality)])
+        self.fc_3 = nn.ModuleList([nn.Linear(sub_repr_size, representation_size) for _ in range(cardinality)])
+    def messages(self, appearance, spatial):
+        return torch.stack([
+            fc_3(F.relu(fc_1(appearance) * fc_2(spatial)))
+            for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
+        ]).sum(dim=0)
+    def forward(self, appearance, spatial):
+        return F.relu(self.messages(appearance, spatial))
+    def human_messages(self, appearance, spatial):
+        n_h, n = spatial.shape[:2]
+        return self.messages(appearance.repeat(n, 1, 1), spatial.permute([1, 0, 2]))
+    def object_messages(self, appearance, spatial):
+        n_h, n = spatial.shape[:2]
+        return self.messages(appearance.repeat(n_h, 1, 1), spatial)
+    def object_local_pose_messages(self, local_feature, appearance, spatial):
+        n_h, n = spatial.shape[:2]
+        return self.messages(torch.cat([local_feature, appearance.repeat(n_h, 1, 1)], dim=2), spatial)
+
+
+def load_branches(module, *args):
+    """Load the weights of a per-branch module into the given fused one"""
+    torch.manual_seed(0)
+    reference = BranchMBF(*args)
+    # Checkpoints hold one linear layer per branch
+    module.load_state_dict(reference.state_dict(), strict=True)
+    return reference
+
+
+def test_mbf():
+    mbf = MultiBranchFusion(64, 32, 256, 16)
+    reference = load_branches(mbf, 64, 32, 256, 16)
+    appearance, spatial = torch.rand(40, 64), torch.rand(40, 32)
+    with torch.no_grad():
+        assert torch.allclose(mbf(appearance, spatial), reference(appearance, spatial), atol=1e-5)
+
+
+def test_message_mbf():
+    n_h, n = 3, 7
+    appearance_h, appearance, spatial = torch.rand(n_h, 64), torch.rand(n, 64), torch.rand(n_h, n, 32)
+    human = MessageMBF(64, 32, 256, 'human', 16)
+    obj = MessageMBF(64, 32, 256, 'object', 16)
+    reference = load_branches(human, 64, 32, 256, 16)
+    obj.load_state_dict(reference.state_dict())
+    with torch.no_grad():
+        ref_h = reference.human_messages(appearance_h, spatial)
+        ref_o = reference.object_messages(appearance, spatial)
+        assert torch.allclose(human(appearance_h, spatial), ref_h, atol=1e-5)
+        assert torch.allclose(obj(appearance, spatial), ref_o, atol=1e-5)
+
+        # Messages of a flat list of pairs, e.g. the pairs kept of each image
+        x, y = torch.randint(0, n_h, (10,)), torch.randint(0, n, (10,))
+        assert torch.allclose(human.forward_pairs(
+            human.project_appearance(appearance_h)[x], spatial[x, y]), ref_h[y, x], atol=1e-5)
+        assert torch.allclose(obj.forward_pairs(
+            obj.project_appearance(appearance)[y], spatial[x, y]), ref_o[x, y], atol=1e-5)
+
+
+def test_message_mbf_local_pose():
+    n_h, n = 3, 7
+    local_feature, appearance, spatial = torch.rand(n_h, n, 48), torch.rand(n, 16), torch.rand(n_h, n, 32)
+    mbf = MessageMBF(64, 32, 256, 'object_local_pose', 16)
+    reference = load_branches(mbf, 64, 32, 256, 16)
+    with torch.no_grad():
+        assert torch.allclose(mbf(local_feature, appearance, spatial),
+            reference.object_local_pose_messages(local_feature, appearance, spatial), atol=1e-5)
+
+
+def test_pair_attention():
+    n_h, n = 3, 7
+    h_node_encodings, node_encodings = torch.rand(n_h, 32), torch.rand(n, 32)
+    global_features, spatial = torch.rand(64), torch.rand(n_h, n, 32)
+    attention_head = MultiBranchFusion(64, 32, 256, 16)
+    attention_head_g = MultiBranchFusion(64, 32, 256, 16)
+    reference = load_branches(attention_head, 64, 32, 256, 16)
+    reference_g = load_branches(attention_head_g, 64, 32, 256, 16)
+    with torch.no_grad():
+        # Attention on the concatenated encodings of the nodes of every pair
+        ref = reference(torch.cat([
+            h_node_encodings[:, None].expand(-1, n, -1),
+            node_encodings[None].expand(n_h, -1, -1)
+        ], 2), spatial)
+        # Encodings projected once per node and summed for each pair, as in GraphHead
+        h_projected = attention_head.project_appearance(h_node_encodings)
+        projected = attention_head.project_appearance(node_encodings, h_node_encodings.shape[1], bias=False)
+        assert torch.allclose(attention_head.forward_projected(
+            h_projected[:, None] + projected[None], spatial), ref, atol=1e-5)
+
+        x, y = torch.randint(0, n_h, (10,)), torch.randint(0, n, (10,))
+        assert torch.allclose(attention_head.forward_projected(
+            h_projected[x] + projected[y], spatial[x, y]), ref[x, y], atol=1e-5)
+        # Global features are projected once per image
+        assert torch.allclose(attention_head_g.forward_projected(
+            attention_head_g.project_appearance(global_features[None]), spatial[x, y]),
+            reference_g(global_features[None].expand(10, -1), spatial[x, y]), atol=1e-5)
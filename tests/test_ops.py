@@ -0,0 +1,54 @@
+import cv2
+import pytest
+import torch
+import numpy as np
+from PIL import Image
+
+from ops import get_warp_matrices, warpaffine_image, warpaffine_images, \
+    transform_preds, transform_preds_batched
+
+IMAGE_SIZES = [(480, 640), (640, 427), (500, 500), (333, 1000), (55, 603), (1098, 756)]
+
+
+def test_get_warp_matrices():
+    trans, center, scale = get_warp_matrices(torch.as_tensor(IMAGE_SIZES), 672)
+    for (h, w), t, c, s in zip(IMAGE_SIZES, trans, center, scale):
+        _, ref, meta = warpaffine_image(Image.new('RGB', (w, h)), 672, 'cpu')
+        assert torch.equal(t, ref)
+        assert torch.equal(c, meta['center'])
+        assert torch.equal(s, meta['scale'])
+
+
+def test_warpaffine_images():
+    torch.manual_seed(0)
+    images = [torch.rand(3, h, w) for h, w in IMAGE_SIZES]
+    warped, trans, _, _ = warpaffine_images(images, 672)
+    assert torch.equal(trans, get_warp_matrices(torch.as_tensor(IMAGE_SIZES), 672)[0])
+    for image, x, t in zip(images, warped, trans):
+        ref = cv2.warpAffine(image.permute(1, 2, 0).numpy() * 255, t.numpy(),
+            (672, 672), flags=cv2.INTER_LINEAR)
+        # cv2 quantises the sampling positions to 1/32 pixel. On uniform
+        # noise, the largest difference measured is 0.055 intensity levels
+        assert np.abs(x.permute(1, 2, 0).numpy() * 255 - ref).max() < 0.1
+
+
+def test_warpaffine_images_uint8():
+    torch.manual_seed(0)
+    h, w = IMAGE_SIZES[0]
+    image = torch.randint(0, 256, (h, w, 3), dtype=torch.uint8)
+    ref, _, _ = warpaffine_image(Image.fromarray(image.numpy()), 672, 'cpu')
+    warped = warpaffine_images([image.permute(2, 0, 1) / 255.], 672)[0][0]
+    # The cv2 warp of uint8 images is also rounded to the nearest level
+    assert np.abs(warped.permute(1, 2, 0).numpy() * 255 - ref).max() < 0.6
+
+
+@pytest.mark.parametrize('use_udp', [False, True])
+def test_transform_preds_batched(use_udp):
+    torch.manual_seed(0)
+    _, center, scale = get_warp_matrices(torch.as_tensor(IMAGE_SIZES), 672)
+    batch_idx = torch.randint(0, len(IMAGE_SIZES), (20,))
+    coords = torch.rand(20, 17, 2) * 672
+    out = transform_preds_batched(coords, center, scale, [672, 672], batch_idx, use_udp)
+    for x, i, y in zip(coords, batch_idx, out):
+        ref = transform_preds(x, center[i], scale[i], [672, 672], use_udp)
+        assert torch.allclose(y, ref, rtol=0, atol=1e-3)
@@ -0,0 +1,302 @@
+"""
+Train the interaction head on backbone features computed once
+
+    python train_head.py --model-path checkpoints/ckpt.pt extract --partition train2015 \
+        --append-gt --flip --detection-dir hicodet/detections/train2015_vitpose \
+        --dst hicodet/features/train2015 --pose --warp --local_pose --pose_cls --patch-size 16
+    python train_head.py --model-path checkpoints/ckpt.pt extract --partition test2015 \
+        --detection-dir hicodet/detections/test2015_vitpose \
+        --dst hicodet/features/test2015 --pose --warp --local_pose --pose_cls --patch-size 16
+    python train_head.py --model-path checkpoints/ckpt.pt train \
+        --train-store hicodet/features/train2015 --val-store hicodet/features/test2015
+"""
+
+import os
+import time
+import torch
+import argparse
+import numpy as np
+from tqdm import tqdm
+from collections import OrderedDict
+from torch.utils.data import Dataset, DataLoader
+
+import pocket
+from pocket.utils import DetectionAPMeter
+
+from models import SpatiallyConditionedGraph as SCG
+from store import HeadFeatureStore
+from hicodet.hicodet import HICODet
+from utils import DataFactory, custom_collate, load_checkpoint
+
+def build_network(args, hoi, settings):
+    """
+    Build a CLIP_CLS network at 672px without the pretrained CLIP weights. The
+    backbone weights are loaded from --model-path, the head is initialised anew
+    """
+    net = SCG(
+        hoi.object_to_verb, hoi.object_n_verb_to_interaction, hoi.object_to_interaction,
+        hoi.verbs, 49, num_classes=117, backbone_name='CLIP_CLS', pretrained=False,
+        output_size=args.roi_size, num_iterations=args.num_iter, postprocess=False,
+        **settings
+    )
+    if os.path.exists(args.model_path):
+        checkpoint = torch.load(args.model_path, map_location='cpu', mmap=True)
+        net.backbone.load_state_dict({
+            k[len('backbone.'):]: v for k, v in checkpoint['model_state_dict'].items()
+            if k.startswith('backbone.')
+        }, assign=True)
+    else:
+        assert not settings['pose_cls'], \
+            "The last block of the backbone pools the pose boxes with pose_cls"
+        print("\nWARNING: The given model path does not exist. "
+            "The backbone is left uninitialised.\n")
+    return net
+
+@torch.no_grad()
+def extract_records(net, dataloader, device, append_gt):
+    """
+    Yield the record of each image, as stored by HeadFeatureStore, in the order of
+    the dataloader. Boxes are kept and ordered by InteractionHead.preprocess
+    """
+    head = net.interaction_head
+    for batch in tqdm(dataloader):
+        images, detections, targets = pocket.ops.relocate_to_device(batch, device)
+        images, detections, targets, _, _ = net.preprocess(images, detections, targets)
+        image_shapes = [img.shape[-2:] for img in images]
+        detections = head.preprocess(detections, targets, append_gt=append_gt)
+
+        box_coords = [det['boxes'] for det in detections]
+        box_labels = [det['labels'] for det in detections]
+        human_joints = [det.get('human_joints') for det in detections]
+        features = OrderedDict()
+        box_features, pose_box_features, pose_box_coords, tokens = head.encode_boxes(
+            features, image_shapes, box_coords, box_labels, human_joints, images)
+
+        box_offset = 0; human_offset = 0
+        for b_idx, (det, target) in enumerate(zip(detections, targets)):
+            n = len(det['boxes'])
+            record = dict(
+                boxes=det['boxes'], labels=det['labels'], scores=det['scores'],
+                box_features=box_features[box_offset: box_offset + n],
+                global_features=features['global'][b_idx],
+                boxes_h=target['boxes_h'].reshape(-1, 4),
+                boxes_o=target['boxes_o'].reshape(-1, 4),
+                verbs=target['labels'].reshape(-1)
+            )
+            box_offset += n
+            if head.pose:
+                n_h = len(det['human_joints'])
+                record['human_joints'] = det['human_joints']
+                record['human_joints_score'] = det['human_joints_score']
+                if head.local_pose and head.pose_cls:
+                    # The masks of the pose boxes are weighted by the head, so the
+                    # last block of the backbone is run again during training
+                    record['tokens'] = tokens[:, b_idx]
+                    record['pose_boxes'] = pose_box_coords[b_idx].reshape(n_h, 17, 4)
+                elif head.local_pose:
+                    record['pose_features'] = pose_box_features[
+                        human_offset * 17: (human_offset + n_h) * 17
+                    ].reshape(n_h, 17, *pose_box_features.shape[1:])
+                human_offset += n_h
+            yield record
+
+def extract(args):
+    dataset = DataFactory(
+        name='hicodet', partition=args.partition,
+        data_root=args.data_root, detection_root=args.detection_dir,
+        flip=args.flip, backbone_name='CLIP_CLS', pose=args.pose,
+        packed_anno=args.packed_anno, preprocess=True, warp=args.warp
+    )
+    # Images are stored in the order of the dataset
+    dataloader = DataLoader(
+        dataset=dataset, collate_fn=custom_collate, batch_size=args.batch_size,
+        num_workers=args.num_workers, pin_memory=args.device == 'cuda'
+    )
+    settings = dict(
+        box_score_thresh=args.box_score_thresh, max_human=args.max_human,
+        max_object=args.max_object, patch_size=args.patch_size, pose=args.pose,
+        warp=args.warp, local_pose=args.local_pose, pose_cls=args.pose_cls
+    )
+    device = torch.device(args.device)
+    net = build_network(args, dataset.dataset, settings).to(device).eval()
+    HeadFeatureStore.pack(
+        extract_records(net, dataloader, device, args.append_gt),
+        [dataset.dataset.filename(i) for i in range(len(dataset))],
+        args.dst, args.shard_size, settings=settings, append_gt=args.append_gt,
+        flip=dataset._flip.long().tolist(), n_px=672, model_path=args.model_path
+    )
+
+class HeadFeatures(Dataset):
+    """Records of a HeadFeatureStore"""
+    def __init__(self, store):
+        self.store = store
+    def __len__(self):
+        return len(self.store)
+    def __getitem__(self, i):
+        return self.store.get(i)
+
+def _records(batch):
+    return batch
+
+def head_inputs(records, n_px, device):
+    """Arguments of InteractionHead.forward_features for a batch of records"""
+    records = [pocket.ops.relocate_to_device(r, device) for r in records]
+    pose = 'human_joints' in records[0]
+    pose_features = None; tokens = None; pose_boxes = None
+    if 'tokens' in records[0]:
+        tokens = torch.stack([r['tokens'] for r in records], dim=1).float()
+        pose_boxes = [r['pose_boxes'].reshape(-1, 4) for r in records]
+    if 'pose_features' in records[0]:
+        pose_features = torch.cat([r['pose_features'] for r in records]).float()
+        if pose_features.dim() == 5:
+            # Pooled pose box features, (17H, C, P, P) as RoI pooling returns them
+            pose_features = pose_features.flatten(0, 1)
+    return dict(
+        features=OrderedDict(
+            [('global', torch.stack([r['global_features'] for r in records]).float())]),
+        image_shapes=[torch.Size([n_px, n_px]) for _ in records],
+        box_features=torch.cat([r['box_features'] for r in records]).float(),
+        pose_box_features=pose_features,
+        box_coords=[r['boxes'] for r in records],
+        box_labels=[r['labels'] for r in records],
+        box_scores=[r['scores'] for r in records],
+        # Heatmaps are only checked for their size
+        pose_heatmaps=[r['human_joints'][:, :0] if pose else None for r in records],
+        human_joints=[r['human_joints'] if pose else None for r in records],
+        human_joints_score=[r['human_joints_score'] if pose else None for r in records],
+        targets=[dict(boxes_h=r['boxes_h'], boxes_o=r['boxes_o'], labels=r['verbs'])
+            for r in records],
+        pose_box_coords=pose_boxes, tokens=tokens
+    )
+
+def log_results(results, meter):
+    meter.append(
+        torch.cat([r['scores'].detach() for r in results]).cpu(),
+        torch.cat([r['prediction'] for r in results]).cpu().float(),
+        torch.cat([r['labels'] for r in results]).cpu()
+    )
+
+@torch.no_grad()
+def validate(head, dataloader, n_px, device):
+    head.eval()
+    meter = DetectionAPMeter(head.num_classes, algorithm='11P')
+    for records in dataloader:
+        log_results(head.forward_features(**head_inputs(records, n_px, device)), meter)
+    return meter.eval()
+
+def train(args):
+    torch.manual_seed(args.random_seed)
+    trainset = HeadFeatureStore(args.train_store)
+    meta = trainset.meta
+    # Only the mappings between objects, verbs and interactions are needed
+    hoi = HICODet(
+        root=os.path.join(args.data_root, 'hico_20160224_det/images/train2015'),
+        anno_file=os.path.join(args.data_root, 'instances_train2015_vitpose.json'),
+        packed=args.packed_anno
+    )
+    device = torch.device(args.device)
+    net = build_network(args, hoi, meta['settings']).to(device)
+    head = net.interaction_head
+    train_loader = DataLoader(HeadFeatures(trainset), collate_fn=_records,
+        batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    val_loader = None
+    if args.val_store is not None:
+        valset = HeadFeatureStore(args.val_store)
+        assert valset.meta['settings'] == meta['settings'], \
+            "Features were extracted with different settings"
+        val_loader = DataLoader(HeadFeatures(valset), collate_fn=_records,
+            batch_size=args.batch_size, num_workers=args.num_workers)
+
+    # The backbone is fixed. With pose_cls, its last block pools the pose boxes
+    net.backbone.requires_grad_(False)
+    params = [p for name, p in head.named_parameters()
+        if not name.startswith('backbone.') and '.backbone.' not in name]
+    optim = torch.optim.AdamW(params, lr=args.learning_rate, weight_decay=args.weight_decay)
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optim,
+        lambda epoch: 1. if epoch < args.milestones[0] else args.lr_decay)
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    for epoch in range(1, args.num_epochs + 1):
+        head.train()
+        meter = DetectionAPMeter(head.num_classes, algorithm='11P')
+        losses = []
+        t = time.time()
+        for records in train_loader:
+            results = head.forward_features(**head_inputs(records, meta['n_px'], device))
+            loss_dict = results.pop()
+            loss = loss_dict['hoi_loss'] + loss_dict['interactiveness_loss']
+            optim.zero_grad()
+            loss.backward()
+            optim.step()
+            losses.append(loss.item())
+            log_results(results, meter)
+        t = time.time() - t
+        lr_scheduler.step()
+        print("Epoch: {} | loss: {:.4f} | {:.1f} images/s | training mAP: {:.4f}".format(
+            epoch, np.mean(losses), len(trainset) / t, meter.eval().mean().item()), end='')
+        if val_loader is not None:
+            ap = validate(head, val_loader, meta['n_px'], device)
+            print(" | validation mAP: {:.4f}".format(ap.mean().item()), end='')
+        print()
+        torch.save({
+            'model_state_dict': net.state_dict(), 'epoch': epoch,
+            'optim_state_dict': optim.state_dict(),
+            'scheduler_state_dict': lr_scheduler.state_dict()
+        }, os.path.join(args.cache_dir, 'ckpt_{:02d}.pt'.format(epoch)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the interaction head on stored backbone features")
+    parser.add_argument('--data-root', default='hicodet', type=str)
+    parser.add_argument('--packed-anno', action='store_true',
+                        help="Load annotations from memory-mapped arrays instead of json")
+    parser.add_argument('--model-path', default='', type=str,
+                        help="Checkpoint of the fixed backbone")
+    parser.add_argument('--num-iter', default=2, type=int,
+                        help="Number of iterations to run message passing")
+    parser.add_argument('--roi-size', default=7, type=int)
+    parser.add_argument('--num-workers', default=4, type=int)
+    parser.add_argument('--device', default='cuda', type=str, choices=['cuda', 'cpu'])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ext = subparsers.add_parser('extract',
+        help="Run the backbone once and store the features of the kept boxes")
+    ext.add_argument('--partition', default='train2015', type=str)
+    ext.add_argument('--detection-dir', default='hicodet/detections/train2015_vitpose', type=str)
+    ext.add_argument('--dst', required=True, type=str)
+    ext.add_argument('--append-gt', action='store_true',
+                     help="Append the ground truth boxes to the detections, as in training")
+    ext.add_argument('--flip', action='store_true',
+                     help="Flip the images as DataFactory does in training")
+    ext.add_argument('--box-score-thresh', default=0.2, type=float)
+    ext.add_argument('--max-human', default=15, type=int)
+    ext.add_argument('--max-object', default=15, type=int)
+    ext.add_argument('--patch-size', default=32, type=int)
+    ext.add_argument('--pose', action='store_true')
+    ext.add_argument('--warp', action='store_true')
+    ext.add_argument('--local_pose', action='store_true')
+    ext.add_argument('--pose_cls', action='store_true')
+    ext.add_argument('--batch-size', default=8, type=int)
+    ext.add_argument('--shard-size', default=1000, type=int,
+                     help="Number of images in each file of the store")
+    ext.set_defaults(func=extract)
+
+    tr = subparsers.add_parser('train',
+        help="Train the interaction head from stored features")
+    tr.add_argument('--train-store', required=True, type=str)
+    tr.add_argument('--val-store', default=None, type=str)
+    tr.add_argument('--num-epochs', default=8, type=int)
+    tr.add_argument('--random-seed', default=42, type=int)
+    tr.add_argument('--learning-rate', default=0.0001, type=float)
+    tr.add_argument('--weight-decay', default=1e-4, type=float)
+    tr.add_argument('--batch-size', default=32, type=int)
+    tr.add_argument('--lr-decay', default=0.1, type=float,
+                    help="The multiplier by which the learning rate is reduced")
+    tr.add_argument('--milestones', nargs='+', default=[6,], type=int,
+                    help="The epoch number when learning rate is reduced")
+    tr.add_argument('--cache-dir', type=str, default='./checkpoints/head')
+    tr.set_defaults(func=train)
+
+    args = parser.parse_args()
+    print(args)
+
+    args.func(args)
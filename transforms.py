@@ -1,5 +1,29 @@
+import PIL.Image as im
+
 from torch import nn
 from torchvision.models.detection import transform
+from torchvision.transforms import Compose, Resize, ToTensor, Normalize, ToPILImage
+try:
+    from torchvision.transforms import InterpolationMode
+    BICUBIC = InterpolationMode.BICUBIC
+except ImportError:
+    BICUBIC = im.BICUBIC
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+def _convert_image_to_rgb(image):
+    return image.convert("RGB")
+
+def clip_image_transform(n_px: int = 672):
+    """Resize an image tensor to a square CLIP input and normalise it"""
+    return Compose([
+        ToPILImage(),
+        Resize((n_px, n_px), interpolation=BICUBIC),
+        _convert_image_to_rgb,
+        ToTensor(),
+        Normalize(CLIP_MEAN, CLIP_STD),
+    ])
 
 class HOINetworkTransform(transform.GeneralizedRCNNTransform):
     """
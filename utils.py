@@ -8,7 +8,9 @@ import torch.distributed as dist
 import cv2
 
 
-from torch.utils.data import Dataset
+import queue
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, Sampler, DataLoader
 from torchvision.ops.boxes import box_iou
 from torchvision.transforms.functional import hflip
 from torchvision.transforms import ColorJitter
@@ -19,6 +21,11 @@ from torch.utils.data.dataset import IterableDataset
 from pycocotools.coco import COCO
 
 from hicodet.hicodet import HICODet
+from store import DetectionStore, WarpedImageStore, TokenCache
+from evaluation import HOIEvaluator, associate_box_pairs
+from models import SpatiallyConditionedGraph as SCG
+from ops import warp_image, get_warp_matrices, warp_annotations, resize_annotations
+from transforms import clip_image_transform, CLIP_MEAN, CLIP_STD
 
 from PIL import Image
 import pocket
@@ -44,7 +51,9 @@ class DataFactory(Dataset):
             data_root, detection_root,
             flip=False, color_jitter=False,
             box_score_thresh_h=0.2,
-            box_score_thresh_o=0.2, backbone_name='resnet50', num_classes=117, pose=False
+            box_score_thresh_o=0.2, backbone_name='resnet50', num_classes=117, pose=False,
+            packed_anno=False, warp_cache=None,
+            preprocess=False, warp=False, transform_targets=True
             ):
         
         self.pose = pose
@@ -58,7 +67,8 @@ class DataFactory(Dataset):
             self.dataset = HICODet(
                 root=os.path.join(data_root, 'hico_20160224_det/images', partition),
                 anno_file=os.path.join(data_root, 'instances_{}_vitpose.json'.format(partition)),
-                target_transform=pocket.ops.ToTensor(input_format='dict'), pose=pose
+                target_transform=pocket.ops.ToTensor(input_format='dict'), pose=pose,
+                packed=packed_anno
             )
             self.human_idx = 49
         else:
@@ -81,10 +91,36 @@ class DataFactory(Dataset):
 
         self.name = name
         self.detection_root = detection_root
+        # A packed detection store replaces the per-image json files
+        self.detection_store = DetectionStore(detection_root) \
+            if DetectionStore.exists(detection_root) else None
+        # Images warped ahead of time skip decoding and warping
+        if warp_cache is not None:
+            assert name == 'hicodet' and not flip and not color_jitter, \
+                "Warped images can only be cached for HICO-DET without augmentation"
+            assert warp, "Cached warped images require warp=True"
+            self.warp_store = WarpedImageStore(warp_cache)
+        else:
+            self.warp_store = None
         self.backbone_name = backbone_name
+        # Warp or resize images and transform the detections in the
+        # dataloader workers instead of the network's preprocess
+        if preprocess:
+            assert backbone_name in ['CLIP', 'CLIP_CLS'], \
+                "Worker preprocessing is only supported for CLIP backbones"
+        self.preprocess = preprocess
+        self.warp = warp
+        self.transform_targets = transform_targets
+        self.image_transform = clip_image_transform(672)
+        self.mean = torch.tensor(CLIP_MEAN).view(-1, 1, 1)
+        self.std = torch.tensor(CLIP_STD).view(-1, 1, 1)
         
         self.box_score_thresh_h = box_score_thresh_h
         self.box_score_thresh_o = box_score_thresh_o
+        # Optional store.TokenCache of the tokens leaving the frozen blocks of the
+        # backbone, which replace the preprocessed images, see token_key
+        self.token_store = None
+        # Drawn once, so that each image keeps the same flip in all epochs
         self._flip = torch.randint(0, 2, (len(self.dataset),)) if flip \
             else torch.zeros(len(self.dataset))
         self._brightness = torch.randint(0, 2, (len(self.dataset),)) if color_jitter \
@@ -130,6 +166,58 @@ class DataFactory(Dataset):
 
         return dict(boxes=boxes, labels=labels, scores=scores)
 
+    def load_detection(self, i):
+        """Load the detections of an image from the store or its json file"""
+        filename = self.dataset.filename(i).replace('jpg', 'json')
+        if self.detection_store is not None:
+            return self.detection_store.get(filename, pose=self.pose)
+
+        with open(os.path.join(self.detection_root, filename), 'r') as f:
+            detection = json.load(f)
+        
+        if not self.pose:
+            if 'human_joints' in detection.keys():
+                detection.pop('human_joints')
+                detection.pop('human_joints_score')        
+
+        return pocket.ops.to_tensor(detection, input_format='dict')
+
+    def box_counts(self, score_thresh: float = 0.2, append_gt: bool = False) -> np.ndarray:
+        """
+        Count the boxes of each image that the interaction head keeps before NMS
+
+        Arguments:
+            score_thresh(float): Box score threshold of the interaction head
+            append_gt(bool): If True, count the ground truth boxes appended in training
+        Returns:
+            ndarray: (N, 2) Numbers of human and object boxes of each image
+        """
+        if self.detection_store is not None:
+            counts = self.detection_store.box_counts([
+                self.dataset.filename(i).replace('jpg', 'json') for i in range(len(self))
+            ], self.human_idx, score_thresh)
+        else:
+            counts = np.zeros((len(self), 2), dtype=np.int64)
+            for i in range(len(self)):
+                detection = self.load_detection(i)
+                keep = detection['scores'] >= score_thresh
+                human = detection['labels'] == self.human_idx
+                counts[i] = [(keep & human).sum().item(), (keep & ~human).sum().item()]
+        if append_gt:
+            # Each ground truth pair adds a human and an object box
+            counts += np.asarray([
+                len(self.dataset.get_target(i)['boxes_h']) for i in range(len(self))
+            ], dtype=np.int64)[:, None]
+        return counts
+
+    def token_key(self, i: int) -> str:
+        """Name of an image in its flip state in the token store"""
+        filename = self.dataset.filename(i)
+        if self._flip[i]:
+            stem, ext = os.path.splitext(filename)
+            return stem + '_flip' + ext
+        return filename
+
     def flip_boxes(self, detection, target, w):
         detection['boxes'] = pocket.ops.horizontal_flip_boxes(w, detection['boxes'])
         
@@ -148,8 +236,10 @@ class DataFactory(Dataset):
         target['boxes_o'] = pocket.ops.horizontal_flip_boxes(w, target['boxes_o'])
 
     def __getitem__(self, i):
-        image, target = self.dataset[i]
-        width, height = image.size
+        if self.warp_store is not None or self.token_store is not None:
+            target = pocket.ops.to_tensor(self.dataset.get_target(i), input_format='dict')
+        else:
+            image, target = self.dataset[i]
 
         if self.name == 'hicodet':
             target['labels'] = target['verb']
@@ -163,20 +253,7 @@ class DataFactory(Dataset):
             target['labels'] = target['actions']
             target['object'] = target.pop('objects')
 
-        detection_path = os.path.join(
-            self.detection_root,
-            self.dataset.filename(i).replace('jpg', 'json')
-        )
-
-        with open(detection_path, 'r') as f:
-            detection = json.load(f)
-        
-        if not self.pose:
-            if 'human_joints' in detection.keys():
-                detection.pop('human_joints')
-                detection.pop('human_joints_score')        
-
-        detection = pocket.ops.to_tensor(detection, input_format='dict')
+        detection = self.load_detection(i)
 
         if self.pose:
             human_joint = detection['human_joints']
@@ -189,7 +266,17 @@ class DataFactory(Dataset):
             if human_joint.dim() == 2:
                 human_joint = human_joint.reshape(-1, 17, 2)
             target['human_joints'] = human_joint
-  
+
+        if self.warp_store is not None:
+            image, detection['img_meta'] = self.warp_store.get(self.dataset.filename(i))
+            if self.preprocess:
+                return self.preprocess_inputs(i, image, detection, target)
+            return image, detection, target
+        if self.token_store is not None:
+            # The tokens replace the image, so only its size is needed
+            if self._flip[i]:
+                self.flip_boxes(detection, target, self.dataset.image_size(i)[0])
+            return self.preprocess_inputs(i, None, detection, target)
         
         # random horizaontal flip
         if self._flip[i]:
@@ -208,108 +295,610 @@ class DataFactory(Dataset):
         # random resize_crop 
         
         image = pocket.ops.to_tensor(image, 'pil')
+        if self.preprocess:
+            return self.preprocess_inputs(i, image, detection, target)
         return image, detection, target
 
-def sample(net, test_loader):
+    def preprocess_inputs(self, i, image, detection, target):
+        """
+        Apply the preprocessing of GenericHOINetwork to an image and its annotations
+
+        The returned image is normalised and of size 672x672. The detections carry
+        `img_meta` with the original image size, which tells the network to skip
+        its own preprocessing. Targets are only transformed if transform_targets is
+        True, as evaluation compares predictions with targets in original coordinates.
+        With a token store, the image is None and its (L, C) tokens are returned in
+        its place.
+        """
+        target_ = target if self.transform_targets else None
+        size = (672, 672)
+        if 'img_meta' in detection:
+            # Image warped ahead of time in uint8
+            img_meta = detection['img_meta']
+            trans = img_meta.pop('trans')
+            w, h = self.dataset.image_size(i)
+            original_size = (h, w)
+            image = image.float().div(255)
+        elif image is None:
+            # Same transform as for the image, computed from its size alone
+            w, h = self.dataset.image_size(i)
+            original_size = (h, w)
+            img_meta = dict()
+            if self.warp:
+                trans, center, scale = get_warp_matrices(torch.as_tensor([original_size]), 672)
+                trans = trans[0]
+                img_meta = dict(center=center[0], scale=scale[0], n_px=torch.as_tensor(672))
+        else:
+            original_size = tuple(image.shape[-2:])
+            if self.warp:
+                image, trans, img_meta = warp_image(image, n_px=672, device='cpu')
+                image = torch.from_numpy(image).permute(2, 0, 1).float().div(255)
+                img_meta['n_px'] = torch.as_tensor(img_meta['n_px'])
+            else:
+                image = self.image_transform(image)
+                img_meta = dict()
+        if self.warp:
+            if image is not None:
+                image = image.sub_(self.mean).div_(self.std)
+            warp_annotations(detection, target_, trans, self.human_idx, self.pose)
+        else:
+            resize_annotations(detection, target_, original_size,
+                size, self.human_idx, self.pose)
+        img_meta['original_size'] = torch.as_tensor(original_size)
+        detection['img_meta'] = img_meta
+        if self.token_store is not None:
+            image = self.token_store.get(self.token_key(i))
+            if image is None:
+                raise KeyError("Tokens of {} are missing from {}".format(
+                    self.token_key(i), self.token_store.dir))
+        return image, detection, target
+
+def load_checkpoint(net, path):
+    """
+    Load the weights of a checkpoint into a network and return the checkpoint
+
+    The checkpoint is memory-mapped and its tensors are assigned to the network
+    instead of being copied into it, so that the weights are held in host memory
+    once. The network can thus be built without initialising its weights, e.g.
+    SpatiallyConditionedGraph with pretrained=False
+    """
+    checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    net.load_state_dict(checkpoint['model_state_dict'], assign=True)
+    return checkpoint
+
+@torch.no_grad()
+def cache_frozen_tokens(backbone, dataset, store, blocks, rank=0, num_replicas=1,
+        batch_size=8, num_workers=4, device='cuda'):
+    """
+    Write the tokens leaving the first blocks of a CLIP backbone to a token store,
+    for each image of a dataset in its flip state, see DataFactory.token_key
+
+    The missing entries are split across processes in turn, as DistributedSampler
+    does without shuffling. After all processes are done, each one writes the
+    entries it still cannot find, so that it can train from the store on its own
+    """
+    assert dataset.preprocess and dataset.token_store is None, \
+        "Tokens are encoded from images preprocessed in the dataloader"
+    missing = [i for i in range(len(dataset)) if dataset.token_key(i) not in store]
+    for pass_idx in range(2):
+        if pass_idx == 0:
+            indices = missing[rank::num_replicas]
+        else:
+            if num_replicas > 1:
+                dist.barrier()
+            indices = [i for i in missing if dataset.token_key(i) not in store]
+        loader = DataLoader(dataset, batch_size=batch_size, sampler=indices,
+            num_workers=num_workers, collate_fn=custom_collate)
+        keys = iter([dataset.token_key(i) for i in indices])
+        for images, _, _ in tqdm(loader, disable=rank != 0 or not len(indices)):
+            tokens = backbone.encode_tokens(torch.stack(images).to(device), blocks)
+            # Tokens come first, so that no key is drawn past the end of the batch
+            for t, key in zip(tokens.unbind(1), keys):
+                store.put(key, t)
+
+def sample(net, test_loader, device='cuda'):
     result = {}
-    net.eval()
     print("sample function start")
-    for fid, batch in tqdm(enumerate(test_loader)):
-        inputs = pocket.ops.relocate_to_cuda(batch[:-1])
-        with torch.no_grad():
-            output = net(*inputs)
-        if output is None:
-            continue
-
-        assert len(output) == 1, "Batch size is not 1"
-        output = pocket.ops.relocate_to_cpu(output[0])
+    for i, output, _ in inference(net, test_loader, device):
         np_output = {}
         for key, value in output.items():
             if key not in ["prior", "weights", "phrase"]:
                 np_output[key] = value.numpy()
-        result[str(fid)] = np_output
+        result[str(i)] = np_output
         
     return result
 
-def test(net, test_loader):
-    testset = test_loader.dataset.dataset
-    associate = BoxPairAssociation(min_iou=0.5)
-    meter = DetectionAPMeter(
-        600, nproc=1,
-        num_gt=testset.anno_interaction,
-        algorithm='11P'
-    )
+class ShardSampler(Sampler):
+    """
+    Sample every num_shards-th image of a dataset, starting from the given shard
+
+    Strided shards interleave images from the whole dataset, which balances the
+    load better than contiguous blocks when image statistics drift with the index
+    """
+    def __init__(self, dataset, shard=0, num_shards=1):
+        self.indices = range(shard, len(dataset), num_shards)
+    def __iter__(self):
+        return iter(self.indices)
+    def __len__(self):
+        return len(self.indices)
+
+class BudgetBatchSampler(Sampler):
+    """
+    Batch the images of a sampler up to a budget of cost instead of a fixed count
+
+    Images are sorted by cost and packed greedily into batches whose total cost
+    stays within the budget, so that crowded images are batched with few others
+    and sparse images with many. An image above the budget forms a batch alone.
+    The batches do not follow the order of the sampler, so outputs are to be keyed
+    by the dataset indices given by the batches, as in `inference`
+
+    Parameters:
+    -----------
+    sampler: Sampler
+        Sampler of dataset indices, e.g. ShardSampler
+    costs: ndarray
+        (N,) Cost of each image of the dataset, e.g. its number of boxes or pairs
+    budget: float
+        Maximum total cost of a batch
+    max_batch_size: int
+        Maximum number of images in a batch
+    """
+    def __init__(self, sampler, costs, budget, max_batch_size=64):
+        indices = np.asarray(list(sampler), dtype=np.int64)
+        # Most costly images first, with ties in sampler order
+        indices = indices[np.argsort(-np.asarray(costs)[indices], kind='stable')]
+        self.batches = []
+        batch = []; total = 0
+        for i in indices.tolist():
+            if len(batch) and (total + costs[i] > budget or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch = []; total = 0
+            batch.append(i)
+            total += costs[i]
+        if len(batch):
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def box_pair_counts(box_counts, max_human=15, max_object=15):
+    """
+    Arguments:
+        box_counts(ndarray): (N, 2) Numbers of human and object boxes, see DataFactory.box_counts
+        max_human(int): Maximum number of human boxes kept by the interaction head
+        max_object(int): Maximum number of object boxes kept by the interaction head
+    Returns:
+        ndarray: (N,) Numbers of boxes of each image kept by the interaction head
+        ndarray: (N,) Numbers of box pairs of each image
+    """
+    n_h = np.minimum(box_counts[:, 0], max_human)
+    n = n_h + np.minimum(box_counts[:, 1], max_object)
+    return n, n_h * np.maximum(n - 1, 0)
+
+def pair_costs(box_counts, max_human=15, max_object=15):
+    """
+    Estimate the cost of each image as its number of boxes and box pairs, which
+    drive the costs of the masked attention and of the graph head respectively
+
+    Returns:
+        ndarray: (N,) Estimated costs, see box_pair_counts for the arguments
+    """
+    boxes, pairs = box_pair_counts(box_counts, max_human, max_object)
+    return boxes + pairs
+
+class BalancedDistributedSampler(Sampler):
+    """
+    Distributed sampler that balances the estimated cost of each batch across ranks
+
+    As with DistributedSampler, the dataset is shuffled with the seed and the epoch,
+    and padded to be evenly divisible by the number of ranks. Each training step takes
+    the next num_replicas * batch_size images of the permutation, as the ranks would
+    together, but deals them out by decreasing cost, each to the rank with the lowest
+    total cost that has room left. The images of a step stay random, while the ranks
+    wait less for each other at the gradient and loss synchronisation. The dataloader
+    must use the same batch size.
+
+    Parameters:
+    -----------
+    costs: ndarray
+        (N,) Estimated cost of each image, e.g. from pair_costs
+    batch_size: int
+        Number of images per batch on each rank
+    num_replicas: int
+        Number of ranks
+    rank: int
+        Rank of the current process
+    seed: int
+        Random seed shared by all ranks
+    """
+    def __init__(self, costs, batch_size, num_replicas, rank, seed=0):
+        self.costs = np.asarray(costs, dtype=np.float64)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = -(-len(self.costs) // num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def assign(self):
+        """
+        Returns:
+            list[list[int]]: Indices of the images of each rank, in order
+            float: Estimated fraction of the step time the ranks spend idle, if the
+                images of each step were dealt out in turn as with DistributedSampler
+            float: The same estimate with balanced batches
+        """
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.costs), generator=g).numpy()
+        indices = np.concatenate([indices, indices[:self.total_size - len(indices)]])
+
+        R = self.num_replicas
+        step = R * self.batch_size
+        assigned = [[] for _ in range(R)]
+        total = 0; idle = 0; idle_before = 0
+        for start in range(0, self.total_size, step):
+            images = indices[start: start + step]
+            costs = self.costs[images]
+            k = len(images) // R
+            before = costs.reshape(k, R).sum(0)
+            loads = np.zeros(R); slots = np.full(R, k)
+            for i in np.argsort(-costs, kind='stable'):
+                r = np.argmin(np.where(slots > 0, loads, np.inf))
+                assigned[r].append(int(images[i]))
+                loads[r] += costs[i]; slots[r] -= 1
+            total += before.mean()
+            idle_before += before.max() - before.mean()
+            idle += loads.max() - loads.mean()
+        return assigned, idle_before / (total + idle_before), idle / (total + idle)
+
+    def __iter__(self):
+        assigned, idle_before, idle = self.assign()
+        if self.rank == 0:
+            print("=> Balanced batches: estimated idle time at synchronisation "
+                "{:.1%} of each step, down from {:.1%}".format(idle, idle_before))
+        return iter(assigned[self.rank])
+
+    def __len__(self):
+        return self.num_samples
+
+# Data types of the --amp flags
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def inference(net, dataloader, device='cuda', amp=None):
+    """
+    Run a network over a dataloader and yield the outputs image by image, under
+    autocast to the given data type if amp is not None
+
+    Images without any box pair yield outputs with empty tensors. Outputs come
+    in the order of the batch sampler, e.g. by cost with BudgetBatchSampler, so
+    they are to be keyed by the yielded dataset indices.
+
+    Yields:
+        int: Index of the image in the dataset
+        dict: Output of the network on CPU
+        dict: Target of the image
+    """
     net.eval()
-    for batch in tqdm(test_loader):
-        inputs = pocket.ops .relocate_to_cuda(batch[:-1])
-        with torch.no_grad():
-            output = net(*inputs)
+    dataset = dataloader.dataset.dataset
+    # The batch sampler gives the dataset indices of the images in each batch
+    for indices, batch in zip(dataloader.batch_sampler, tqdm(dataloader)):
+        inputs = pocket.ops.relocate_to_device(batch[:-1], device)
+        with torch.no_grad(), torch.autocast(torch.device(device).type,
+                dtype=amp or torch.float32, enabled=amp is not None):
+            output = net(*inputs, filenames=[dataset.filename(i) for i in indices])
         if output is None:
             continue
 
-        # Batch size is fixed as 1 for inference
-        assert len(output) == 1, "Batch size is not 1"
-        output = pocket.ops.relocate_to_cpu(output[0])
-        target = batch[-1][0]
-        # Format detections
-        box_idx = output['index'] # L
-        boxes_h = output['boxes_h'][box_idx] # L x 4
-        boxes_o = output['boxes_o'][box_idx] # L x 4
-        objects = output['object'][box_idx] # L
-        scores = output['scores'] # L
-        verbs = output['prediction'] # L
-        interactions = torch.tensor([
-            testset.object_n_verb_to_interaction[o][v]
-            for o, v in zip(objects, verbs)
-        ]) #L
-        # Associate detected pairs with ground truth pairs
-        labels = torch.zeros_like(scores)
-        unique_hoi = interactions.unique()
-        for hoi_idx in unique_hoi:
-            gt_idx = torch.nonzero(target['hoi'] == hoi_idx).squeeze(1)
-            det_idx = torch.nonzero(interactions == hoi_idx).squeeze(1)
-            if len(gt_idx):
-                labels[det_idx] = associate(
-                    (target['boxes_h'][gt_idx].view(-1, 4),
-                    target['boxes_o'][gt_idx].view(-1, 4)),
-                    (boxes_h[det_idx].view(-1, 4),
-                    boxes_o[det_idx].view(-1, 4)),
-                    scores[det_idx].view(-1)
-                )
-
-        meter.append(scores, interactions, labels)
-
-    return meter.eval()
+        assert len(output) == len(indices), \
+            "Expected {} outputs but got {}".format(len(indices), len(output))
+        output = pocket.ops.relocate_to_cpu(output)
+        for i, out, target in zip(indices, output, batch[-1]):
+            yield i, out, target
+
+def _run_shard(worker, rank, num_shards, args, results):
+    try:
+        worker(rank, num_shards, args, results.put)
+    finally:
+        # Mark the end of the shard even if the worker failed
+        results.put(None)
+
+def run_sharded(worker, num_shards, args):
+    """
+    Run worker(rank, num_shards, args, put) in num_shards processes and yield
+    everything the workers pass to put, in the order of arrival
+
+    Results should be numpy arrays or Python objects, as tensors sent across
+    processes hold file descriptors until they are released
+    """
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_run_shard, args=(worker, rank, num_shards, args, results))
+        for rank in range(num_shards)]
+    for p in processes:
+        p.start()
+    finished = 0
+    while finished < num_shards:
+        try:
+            item = results.get(timeout=10)
+        except queue.Empty:
+            if any(p.exitcode not in (None, 0) for p in processes):
+                break
+            continue
+        if item is None:
+            finished += 1
+        else:
+            yield item
+    if finished < num_shards:
+        # The queue is no longer read, so the other shards may never finish
+        # flushing their results to it. They are stopped instead of awaited
+        failed = [rank for rank, p in enumerate(processes) if p.exitcode not in (None, 0)]
+        for p in processes:
+            p.terminate()
+    for p in processes:
+        p.join()
+    if finished == num_shards:
+        failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if len(failed):
+        raise RuntimeError("Evaluation shards {} failed".format(failed))
+
+def build_inference(args, num_classes, rank=0, num_shards=1):
+    """
+    Build the network and the dataloader of an inference shard of args.dataset,
+    with the network loaded from args.model_path if it exists
+
+    Returns:
+        SpatiallyConditionedGraph: Network on the device of the shard
+        DataLoader: Dataloader over every num_shards-th image
+        torch.device: Device of the shard
+        int: Epoch of the checkpoint, or 0 without one
+    """
+    if args.device == 'cuda':
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+        torch.cuda.empty_cache()
+    else:
+        device = torch.device('cpu')
+        # Split the cores amongst the shards
+        torch.set_num_threads(max(1, os.cpu_count() // num_shards))
+    torch.backends.cudnn.benchmark = False
+
+    dataset = DataFactory(
+        name=args.dataset, partition=args.partition,
+        data_root=args.data_root,
+        detection_root=args.detection_dir, backbone_name=args.backbone_name, num_classes=args.num_class, pose=args.pose, packed_anno=args.packed_anno,
+        warp_cache=args.warp_cache, preprocess=args.worker_preprocess, warp=args.warp,
+        transform_targets=False
+    )
+    sampler = ShardSampler(dataset, rank, num_shards)
+    if args.batch_budget is not None:
+        # Pack images up to a budget of the boxes or pairs the interaction head keeps
+        boxes, pairs = box_pair_counts(dataset.box_counts(args.box_score_thresh),
+            args.max_human, args.max_object)
+        # Without --batch-size, batches are only capped by the sampler's default
+        cap = dict() if args.batch_size is None else dict(max_batch_size=args.batch_size)
+        dataloader = DataLoader(
+            dataset=dataset, collate_fn=custom_collate,
+            num_workers=args.num_workers, pin_memory=device.type == 'cuda',
+            batch_sampler=BudgetBatchSampler(sampler, boxes if args.budget_unit == 'boxes' else pairs,
+                args.batch_budget, **cap)
+        )
+    else:
+        dataloader = DataLoader(
+            dataset=dataset, collate_fn=custom_collate, batch_size=args.batch_size or 1,
+            num_workers=args.num_workers, pin_memory=device.type == 'cuda',
+            sampler=sampler
+        )
+
+    if args.dataset == 'hicodet':
+        object_to_target = dataset.dataset.object_to_verb
+        object_to_interaction = dataset.dataset.object_to_interaction
+        object_n_verb_to_interaction = dataset.dataset.object_n_verb_to_interaction
+        verb_list = dataset.dataset.verbs
+        human_idx = 49
+    elif args.dataset == 'vcoco':
+        object_to_target = dataset.dataset.object_to_action
+        object_to_interaction = None
+        object_n_verb_to_interaction = None
+        verb_list = dataset.dataset.actions
+        human_idx = 1
+    net = SCG(
+        object_to_target, object_n_verb_to_interaction, object_to_interaction, verb_list, human_idx, num_classes=num_classes, backbone_name=args.backbone_name,
+        output_size=args.roi_size, num_iterations=args.num_iter, max_human=args.max_human, max_object=args.max_object,
+        box_score_thresh=args.box_score_thresh, patch_size=args.patch_size, pose=args.pose, warp=args.warp, local_pose=args.local_pose, pose_cls=args.pose_cls,
+        # The pretrained CLIP weights would be overwritten by the checkpoint
+        pretrained=not os.path.exists(args.model_path)
+    )
+
+    epoch = 0
+    if os.path.exists(args.model_path):
+        if rank == 0:
+            print("Loading model from ", args.model_path)
+        checkpoint = load_checkpoint(net, args.model_path)
+        epoch = checkpoint["epoch"]
+    elif len(args.model_path) and rank == 0:
+        print("\nWARNING: The given model path does not exist. "
+            "Proceed to use a randomly initialised model.\n")
+
+    if args.token_cache is not None:
+        assert args.backbone_name == 'CLIP_CLS', \
+            "Backbone tokens can only be cached for CLIP_CLS"
+        # Keyed by a fingerprint of the loaded weights and the preprocessing path
+        net.token_cache = TokenCache(args.token_cache, net.backbone, args.warp,
+            args.worker_preprocess, args.token_cache_gb)
+
+    net.to(device)
+    return net, dataloader, device, epoch
+
+def label_detections(testset, output, target, min_iou=0.5):
+    """
+    Map the detected pairs of an image to interaction classes and label them
+
+    Returns:
+        Tensor: (L,) Interaction classes
+        Tensor: (L,) Scores
+        Tensor: (L,) Binary labels
+    """
+    # Format detections
+    box_idx = output['index'] # L
+    boxes_h = output['boxes_h'][box_idx] # L x 4
+    boxes_o = output['boxes_o'][box_idx] # L x 4
+    objects = output['object'][box_idx] # L
+    scores = output['scores'] # L
+    verbs = output['prediction'] # L
+    interactions = testset.object_n_verb_to_interaction_lut[objects, verbs] #L
+    # Associate detected pairs with ground truth pairs of all classes at once
+    labels = associate_box_pairs(
+        (target['boxes_h'], target['boxes_o']), target['hoi'],
+        (boxes_h, boxes_o), interactions, scores, min_iou
+    )
+    return interactions, scores, labels
+
+def test(net, test_loader, device='cuda', amp=None):
+    testset = test_loader.dataset.dataset
+    evaluator = HOIEvaluator(testset.anno_interaction, min_iou=0.5)
+    for i, output, target in inference(net, test_loader, device, amp):
+        evaluator.extend(i, *label_detections(testset, output, target))
+
+    return evaluator.eval()
+
+class ResultBuffer:
+    """
+    Growable device buffer of the scores, predictions and labels of box pairs
+
+    Results are appended without leaving the device, and gathered across processes
+    with tensor collectives only when logged. The gathered results are ordered by
+    iteration and then by rank, as if they had been gathered at every iteration.
+
+    Parameters:
+    -----------
+    capacity: int
+        Initial number of box pairs the buffer holds, doubled whenever exceeded
+    """
+    def __init__(self, capacity: int = 2 ** 16):
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self._data = None
+        self._size = 0
+        # Number of box pairs appended at each iteration
+        self._counts = []
+
+    def append(self, output: list):
+        """Append the results of an iteration, organised by image"""
+        data = torch.stack([
+            torch.cat([result['scores'].detach() for result in output]),
+            torch.cat([result['prediction'] for result in output]).float(),
+            torch.cat([result['labels'] for result in output]).float()
+        ])
+        n = data.shape[1]
+        if self._data is None:
+            self._data = data.new_empty(3, max(self.capacity, n))
+        elif self._size + n > self._data.shape[1]:
+            grown = data.new_empty(3, max(2 * self._data.shape[1], self._size + n))
+            grown[:, :self._size] = self._data[:, :self._size]
+            self._data = grown
+        self._data[:, self._size: self._size + n] = data
+        self._size += n
+        self._counts.append(n)
+
+    def log(self, meter, device):
+        """
+        Gather the results of all processes and append them to the meter in the
+        master process, then empty the buffer. To be called by every process
+        """
+        data = self._data[:, :self._size] if self._data is not None \
+            else torch.zeros(3, 0, device=device)
+        counts = torch.as_tensor(self._counts, dtype=torch.int64, device=device)
+        world_size = dist.get_world_size()
+        sizes = [torch.zeros(2, dtype=torch.int64, device=device) for _ in range(world_size)]
+        dist.all_gather(sizes, torch.as_tensor([self._size, len(self._counts)], device=device))
+        sizes = torch.stack(sizes).tolist()
+        assert all(s[1] == len(self._counts) for s in sizes), \
+            "Processes ran different numbers of iterations"
+        max_size = max(s[0] for s in sizes)
+        padded = data.new_zeros(3, max_size)
+        padded[:, :self._size] = data
+        all_data = [torch.empty_like(padded) for _ in range(world_size)]
+        all_counts = [torch.empty_like(counts) for _ in range(world_size)]
+        dist.all_gather(all_data, padded)
+        dist.all_gather(all_counts, counts)
+        if dist.get_rank() == 0:
+            chunks = [d[:, :size].cpu().split(c.tolist(), dim=1)
+                for d, c, (size, _) in zip(all_data, all_counts, sizes)]
+            # Interleave the iterations of the processes
+            scores, pred, labels = torch.cat([
+                rank_chunks[i] for i in range(len(self._counts)) for rank_chunks in chunks
+            ], dim=1).unbind(0)
+            meter.append(scores, pred, labels)
+        self.reset()
 
 class CustomisedDLE(DistributedLearningEngine):
-    def __init__(self, net, train_loader, val_loader, num_classes=117, backbone_name='resnet-50', **kwargs):
+    """
+    Parameters:
+    -----------
+    epoch_results: bool
+        If True, keep the training and validation results on the device and gather
+        them across processes once per epoch, instead of at every iteration
+    amp: torch.dtype, optional
+        Data type to autocast the forward passes to, torch.float16 or torch.bfloat16.
+        Losses are scaled against fp16 underflow
+    """
+    def __init__(self, net, train_loader, val_loader, num_classes=117, backbone_name='resnet-50',
+            epoch_results=False, amp=None, **kwargs):
         super().__init__(net, None, train_loader, **kwargs)
         self.val_loader = val_loader
         self.num_classes = num_classes
         self.backbone_name = backbone_name
+        self.epoch_results = epoch_results
+        self.amp = amp
+        # Autocast on the device of the engine, e.g. to bf16 on the CPU
+        self._device_type = torch.device(self._device).type
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler(self._device_type, enabled=amp == torch.float16)
+        else:
+            # Before torch 2.3, gradients can only be scaled on cuda
+            self.scaler = torch.cuda.amp.GradScaler(enabled=amp == torch.float16)
     def _on_start(self):
         self.meter = DetectionAPMeter(self.num_classes, algorithm='11P')
         self.hoi_loss = pocket.utils.SyncedNumericalMeter(maxlen=self._print_interval)
         self.intr_loss = pocket.utils.SyncedNumericalMeter(maxlen=self._print_interval)
+        self.results = ResultBuffer() if self.epoch_results else None
 
     def _on_each_iteration(self):
         self._state.optimizer.zero_grad()
-        output = self._state.net(
-            *self._state.inputs, targets=self._state.targets)
+        with torch.autocast(self._device_type, dtype=self.amp or torch.float32, enabled=self.amp is not None):
+            output = self._state.net(
+                *self._state.inputs, targets=self._state.targets)
         loss_dict = output.pop()
         if loss_dict['hoi_loss'].isnan():
             raise ValueError(f"The HOI loss is NaN for lrank {self._rank}")
         
         self._state.loss = loss_dict['hoi_loss'] + loss_dict['interactiveness_loss']
-        self._state.loss.backward()
-        self._state.optimizer.step()
+        # The scaler is a pass-through unless training in fp16
+        self.scaler.scale(self._state.loss).backward()
+        self.scaler.step(self._state.optimizer)
+        self.scaler.update()
         self.hoi_loss.append(loss_dict['hoi_loss'])
         self.intr_loss.append(loss_dict['interactiveness_loss'])
            
-        self._synchronise_and_log_results(output, self.meter)
+        if self.results is not None:
+            self.results.append(output)
+        else:
+            self._synchronise_and_log_results(output, self.meter)
 
     def _on_end_epoch(self):
         timer = HandyTimer(maxlen=2)
+        if self.results is not None:
+            self.results.log(self.meter, 'cuda')
         # Compute training mAP
         if self._rank == 0:
             with timer:
@@ -341,9 +930,15 @@ class CustomisedDLE(DistributedLearningEngine):
         super()._print_statistics()
         hoi_loss = self.hoi_loss.mean()
         intr_loss = self.intr_loss.mean()
+        net = self._state.net
+        timer = getattr(net, 'module', net).interaction_head.collective_timer
+        t_collective = timer.total(); n_collective = timer.count
+        timer.reset()
         if self._rank == 0:
             print(f"=> HOI classification loss: {hoi_loss:.4f},",
             f"interactiveness loss: {intr_loss:.4f}")
+            print(f"=> Time waiting for collectives: {t_collective:.3f}s",
+            f"over {n_collective} calls")
             self.hoi_loss.reset()
             self.intr_loss.reset()
 
@@ -372,10 +967,17 @@ class CustomisedDLE(DistributedLearningEngine):
     def validate(self):
         meter = DetectionAPMeter(self.num_classes, algorithm='11P')
         self._state.net.eval()
+        buffer = ResultBuffer() if self.epoch_results else None
         for batch in self.val_loader:
             inputs = pocket.ops.relocate_to_cuda(batch)
-            results = self._state.net(*inputs)
-            self._synchronise_and_log_results(results, meter)
+            with torch.autocast(self._device_type, dtype=self.amp or torch.float32, enabled=self.amp is not None):
+                results = self._state.net(*inputs)
+            if buffer is not None:
+                buffer.append(results)
+            else:
+                self._synchronise_and_log_results(results, meter)
+        if buffer is not None:
+            buffer.log(meter, 'cuda')
 
         # Evaluate mAP in master process
         if self._rank == 0: